@@ -0,0 +1,364 @@
+"""Rate-limit-aware admission scheduler for upstream LLM calls.
+
+The scheduler mirrors the upstream's requests-per-minute and tokens-per-minute
+budgets from its ``x-ratelimit-*`` response headers (or from configured
+limits until the first response arrives) and refills them linearly. Each call
+reserves one request plus an estimate of its token cost before it is sent.
+
+When the budget is short, calls wait in per-tenant queues that are served
+round-robin, with interactive requests ahead of batch work. A call whose
+projected wait exceeds its deadline is rejected immediately with a
+``Retry-After`` hint instead of timing out late.
+
+Each process keeps its own scheduler. When several processes share one API
+key (the prefork workers), ``processes`` gives each an equal share of the
+configured and reported budgets so that together they stay within them.
+"""
+import asyncio
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, BATCH)
+
+DEFAULT_MAX_WAIT = {INTERACTIVE: 10.0, BATCH: 120.0}
+DEFAULT_COMPLETION_TOKENS = 1000
+
+_DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a call cannot be admitted within its deadline."""
+
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Parse reset durations such as ``"1s"``, ``"6m0s"`` or ``"20ms"`` into seconds."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> int:
+    """Estimate the token cost of a chat completion: prompt (~4 chars per token) plus completion budget."""
+    prompt_tokens = sum(len(message.get('content') or '') for message in messages) // 4 + 4 * len(messages)
+    return prompt_tokens + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class _Budget:
+    """One linearly refilling budget (requests or tokens)."""
+
+    def __init__(self, limit: Optional[float], window: float = 60.0, share: float = 1.0):
+        self.share = share
+        self.limit = limit * share if limit else limit
+        self.remaining = self.limit
+        self.rate = self.limit / window if self.limit else None
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.limit is None or self.rate is None:
+            return
+        self.remaining = min(self.limit, self.remaining + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def observe(self, limit: Optional[float], remaining: Optional[float], reset: Optional[float], now: float) -> None:
+        if limit:
+            self.limit = limit * self.share
+        if remaining is not None and self.limit:
+            remaining *= self.share
+            self.remaining = remaining
+            self.updated = now
+            # Time until fully replenished gives the refill rate; fall back to a one-minute window
+            if reset and reset > 0 and self.limit > remaining:
+                self.rate = (self.limit - remaining) / reset
+            elif self.rate is None:
+                self.rate = self.limit / 60.0
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until ``amount`` is available (0 if unlimited or available now)."""
+        if self.limit is None or self.remaining is None:
+            return 0.0
+        deficit = amount - self.remaining
+        if deficit <= 0:
+            return 0.0
+        if not self.rate:
+            return math.inf
+        return deficit / self.rate
+
+    def take(self, amount: float) -> None:
+        if self.remaining is not None:
+            self.remaining -= amount
+
+
+class _Ticket:
+    __slots__ = ('tenant', 'priority', 'cost', 'deadline', 'granted', 'notify')
+
+    def __init__(self, tenant: str, priority: str, cost: int, deadline: float, notify):
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = cost
+        self.deadline = deadline
+        self.granted = False
+        self.notify = notify
+
+
+class AdmissionScheduler:
+    """Fair, deadline-aware admission control in front of the upstream."""
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_wait: Optional[Dict[str, float]] = None, processes: int = 1):
+        self._configured = (requests_per_minute, tokens_per_minute)
+        self.processes = max(1, processes)
+        self._requests = _Budget(requests_per_minute, share=1.0 / self.processes)
+        self._tokens = _Budget(tokens_per_minute, share=1.0 / self.processes)
+        self.max_wait = dict(DEFAULT_MAX_WAIT, **(max_wait or {}))
+        self._queues: Dict[str, OrderedDict] = {priority: OrderedDict() for priority in PRIORITIES}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._timer_pid: Optional[int] = None
+        self._next_wake: Optional[float] = None
+        self._stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'upstream_429': 0, 'wait_seconds': 0.0}
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionScheduler':
+        def optional_float(name: str) -> Optional[float]:
+            value = os.getenv(name)
+            return float(value) if value else None
+        return cls(
+            requests_per_minute=optional_float('UPSTREAM_RPM'),
+            tokens_per_minute=optional_float('UPSTREAM_TPM'),
+            max_wait={
+                INTERACTIVE: float(os.getenv('ADMISSION_MAX_WAIT_INTERACTIVE', DEFAULT_MAX_WAIT[INTERACTIVE])),
+                BATCH: float(os.getenv('ADMISSION_MAX_WAIT_BATCH', DEFAULT_MAX_WAIT[BATCH])),
+            },
+            processes=int(os.getenv('ADMISSION_PROCESSES', 1)),
+        )
+
+    def set_processes(self, processes: int) -> None:
+        """Split the budgets across ``processes`` schedulers sharing the upstream key.
+
+        Called before the workers are forked, while nothing has been admitted.
+        """
+        requests_per_minute, tokens_per_minute = self._configured
+        with self._lock:
+            self.processes = max(1, processes)
+            self._requests = _Budget(requests_per_minute, share=1.0 / self.processes)
+            self._tokens = _Budget(tokens_per_minute, share=1.0 / self.processes)
+
+    # -- budget bookkeeping -------------------------------------------------
+
+    def update_from_headers(self, headers: Any) -> None:
+        """Adopt the authoritative budget state from upstream ``x-ratelimit-*`` headers."""
+        if headers is None:
+            return
+
+        def number(name: str) -> Optional[float]:
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        now = time.monotonic()
+        with self._lock:
+            self._requests.observe(number('x-ratelimit-limit-requests'), number('x-ratelimit-remaining-requests'),
+                                   parse_reset(headers.get('x-ratelimit-reset-requests')), now)
+            self._tokens.observe(number('x-ratelimit-limit-tokens'), number('x-ratelimit-remaining-tokens'),
+                                 parse_reset(headers.get('x-ratelimit-reset-tokens')), now)
+            self._dispatch(now)
+
+    def record_rate_limited(self, headers: Any) -> float:
+        """Record an upstream 429 and return how long callers should back off."""
+        retry_after = None
+        if headers is not None:
+            retry_after = parse_reset(headers.get('retry-after-ms'))
+            retry_after = retry_after / 1000.0 if retry_after is not None else parse_reset(headers.get('retry-after'))
+        self.update_from_headers(headers)
+        with self._lock:
+            self._stats['upstream_429'] += 1
+            if retry_after is None:
+                retry_after = max(self._requests.wait_for(1), self._tokens.wait_for(DEFAULT_COMPLETION_TOKENS), 1.0)
+        return retry_after
+
+    def _wait_for(self, requests: float, tokens: float) -> float:
+        return max(self._requests.wait_for(requests), self._tokens.wait_for(tokens))
+
+    def _queued_ahead(self, priority: str):
+        requests, tokens = 0, 0
+        for queued_priority in PRIORITIES[:PRIORITIES.index(priority) + 1]:
+            for tickets in self._queues[queued_priority].values():
+                requests += len(tickets)
+                tokens += sum(ticket.cost for ticket in tickets)
+        return requests, tokens
+
+    # -- queueing -----------------------------------------------------------
+
+    def _submit(self, tenant: str, priority: str, cost: int, max_wait: Optional[float], notify) -> Optional[_Ticket]:
+        """Admit immediately (returns None), enqueue (returns the ticket) or raise AdmissionRejected."""
+        if priority not in self._queues:
+            priority = INTERACTIVE
+        max_wait = self.max_wait[priority] if max_wait is None else max_wait
+        now = time.monotonic()
+        with self._lock:
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            ahead_requests, ahead_tokens = self._queued_ahead(priority)
+            projected = self._wait_for(ahead_requests + 1, ahead_tokens + cost)
+            if projected == 0.0 and not ahead_requests:
+                self._requests.take(1)
+                self._tokens.take(cost)
+                self._stats['admitted'] += 1
+                return None
+            if projected > max_wait:
+                self._stats['rejected'] += 1
+                retry_after = projected if projected != math.inf else max_wait
+                raise AdmissionRejected(
+                    f"Upstream rate limit: projected wait {projected:.1f}s exceeds {max_wait:.1f}s", retry_after
+                )
+            ticket = _Ticket(tenant, priority, cost, now + max_wait, notify)
+            self._queues[priority].setdefault(tenant, deque()).append(ticket)
+            self._stats['queued'] += 1
+            self._ensure_timer()
+            self._dispatch(now)
+            return ticket
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        for priority in PRIORITIES:
+            tenants = self._queues[priority]
+            if tenants:
+                return tenants[next(iter(tenants))][0]
+        return None
+
+    def _pop_ticket(self, ticket: _Ticket) -> None:
+        tenants = self._queues[ticket.priority]
+        tickets = tenants[ticket.tenant]
+        tickets.popleft()
+        # Round-robin between tenants: the tenant just served moves to the back of the line
+        del tenants[ticket.tenant]
+        if tickets:
+            tenants[ticket.tenant] = tickets
+
+    def _dispatch(self, now: float) -> None:
+        """Grant queued tickets in fair order while the budget allows (lock held)."""
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        while True:
+            ticket = self._next_ticket()
+            if ticket is None:
+                self._next_wake = None
+                return
+            wait = self._wait_for(1, ticket.cost)
+            if wait > 0:
+                self._next_wake = now + min(wait, 1.0)
+                self._wakeup.notify_all()
+                return
+            self._pop_ticket(ticket)
+            self._requests.take(1)
+            self._tokens.take(ticket.cost)
+            ticket.granted = True
+            self._stats['admitted'] += 1
+            ticket.notify()
+
+    def _cancel(self, ticket: _Ticket) -> None:
+        """Remove a ticket that gave up waiting (lock held)."""
+        tickets = self._queues[ticket.priority].get(ticket.tenant)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.priority][ticket.tenant]
+        self._stats['rejected'] += 1
+
+    def _ensure_timer(self) -> None:
+        """Run one refill timer thread per process (lock held)."""
+        pid = os.getpid()
+        if self._timer_pid == pid:
+            return
+        self._timer_pid = pid
+        threading.Thread(target=self._timer_loop, name='admission-refill', daemon=True).start()
+
+    def _timer_loop(self) -> None:
+        with self._lock:
+            while True:
+                timeout = None if self._next_wake is None else max(0.0, self._next_wake - time.monotonic())
+                self._wakeup.wait(timeout)
+                self._dispatch(time.monotonic())
+
+    # -- public API ---------------------------------------------------------
+
+    def acquire(self, tenant: str, priority: str, cost: int, max_wait: Optional[float] = None) -> None:
+        """Block until the call is admitted; raise AdmissionRejected if it cannot be in time."""
+        granted = threading.Event()
+        started = time.monotonic()
+        ticket = self._submit(tenant, priority, cost, max_wait, granted.set)
+        if ticket is None:
+            return
+        granted.wait(max(0.0, ticket.deadline - time.monotonic()))
+        with self._lock:
+            self._stats['wait_seconds'] += time.monotonic() - started
+            if ticket.granted:
+                return
+            self._cancel(ticket)
+            retry_after = self._wait_for(1, ticket.cost)
+        raise AdmissionRejected("Upstream rate limit: admission deadline exceeded", max(retry_after, 1.0))
+
+    async def acquire_async(self, tenant: str, priority: str, cost: int, max_wait: Optional[float] = None) -> None:
+        """Coroutine version of ``acquire`` for the asyncio serving mode."""
+        loop = asyncio.get_running_loop()
+        granted = asyncio.Event()
+        started = time.monotonic()
+        ticket = self._submit(tenant, priority, cost, max_wait, lambda: loop.call_soon_threadsafe(granted.set))
+        if ticket is None:
+            return
+        try:
+            await asyncio.wait_for(granted.wait(), max(0.0, ticket.deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        with self._lock:
+            self._stats['wait_seconds'] += time.monotonic() - started
+            if ticket.granted:
+                return
+            self._cancel(ticket)
+            retry_after = self._wait_for(1, ticket.cost)
+        raise AdmissionRejected("Upstream rate limit: admission deadline exceeded", max(retry_after, 1.0))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            waiting = {
+                priority: sum(len(tickets) for tickets in tenants.values())
+                for priority, tenants in self._queues.items()
+            }
+            return dict(
+                self._stats,
+                wait_seconds=round(self._stats['wait_seconds'], 3),
+                waiting=waiting,
+                requests_remaining=self._requests.remaining,
+                requests_limit=self._requests.limit,
+                tokens_remaining=self._tokens.remaining,
+                tokens_limit=self._tokens.limit,
+                processes=self.processes,
+            )
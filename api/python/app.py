@@ -1,40 +1,73 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, stream_with_context
 from flask_cors import CORS
-from openai import OpenAI, OpenAIError, AuthenticationError
+from openai import OpenAIError, RateLimitError
 import os
 from dotenv import load_dotenv
 import logging
 import sys
 import json
-from typing import Dict, Any, Optional
+from typing import Callable, Dict, Any, Optional, Tuple
+import shutil
 import socket
-import openai
+import tempfile
 from datetime import datetime
 import time
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
+import math
+import uuid
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from response_cache import ResponseCache, make_cache_key
+from catalog import ArtifactCatalog
+from idempotency import (
+    IDEMPOTENCY_HEADER, IDEMPOTENT_METHODS, REPLAYED_HEADER, IdempotencyError, IdempotencyInProgress,
+    IdempotencyStore, StoredResponse, body_fingerprint, scoped_key, storable, stored_headers
+)
+from plan_store import GENERATED_SOURCE, LIST_SOURCES, InvalidCursor, LessonPlanStore, PlanNotFound
+from lesson_sections import (
+    join_sections, normalize_content, regenerated_sections, split_sections, validate_section_names
+)
+from static_responses import PreparedResponseCache, prepare_json
+from upstream_client import UpstreamClient
+from admission import BATCH, INTERACTIVE, AdmissionRejected, AdmissionScheduler, estimate_tokens
+import metrics
+from request_logging import RequestLogPolicy, access_entry, configure_logging, logging_stats, start_timings
+from resilience import UpstreamPolicy
+from model_router import ModelRouter
+from prompts import (
+    PROMPT_TEMPLATE_VERSION, GenerationRequest, RequestValidationError,
+    build_lesson_request, build_rubric_request, build_unit_plan_request, build_activities_request,
+    build_section_request, PROMPT_BUILDERS, CURRICULUM_INDEX
+)
+from similarity_index import SimilarityIndex
+from jobs import JobFinished, JobNotFound, JobStore, JobWorkerPool, job_requested
+from server import ServerConfig, serve
+from singleflight import CoalescingTimeout, SingleFlight
+from structured_output import (
+    document_sections, is_structured, parse_document, stream_framer, structured_request, structured_requested
 )
+from sse import SSE_HEADERS, EventStream, cached_tokens, format_sse, iter_stream_events, streaming_requested, usage_to_dict
+
+# Configure logging: records are queued and written by a background thread
+configure_logging()
 logger = logging.getLogger(__name__)
+request_log = RequestLogPolicy.from_env()
 
 # Load environment variables
 load_dotenv()
 
+CORS_ORIGINS = [
+    "http://localhost:3000",  # Next.js development server
+    "http://127.0.0.1:3000",  # Alternate localhost format
+    "https://demo-02.vercel.app",  # Production domain (update as needed)
+]
+
 app = Flask(__name__)
 CORS(app, resources={
     r"/*": {
-        "origins": [
-            "http://localhost:3000",  # Next.js development server
-            "http://127.0.0.1:3000",  # Alternate localhost format
-            "https://demo-02.vercel.app",  # Production domain (update as needed)
-        ],
+        "origins": CORS_ORIGINS,
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "X-Cache-Bypass", "X-Accept-Similar", "X-Tenant-Id", "Prefer", "X-Request-Id", "X-Structured-Output", "Idempotency-Key"],
+        "expose_headers": ["X-Cache", "X-Similarity", "X-Prompt-Tokens-Estimated", "X-Prompt-Tokens", "ETag", "Link", "X-Next-Cursor", "Retry-After", "Location", "X-Request-Id", "X-Model", "Idempotent-Replayed"]
     }
 })
 
@@ -56,47 +89,504 @@ def get_available_port(start_port: int, max_attempts: int = 10) -> int:
         port += 1
     raise RuntimeError(f"No available ports found between {start_port} and {start_port + max_attempts - 1}")
 
-def validate_api_key(api_key: str) -> OpenAI:
-    """Validate OpenAI API key and initialize client."""
-    if not api_key or api_key == 'your-api-key-here':
-        logger.error("OpenAI API key not configured")
-        raise ValueError("OpenAI API key not configured")
+# Shared OpenAI client, created lazily; the API key is validated in the background
+upstream_client = UpstreamClient.from_env()
+admission = AdmissionScheduler.from_env()
+upstream_policy = UpstreamPolicy.from_env()
+model_router = ModelRouter.from_env()
+
+response_cache = ResponseCache.from_env()
+artifact_catalog = ArtifactCatalog.from_env()
+coalescer = SingleFlight.from_env()
+similarity_index = SimilarityIndex.from_env()
+plan_store = LessonPlanStore.from_env()
+idempotency_store = IdempotencyStore.from_env()
+SIMILARITY_AUTO_SERVE = os.getenv('SIMILARITY_AUTO_SERVE', '').lower() in ('1', 'true', 'yes')
+
+def cache_bypass_requested(headers) -> bool:
+    """Return True if the client asked to skip the response cache for this request."""
+    if headers.get('X-Cache-Bypass', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'no-cache' in headers.get('Cache-Control', '').lower()
+
+def similar_results_accepted(headers) -> bool:
+    """Return True if a near-duplicate prior generation may be served for this request."""
+    if SIMILARITY_AUTO_SERVE:
+        return True
+    return headers.get('X-Accept-Similar', '').lower() in ('1', 'true', 'yes')
+
+def similarity_variant(gen: GenerationRequest) -> str:
+    """Identify the prompt template version and parameters a similar prior result must share."""
+    return make_cache_key(gen.endpoint, {}, PROMPT_TEMPLATE_VERSION, gen.params)[:16]
+
+def find_similar(gen: GenerationRequest) -> Optional[Dict[str, Any]]:
+    """Return a prior generation for a near-duplicate request, tagged with its similarity."""
+    match = similarity_index.lookup(gen.endpoint, gen.fields, variant=similarity_variant(gen))
+    if match is None:
+        return None
+    logger.info("Serving %s from a similar prior generation (%s)", gen.endpoint, match['similarity'])
+    return dict(match["result"], similarity=match["similarity"])
+
+def generation_cache_key(gen: GenerationRequest) -> str:
+    """Return the response cache key for a built generation request."""
+    return make_cache_key(gen.endpoint, gen.fields, PROMPT_TEMPLATE_VERSION, gen.params)
+
+def request_tenant() -> str:
+    """Identify the tenant whose fair share an upstream call is charged to."""
+    return request.headers.get('X-Tenant-Id') or request.remote_addr or 'anonymous'
+
+def routed_model(gen: GenerationRequest) -> str:
+    """The model the router picks for ``gen``.
+
+    Structured requests keep the model ``structured_request`` pinned, since a
+    ``json_schema`` response format is not supported by every routed model.
+    """
+    if 'response_format' in gen.params:
+        return gen.params['model']
+    return model_router.route(gen.endpoint, gen.params.get('model'), gen.params.get('max_tokens'))
 
+def call_upstream(gen: GenerationRequest, tenant: str, priority: str = INTERACTIVE, stream: bool = False):
+    """Send a chat completion upstream under the endpoint's deadline and circuit breaker.
+
+    Non-streaming calls may be hedged with a duplicate after the endpoint's p95
+    latency. Streaming calls return an iterator of ``(kind, value)`` events.
+    The model is chosen by the router and recorded in ``gen.model``.
+    """
+    model = gen.model = upstream_policy.select_model(routed_model(gen))
+    metrics.record_prompt(gen.endpoint, gen.prompt_tokens, gen.truncated)
+    expires_at = time.monotonic() + upstream_policy.deadline_for(gen.endpoint)
+    if stream:
+        return upstream_attempt(gen, model, tenant, priority, expires_at, stream=True)
+    return upstream_policy.run(
+        gen.endpoint, lambda hedge: upstream_attempt(gen, model, tenant, priority, expires_at, hedge=hedge))
+
+def upstream_attempt(gen: GenerationRequest, model: str, tenant: str, priority: str, expires_at: float,
+                     stream: bool = False, hedge: bool = False):
+    """Admit one chat completion through the rate-limit scheduler and send it upstream.
+
+    Budgets are refreshed from the response's rate-limit headers; an upstream
+    429 is surfaced as AdmissionRejected so callers can answer with Retry-After.
+    A hedge is only sent if the budget admits it without queueing. The client
+    timeout is whatever is left of the call's deadline after admission.
+    """
+    with metrics.Timer(metrics.admission_wait.labels(priority), 'admission_ms'):
+        admission.acquire(tenant, priority, estimate_tokens(gen.messages, gen.params.get('max_tokens')),
+                          max_wait=0 if hedge else None)
+    timeout = upstream_policy.remaining(gen.endpoint, expires_at)
+    kwargs = dict(gen.params, model=model, messages=gen.messages, timeout=timeout)
+    if stream:
+        kwargs.update(stream=True, stream_options={"include_usage": True})
+    call = metrics.UpstreamCall(gen.endpoint, model, stream, listener=model_router.record)
+    started = time.monotonic()
     try:
-        client = OpenAI(api_key=api_key)
-        client.models.list()
-        logger.info("OpenAI API key validated successfully")
-        return client
-    except AuthenticationError as e:
-        logger.error("Invalid OpenAI API key")
-        raise ValueError("Invalid OpenAI API key") from e
+        raw = upstream_client.client.chat.completions.with_raw_response.create(**kwargs)
+    except RateLimitError as e:
+        call.fail(e)
+        upstream_policy.record(gen.endpoint, model, time.monotonic() - started, e)
+        retry_after = admission.record_rate_limited(e.response.headers)
+        raise AdmissionRejected(f"Upstream rate limit reached: {str(e)}", retry_after) from e
+    except BaseException as e:
+        call.fail(e)
+        upstream_policy.record(gen.endpoint, model, time.monotonic() - started, e)
+        raise
+    upstream_policy.record(gen.endpoint, model, time.monotonic() - started, sample_latency=not stream)
+    admission.update_from_headers(raw.headers)
+    response = raw.parse()
+    if stream:
+        def release():
+            response.close()
+            if call.open:
+                call.fail(ConnectionAbortedError("Upstream stream closed before it was read to the end"))
+        return EventStream(call.observe(iter_stream_events(response)), release)
+    call.event('usage', usage_to_dict(response.usage))
+    call.finish()
+    return response
+
+def rejected_response(e: AdmissionRejected):
+    """Answer a rejected call (rate limit 429, open circuit 503, deadline 504) with a Retry-After hint."""
+    logger.warning("Rejecting generation request: %s", e)
+    response = jsonify({"success": False, "error": str(e), "retry_after": round(e.retry_after, 1)})
+    response.status_code = e.status_code
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+def run_completion(gen: GenerationRequest, bypass_cache: bool = False, accept_similar: bool = False,
+                   tenant: str = 'anonymous', priority: str = INTERACTIVE) -> Tuple[Dict[str, Any], str]:
+    """Return ``(result, cache_status)`` for a generation request.
+
+    Consults the pre-generated catalog, the response cache, the similarity
+    index (when ``accept_similar``) and the single-flight registry before
+    calling the upstream. Does not touch the Flask request, so batch workers
+    can call it.
+    """
+    endpoint = gen.endpoint
+    key = generation_cache_key(gen)
+    if bypass_cache:
+        response_cache.record_bypass(endpoint)
+        cache_status = "BYPASS"
+    else:
+        cataloged = artifact_catalog.get(endpoint, key)
+        if cataloged is not None:
+            return cataloged, "CATALOG"
+        cached = response_cache.get(endpoint, key)
+        if cached is not None:
+            logger.info("Serving %s from response cache", endpoint)
+            return cached, "HIT"
+        if accept_similar:
+            similar = find_similar(gen)
+            if similar is not None:
+                return similar, "SIMILAR"
+        cache_status = "MISS"
+
+    # Identical requests already in flight share one upstream call
+    flight, is_leader = coalescer.join(endpoint, key)
+    if not is_leader:
+        try:
+            return flight.wait(coalescer.timeout), "COALESCED"
+        except CoalescingTimeout:
+            coalescer.record_timeout(endpoint)
+            raise
+
+    try:
+        response = call_upstream(gen, tenant, priority)
+        result = {
+            "content": response.choices[0].message.content,
+            "finish_reason": response.choices[0].finish_reason,
+            "usage": usage_to_dict(response.usage),
+            "model": gen.model
+        }
+        if is_structured(gen):
+            # Never cache (or share) JSON that does not parse
+            parse_document(result["content"])
+        response_cache.set(endpoint, key, result)
+        similarity_index.add(endpoint, gen.fields, result, similarity_variant(gen))
+        flight.finish(result)
+    except BaseException as e:
+        flight.fail(e)
+        raise
+    finally:
+        coalescer.leave(endpoint, key, flight)
+    return result, cache_status
+
+def apply_output_format(gen: GenerationRequest) -> GenerationRequest:
+    """Switch a generation to schema-constrained JSON when the request asked for structured output."""
+    if structured_requested(request.args, request.headers):
+        return structured_request(gen)
+    return gen
+
+def completion_value(gen: GenerationRequest, content: str) -> Any:
+    """The response value of a completion: its text, or the parsed object in structured mode."""
+    return parse_document(content) if is_structured(gen) else content
+
+def cached_completion(gen: GenerationRequest) -> str:
+    """Return the completion text for a generation request, consulting the response cache first."""
+    result, g.cache_status = run_completion(
+        gen, cache_bypass_requested(request.headers), similar_results_accepted(request.headers), request_tenant()
+    )
+    g.similarity = result.get("similarity")
+    g.model = result.get("model")
+    g.prompt_tokens = (gen.prompt_tokens, (result.get("usage") or {}).get("prompt_tokens"))
+    return result["content"]
+
+def store_lesson_plan(gen: GenerationRequest, content: str) -> Dict[str, Any]:
+    """Persist a generated lesson split into sections, so single sections can be regenerated later."""
+    sections = document_sections(parse_document(content)) if is_structured(gen) else split_sections(content)
+    plan = plan_store.add(dict(gen.fields, content=sections, source=GENERATED_SOURCE))
+    return {"plan_id": plan["id"], "sections": sections}
+
+# Per-endpoint work done with each completed generation; the returned fields are added to the response
+COMPLETION_HOOKS: Dict[str, Callable[[GenerationRequest, str], Dict[str, Any]]] = {
+    'generate-lesson': store_lesson_plan,
+}
+
+def completion_extras(gen: GenerationRequest, content: str) -> Dict[str, Any]:
+    """Run the endpoint's completion hook; a failing hook never fails the generation itself."""
+    hook = COMPLETION_HOOKS.get(gen.endpoint)
+    if hook is None:
+        return {}
+    try:
+        return hook(gen, content)
     except Exception as e:
-        logger.error(f"Error initializing OpenAI client: {str(e)}")
+        logger.error("Error running %s completion hook: %s", gen.endpoint, e)
+        return {}
+
+def stream_completion(gen: GenerationRequest,
+                      on_complete: Optional[Callable[[str], Dict[str, Any]]] = None) -> Response:
+    """Stream a generation as SSE frames: ``delta`` per token chunk, then a final ``done`` frame.
+
+    Structured generations send each parsed field as it closes instead of ``delta`` frames.
+
+    ``on_complete`` receives the full text and returns fields to add to the
+    ``done`` frame; it defaults to the endpoint's completion hook.
+    """
+    hook = on_complete or (lambda content: completion_extras(gen, content))
+
+    def on_complete(content: str) -> Dict[str, Any]:
+        try:
+            return hook(content)
+        except Exception as e:
+            logger.error("Error completing streamed %s: %s", gen.endpoint, e)
+            return {"success": False, "error": str(e)}
+
+    endpoint = gen.endpoint
+    key = generation_cache_key(gen)
+    g.prompt_tokens = (gen.prompt_tokens, None)
+    cached = None
+    if cache_bypass_requested(request.headers):
+        response_cache.record_bypass(endpoint)
+        g.cache_status = "BYPASS"
+    else:
+        cached = artifact_catalog.get(endpoint, key)
+        if cached is not None:
+            g.cache_status = "CATALOG"
+        else:
+            cached = response_cache.get(endpoint, key)
+            g.cache_status = "HIT" if cached is not None else "MISS"
+        if cached is None and similar_results_accepted(request.headers):
+            cached = find_similar(gen)
+            if cached is not None:
+                g.cache_status = "SIMILAR"
+                g.similarity = cached["similarity"]
+
+    if cached is not None:
+        g.model = cached.get("model")
+
+        def replay():
+            frames = stream_framer(gen)
+            for event, data in frames(cached["content"]):
+                yield format_sse(event, data)
+            yield format_sse("done", dict({
+                "success": True,
+                "finish_reason": cached.get("finish_reason"),
+                "usage": cached.get("usage"),
+                "model": cached.get("model")
+            }, **on_complete(cached["content"])))
+        return Response(replay(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    flight, is_leader = coalescer.join(endpoint, key)
+    if not is_leader:
+        g.cache_status = "COALESCED"
+
+        def follow():
+            frames = stream_framer(gen)
+            streamed = False
+            try:
+                for chunk in flight.iter_chunks(coalescer.timeout):
+                    streamed = True
+                    for event, data in frames(chunk):
+                        yield format_sse(event, data)
+                result = flight.result
+            except CoalescingTimeout as e:
+                coalescer.record_timeout(endpoint)
+                yield format_sse("error", {"success": False, "error": str(e)})
+                return
+            except Exception as e:
+                yield format_sse("error", {"success": False, "error": str(e)})
+                return
+            if not streamed:
+                # The leader was a non-streaming request; deliver its result at once
+                for event, data in frames(result["content"]):
+                    yield format_sse(event, data)
+            yield format_sse("done", dict({
+                "success": True,
+                "finish_reason": result.get("finish_reason"),
+                "usage": result.get("usage"),
+                "model": result.get("model")
+            }, **on_complete(result["content"])))
+        return Response(follow(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+    # Open the upstream stream before responding so connection errors still map to a JSON 500
+    try:
+        events = call_upstream(gen, request_tenant(), stream=True)
+    except BaseException as e:
+        flight.fail(e)
+        coalescer.leave(endpoint, key, flight)
         raise
+    g.model = gen.model
+    released = []
 
-# Initialize OpenAI client
-api_key = os.getenv('OPENAI_API_KEY')
-try:
-    client = validate_api_key(api_key)
-except Exception as e:
-    logger.error(f"Failed to initialize OpenAI client: {str(e)}")
-    client = None
-
-def validate_request_data(data: Dict[str, Any], required_fields: list) -> Optional[str]:
-    """Validate request data and return error message if invalid."""
-    if not data:
-        return "No se proporcionaron datos"
-    
-    missing_fields = [field for field in required_fields if not data.get(field)]
-    if missing_fields:
-        return f"Faltan campos requeridos: {', '.join(missing_fields)}"
-    
+    def release():
+        """Close the upstream stream and retire the flight; runs once, even if the body is never read."""
+        if released:
+            return
+        released.append(True)
+        events.close()
+        if not flight.done:
+            # The leader's client disconnected mid-stream (or before it started)
+            flight.fail(ConnectionAbortedError("Coalesced stream was aborted"))
+        coalescer.leave(endpoint, key, flight)
+
+    def generate():
+        frames = stream_framer(gen)
+        parts = []
+        finish_reason = None
+        usage = None
+        try:
+            for kind, value in events:
+                if kind == 'delta':
+                    parts.append(value)
+                    flight.publish(value)
+                    for event, data in frames(value):
+                        yield format_sse(event, data)
+                elif kind == 'finish_reason':
+                    finish_reason = value
+                else:
+                    usage = value
+            result = {"content": ''.join(parts), "finish_reason": finish_reason, "usage": usage,
+                      "model": gen.model}
+            if finish_reason == 'stop':
+                if is_structured(gen):
+                    # Never cache (or share) JSON that does not parse
+                    parse_document(result["content"])
+                response_cache.set(endpoint, key, result)
+                similarity_index.add(endpoint, gen.fields, result, similarity_variant(gen))
+            flight.finish(result)
+        except Exception as e:
+            logger.error("Error streaming %s: %s", endpoint, e)
+            flight.fail(e)
+            yield format_sse("error", {"success": False, "error": str(e)})
+            return
+        finally:
+            release()
+        yield format_sse("done", dict({"success": True, "finish_reason": finish_reason, "usage": usage,
+                                       "model": gen.model}, **on_complete(result["content"])))
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+    # The server closes the response even when the client left before the body was iterated
+    response.call_on_close(release)
+    return response
+
+@app.after_request
+def add_cache_status_header(response):
+    """Expose the cache outcome, model and prompt token counts of generation requests."""
+    cache_status = g.get('cache_status')
+    if cache_status:
+        response.headers['X-Cache'] = cache_status
+    if g.get('similarity') is not None:
+        response.headers['X-Similarity'] = str(g.similarity)
+    if g.get('model'):
+        response.headers['X-Model'] = g.model
+    if g.get('prompt_tokens'):
+        estimated, actual = g.prompt_tokens
+        response.headers['X-Prompt-Tokens-Estimated'] = str(estimated)
+        if actual is not None:
+            response.headers['X-Prompt-Tokens'] = str(actual)
+    return response
+
+def request_route() -> str:
+    """Label requests by their URL rule so path parameters don't explode the series count."""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.timings = start_timings()
+    metrics.http_in_flight.labels(request_route()).inc()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        route = request_route()
+        metrics.http_request_duration.labels(route, request.method).observe(time.perf_counter() - started)
+        metrics.http_requests.labels(route, request.method, response.status_code).inc()
+    return response
+
+@app.after_request
+def schedule_access_log(response):
+    """Write the request's JSON access line once its body, including a stream, has been sent."""
+    started = g.get('metrics_started')
+    if started is None or not request_log.access_log:
+        return response
+    timings = g.timings
+    timings['handler_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    response.headers['X-Request-Id'] = request_id
+    route = request_route()
+    fields = dict(method=request.method, path=request.path, route=route, status=response.status_code,
+                  started=started, timings=timings, request_id=request_id,
+                  bytes=response.content_length, cache=g.get('cache_status'), idempotency=g.get('idempotency'))
+    response.call_on_close(lambda: request_log.log_access(access_entry(**fields), route))
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if g.get('metrics_started') is not None:
+        metrics.http_in_flight.labels(request_route()).dec()
+        if exc is not None:
+            metrics.http_requests.labels(request_route(), request.method, 500).inc()
+
+# Read-only POST routes that need no Idempotency-Key handling
+IDEMPOTENCY_EXEMPT_ROUTES = ('/api/similar/<endpoint>',)
+
+@app.before_request
+def claim_idempotency_key():
+    """Replay (or wait for) an earlier request with the same Idempotency-Key, or claim the key for this one."""
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key or request.method not in IDEMPOTENT_METHODS or request.url_rule is None \
+            or request.url_rule.rule in IDEMPOTENCY_EXEMPT_ROUTES:
+        return None
+    try:
+        outcome = idempotency_store.claim(
+            scoped_key(key, request.method, request.path, request.headers.get('X-Tenant-Id', '')),
+            body_fingerprint(request.get_data(), request.query_string))
+    except IdempotencyError as e:
+        response = jsonify({"success": False, "error": str(e)})
+        response.status_code = e.status_code
+        if isinstance(e, IdempotencyInProgress):
+            response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+        return response
+    if isinstance(outcome, StoredResponse):
+        g.idempotency = "replayed"
+        return Response(outcome.body, status=outcome.status, headers=outcome.headers + [(REPLAYED_HEADER, 'true')])
+    g.idempotency_claim = outcome
     return None
 
+def recorded_body(iterable, parts: list, state: Dict[str, bool]):
+    """Pass a streamed body through, keeping a copy and noting whether it was sent to the end."""
+    try:
+        for chunk in iterable:
+            parts.append(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            yield chunk
+        state['complete'] = True
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+@app.after_request
+def store_idempotent_response(response):
+    """Store the response of a request that claimed an Idempotency-Key once its body has been sent."""
+    claim = g.pop('idempotency_claim', None)
+    if claim is None:
+        return response
+    g.idempotency = "stored"
+    streamed = response.is_streamed
+    parts, state = [], {'complete': not streamed}
+    if streamed:
+        response.response = recorded_body(response.response, parts, state)
+
+    def finish():
+        # Runs after every after_request hook, so the stored headers are the final ones
+        body = b''.join(parts) if streamed else response.get_data()
+        headers = list(response.headers.items())
+        if state['complete'] and storable(response.status_code, headers, body):
+            idempotency_store.complete(claim, response.status_code, stored_headers(headers), body)
+        else:
+            idempotency_store.release(claim)
+    response.call_on_close(finish)
+    return response
+
+@app.teardown_request
+def release_idempotency_key(exc):
+    # A claim still here never got a response to store
+    claim = g.pop('idempotency_claim', None)
+    if claim is not None:
+        idempotency_store.release(claim)
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint to verify the server is running correctly"""
-    logger.info("Health check endpoint called")
+    logger.debug("Health check endpoint called")
     return jsonify({
         "status": "healthy",
         "message": "API is operational",
@@ -109,57 +599,30 @@ def generate_lesson():
     """Generate a lesson plan based on the provided parameters"""
     try:
         data = request.json
-        logger.info(f"Received lesson plan generation request: {data}")
-        
-        # Extract parameters
-        subject = data.get('subject', '')
-        grade = data.get('grade', '')
-        topic = data.get('topic', '')
-        duration = data.get('duration', 60)
-        objectives = data.get('objectives', '')
-        
-        # Create prompt for OpenAI
-        prompt = f"""
-        Create a detailed lesson plan for the following:
-        Subject: {subject}
-        Grade: {grade}
-        Topic: {topic}
-        Duration: {duration} minutes
-        Learning Objectives: {objectives}
-        
-        The lesson plan should include:
-        1. Introduction/warm-up activity
-        2. Main content/teaching activities
-        3. Practice activities
-        4. Assessment
-        5. Closure
-        6. Materials needed
+        request_log.log_body(request_route(), data)
         
-        Please structure it in a clear, organized format that a teacher can easily follow.
-        """
+        gen = build_lesson_request(data)
+        gen = apply_output_format(gen)
+        if job_requested(request.args, request.headers):
+            return submit_job(gen, data)
+        if streaming_requested(request.args, request.headers):
+            return stream_completion(gen)
         
-        # Call OpenAI API
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an expert curriculum designer and educator."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1500
-        )
+        # Call OpenAI API (or serve an identical earlier generation from the cache)
+        lesson_plan = cached_completion(gen)
         
-        # Extract and return the lesson plan
-        lesson_plan = response.choices[0].message.content
-        logger.info(f"Generated lesson plan successfully")
+        # Return the lesson plan, stored by section for later regeneration
+        logger.debug("Generated lesson plan successfully")
         
-        return jsonify({
+        return jsonify(dict({
             "success": True,
-            "lesson_plan": lesson_plan
-        })
+            "lesson_plan": completion_value(gen, lesson_plan)
+        }, **completion_extras(gen, lesson_plan)))
     
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
-        logger.error(f"Error generating lesson plan: {str(e)}")
+        logger.error("Error generating lesson plan: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -169,212 +632,591 @@ def generate_lesson():
 def generate_rubric():
     """Generate a rubric based on provided parameters."""
     try:
-        data = request.json
-        error = validate_request_data(data, ['assignmentType', 'criteria', 'gradeLevel'])
-        if error:
-            return jsonify({"success": False, "error": error}), 400
+        try:
+            gen = build_rubric_request(request.json)
+        except RequestValidationError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
 
-        assignment_type = data['assignmentType']
-        criteria = data['criteria']
-        grade_level = data['gradeLevel']
-        
-        prompt = f"""Crea una rúbrica detallada para {assignment_type} de {grade_level}° grado con los siguientes criterios: {', '.join(criteria)}. 
-        Incluye:
-        1. Niveles de desempeño específicos
-        2. Criterios de calificación
-        3. Descriptores para cada nivel
-        4. Puntajes
+        gen = apply_output_format(gen)
+        if job_requested(request.args, request.headers):
+            return submit_job(gen, request.json)
+        if streaming_requested(request.args, request.headers):
+            return stream_completion(gen)
         
-        La respuesta debe estar en español."""
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un asistente docente especializado en crear rúbricas de evaluación alineadas con estándares educativos. Todas tus respuestas deben ser en español."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        rubric = cached_completion(gen)
         
         return jsonify({
             "success": True,
-            "rubric": response.choices[0].message.content
+            "rubric": completion_value(gen, rubric)
         })
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
-        logger.error(f"Error generating rubric: {str(e)}")
+        logger.error("Error generating rubric: %s", e)
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/generate-unit-plan', methods=['POST'])
 def generate_unit_plan():
     """Generate a unit plan based on provided parameters."""
     try:
-        data = request.json
-        error = validate_request_data(data, ['subject', 'grade', 'mainTopic'])
-        if error:
-            return jsonify({"success": False, "error": error}), 400
-
-        subject = data['subject']
-        grade = data['grade']
-        duration = data.get('duration', '4 semanas')
-        main_topic = data['mainTopic']
-        
-        prompt = f"""Crea un plan de unidad de {duration} para la clase de {subject}, {grade}° grado, enfocado en {main_topic}. 
-        Incluye:
-        1. Objetivos de la unidad
-        2. Desglose semanal
-        3. Actividades principales
-        4. Plan de evaluación
-        5. Materiales requeridos
-        
-        Asegúrate de que esté alineado con el Currículo Nacional de Educación Básica del Perú.
-        La respuesta debe estar en español."""
+        try:
+            gen = build_unit_plan_request(request.json)
+        except RequestValidationError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        gen = apply_output_format(gen)
+        if job_requested(request.args, request.headers):
+            return submit_job(gen, request.json)
+        if streaming_requested(request.args, request.headers):
+            return stream_completion(gen)
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un especialista en planificación curricular familiarizado con los estándares educativos peruanos. Todas tus respuestas deben ser en español."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        unit_plan = cached_completion(gen)
         
         return jsonify({
             "success": True,
-            "unit_plan": response.choices[0].message.content
+            "unit_plan": completion_value(gen, unit_plan)
         })
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
-        logger.error(f"Error generating unit plan: {str(e)}")
+        logger.error("Error generating unit plan: %s", e)
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/generate-activities', methods=['POST'])
 def generate_activities():
     try:
-        data = request.json
-        if not data:
-            logger.error("No data provided in request")
-            return jsonify({"success": False, "error": "No data provided"}), 400
-            
-        subject = data.get('subject')
-        grade = data.get('grade')
-        topic = data.get('topic')
-        activity_type = data.get('activityType', 'individual')
-        
-        # Validate required fields
-        if not all([subject, grade, topic]):
-            missing = []
-            if not subject: missing.append("subject")
-            if not grade: missing.append("grade")
-            if not topic: missing.append("topic")
-            logger.error(f"Missing required fields: {', '.join(missing)}")
-            return jsonify({"success": False, "error": f"Missing required fields: {', '.join(missing)}"}), 400
-        
-        prompt = f"""Crea 3 actividades {activity_type}s atractivas para la clase de {subject}, {grade}° grado, sobre {topic}. 
-        Para cada actividad incluye:
-        1. Descripción de la actividad
-        2. Duración
-        3. Materiales necesarios
-        4. Instrucciones paso a paso
-        5. Criterios de evaluación
+        try:
+            gen = build_activities_request(request.json)
+        except RequestValidationError as e:
+            logger.error(str(e))
+            return jsonify({"success": False, "error": str(e)}), 400
         
-        Asegúrate de que las actividades sean apropiadas para el nivel y estén alineadas con el Currículo Nacional.
-        La respuesta debe estar en español."""
+        gen = apply_output_format(gen)
+        if job_requested(request.args, request.headers):
+            return submit_job(gen, request.json)
+
+        fields = gen.fields
+        logger.info("Calling OpenAI API for activities generation with prompt related to %s, %s, %s",
+                    fields['subject'], fields['grade'], fields['topic'])
         
-        logger.info(f"Calling OpenAI API for activities generation with prompt related to {subject}, {grade}, {topic}")
+        if streaming_requested(request.args, request.headers):
+            return stream_completion(gen)
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un experto en crear actividades educativas atractivas alineadas con el Currículo Nacional de Educación Básica del Perú. Todas tus respuestas deben ser en español."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        activities = cached_completion(gen)
         
         logger.info("Successfully generated activities with OpenAI")
         return jsonify({
             "success": True,
-            "activities": response.choices[0].message.content
+            "activities": completion_value(gen, activities)
         })
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except OpenAIError as e:
-        logger.error(f"OpenAI API error: {str(e)}")
+        logger.error("OpenAI API error: %s", e)
         return jsonify({"success": False, "error": f"AI service error: {str(e)}"}), 500
     except Exception as e:
-        logger.error(f"Error generating activities: {str(e)}")
+        logger.error("Error generating activities: %s", e)
         return jsonify({"success": False, "error": f"Server error: {str(e)}"}), 500
 
+# Item types accepted by /api/generate-batch, mapped to the endpoint whose prompt builder they reuse
+BATCH_ITEM_TYPES = {
+    'lesson': 'generate-lesson',
+    'rubric': 'generate-rubric',
+    'unit-plan': 'generate-unit-plan',
+    'activities': 'generate-activities',
+}
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 50))
+BATCH_MAX_PARALLEL = int(os.getenv('BATCH_MAX_PARALLEL', 4))
+
+def run_batch_item(index: int, item: Dict[str, Any], bypass_cache: bool, accept_similar: bool,
+                   tenant: str) -> Dict[str, Any]:
+    """Generate one batch item, turning any failure into a per-item error result.
+
+    Failed items carry the ``status`` the single-item endpoint would have
+    answered with: 400 for an invalid item, 429/503/504 when rejected, 500
+    otherwise. Only the 500s are logged as errors.
+    """
+    item_type = item.get('type') if isinstance(item, dict) else None
+    result = {"index": index, "type": item_type}
+    endpoint = BATCH_ITEM_TYPES.get(item_type)
+    if not endpoint:
+        result.update(success=False, status=400, error=f"Unknown item type: {item_type}")
+        return result
+    try:
+        spec = {k: v for k, v in item.items() if k != 'type'}
+        gen = PROMPT_BUILDERS[endpoint](spec)
+        completion, cache_status = run_completion(gen, bypass_cache, accept_similar, tenant, BATCH)
+        result.update({"success": True, gen.result_key: completion["content"], "cache": cache_status,
+                       "model": completion.get("model")})
+    except RequestValidationError as e:
+        result.update(success=False, status=400, error=str(e))
+    except AdmissionRejected as e:
+        result.update(success=False, status=e.status_code, error=str(e), retry_after=round(e.retry_after, 1))
+    except Exception as e:
+        logger.error("Error generating batch item %s (%s): %s", index, item_type, e)
+        result.update(success=False, status=500, error=str(e))
+    return result
+
+@app.route('/api/generate-batch', methods=['POST'])
+def generate_batch():
+    """Generate a list of lesson, rubric, unit plan and activity specs with bounded parallelism.
+
+    Returns ordered JSON by default. With ``Accept: application/x-ndjson`` (or
+    ``?format=ndjson``) or an SSE request, each item is delivered as soon as it
+    completes, tagged with its ``index``.
+    """
+    try:
+        data = request.json
+        items = data.get('items') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({"success": False, "error": "Se requiere una lista 'items' no vacía"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"success": False, "error": f"Máximo {BATCH_MAX_ITEMS} elementos por lote"}), 400
+
+        logger.info("Received batch generation request with %s items", len(items))
+        bypass_cache = cache_bypass_requested(request.headers)
+        accept_similar = similar_results_accepted(request.headers)
+        tenant = request_tenant()
+        executor = ThreadPoolExecutor(max_workers=min(BATCH_MAX_PARALLEL, len(items)))
+        futures = [executor.submit(run_batch_item, i, item, bypass_cache, accept_similar, tenant) for i, item in enumerate(items)]
+
+        use_ndjson = (request.args.get('format') == 'ndjson'
+                      or 'application/x-ndjson' in request.headers.get('Accept', ''))
+        if use_ndjson or streaming_requested(request.args, request.headers):
+            def deliver():
+                failed = 0
+                try:
+                    for future in as_completed(futures):
+                        result = future.result()
+                        failed += not result["success"]
+                        if use_ndjson:
+                            yield json.dumps(result, ensure_ascii=False) + "\n"
+                        else:
+                            yield format_sse("item", result)
+                    summary = {"success": True, "total": len(items), "failed": failed}
+                    if use_ndjson:
+                        yield json.dumps(dict(summary, done=True)) + "\n"
+                    else:
+                        yield format_sse("done", summary)
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+            mimetype = 'application/x-ndjson' if use_ndjson else 'text/event-stream'
+            return Response(deliver(), mimetype=mimetype, headers=SSE_HEADERS)
+
+        try:
+            results = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=False)
+        return jsonify({
+            "success": True,
+            "results": results,
+            "total": len(results),
+            "failed": sum(1 for result in results if not result["success"])
+        })
+    except Exception as e:
+        logger.error("Error generating batch: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# Artifacts /api/generate-bundle can produce, in the order they are sent upstream
+BUNDLE_ARTIFACTS = ('lesson', 'rubric', 'activities')
+BUNDLE_DEFAULT_CRITERIA = ["Comprensión del tema", "Aplicación", "Comunicación", "Participación"]
+# Head start for the first artifact so its shared prompt prefix is cached before the others arrive
+BUNDLE_STAGGER_SECONDS = float(os.getenv('BUNDLE_STAGGER_SECONDS', 0.5))
+
+def bundle_specs(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Split a bundle body into the specs of the artifacts it asks for."""
+    subject, grade, topic = data.get('subject'), data.get('grade'), data.get('topic')
+    rubric = data.get('rubric') or {}
+    activities = data.get('activities') or {}
+    specs = {
+        'lesson': {"subject": subject, "grade": grade, "topic": topic,
+                   "duration": data.get('duration', 60), "objectives": data.get('objectives', '')},
+        'rubric': {"subject": subject, "topic": topic, "gradeLevel": grade,
+                   "assignmentType": rubric.get('assignmentType') or f"la clase sobre {topic}",
+                   "criteria": rubric.get('criteria') or BUNDLE_DEFAULT_CRITERIA},
+        'activities': {"subject": subject, "grade": grade, "topic": topic,
+                       "activityType": activities.get('activityType', 'individual'),
+                       "count": activities.get('count', 3)},
+    }
+    requested = data.get('artifacts') or list(BUNDLE_ARTIFACTS)
+    unknown = [name for name in requested if name not in specs]
+    if unknown:
+        raise RequestValidationError(f"Artefactos desconocidos: {', '.join(map(str, unknown))}")
+    return {name: specs[name] for name in BUNDLE_ARTIFACTS if name in requested}
+
+def run_bundle_artifact(name: str, gen: GenerationRequest, bypass_cache: bool, accept_similar: bool,
+                        tenant: str) -> Dict[str, Any]:
+    """Generate one bundle artifact, turning any failure into a per-artifact error."""
+    try:
+        completion, cache_status = run_completion(gen, bypass_cache, accept_similar, tenant)
+    except AdmissionRejected as e:
+        return {"success": False, "error": str(e), "retry_after": round(e.retry_after, 1), "rejected": e}
+    except Exception as e:
+        logger.error("Error generating bundle %s: %s", name, e)
+        return {"success": False, "error": str(e)}
+    usage = completion.get("usage") or {}
+    result = {"success": True, "content": completion["content"], "cache": cache_status, "usage": usage,
+              "cached_tokens": cached_tokens(usage), "model": completion.get("model")}
+    result.update(completion_extras(gen, completion["content"]))
+    return result
+
+@app.route('/api/generate-bundle', methods=['POST'])
+def generate_bundle():
+    """Generate a class's lesson plan, rubric and activities in one call.
+
+    All three prompts start with the same system message and course context,
+    so after the first call the upstream can serve that prefix from its prompt
+    cache; ``usage.cached_tokens`` reports how much it did. The first artifact
+    gets a short head start, then the rest run in parallel. Each artifact is
+    cached under its own endpoint, so later single-artifact calls for the same
+    class are cache hits.
+    """
+    try:
+        data = request.json
+        if not isinstance(data, dict):
+            return jsonify({"success": False, "error": "No se proporcionaron datos"}), 400
+        missing = [name for name in ('subject', 'grade', 'topic') if not data.get(name)]
+        if missing:
+            return jsonify({"success": False, "error": f"Faltan campos requeridos: {', '.join(missing)}"}), 400
+        try:
+            specs = bundle_specs(data)
+            gens = {name: PROMPT_BUILDERS[BATCH_ITEM_TYPES[name]](spec) for name, spec in specs.items()}
+        except RequestValidationError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+
+        logger.info("Generating bundle (%s) for %s, %s, %s",
+                    ', '.join(gens), data['subject'], data['grade'], data['topic'])
+        args = (cache_bypass_requested(request.headers), similar_results_accepted(request.headers), request_tenant())
+        names = list(gens)
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            futures = {names[0]: executor.submit(run_bundle_artifact, names[0], gens[names[0]], *args)}
+            if len(names) > 1:
+                # Returns early if the first artifact finishes (or is served from cache) sooner
+                wait([futures[names[0]]], timeout=BUNDLE_STAGGER_SECONDS)
+            for name in names[1:]:
+                futures[name] = executor.submit(run_bundle_artifact, name, gens[name], *args)
+            results = {name: future.result() for name, future in futures.items()}
+
+        failed = [name for name, result in results.items() if not result["success"]]
+        if len(failed) == len(results):
+            rejected = results[failed[0]].get("rejected")
+            if rejected is not None:
+                return rejected_response(rejected)
+            return jsonify({"success": False, "error": results[failed[0]]["error"]}), 500
+
+        response = {"success": True, "artifacts": {}}
+        totals = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+        for name, result in results.items():
+            result.pop("rejected", None)
+            if result["success"]:
+                response[gens[name].result_key] = result.pop("content")
+                for key in ("plan_id", "sections"):
+                    if key in result:
+                        response[key] = result.pop(key)
+                if result["cache"] in ("MISS", "BYPASS"):
+                    # Only calls made for this request count towards its token totals
+                    totals["prompt_tokens"] += result["usage"].get("prompt_tokens") or 0
+                    totals["completion_tokens"] += result["usage"].get("completion_tokens") or 0
+                    totals["cached_tokens"] += result["cached_tokens"]
+            response["artifacts"][name] = result
+        response["usage"] = totals
+        if failed:
+            response["failed"] = failed
+        return jsonify(response)
+    except Exception as e:
+        logger.error("Error generating bundle: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+def run_generation_job(job, progress) -> Dict[str, Any]:
+    """Run a queued generation at batch priority, streaming its text into the job's partial output.
+
+    Module-level so process-backed job workers can import it.
+    """
+    gen = PROMPT_BUILDERS[job.endpoint](job.spec)
+    if job.options.get('structured'):
+        gen = structured_request(gen)
+    key = generation_cache_key(gen)
+    cache_status = "BYPASS"
+    if not job.options.get('bypass_cache'):
+        cached = artifact_catalog.get(gen.endpoint, key)
+        cache_status = "CATALOG"
+        if cached is None:
+            cached = response_cache.get(gen.endpoint, key)
+            cache_status = "HIT"
+        if cached is not None:
+            progress.write(cached["content"])
+            return {gen.result_key: completion_value(gen, cached["content"]), "finish_reason": cached.get("finish_reason"),
+                    "usage": cached.get("usage"), "model": cached.get("model"), "cache": cache_status}
+        cache_status = "MISS"
+
+    events = call_upstream(gen, job.tenant, BATCH, stream=True)
+    parts = []
+    finish_reason = None
+    usage = None
+    try:
+        for kind, value in events:
+            if kind == 'delta':
+                parts.append(value)
+                progress.write(value)
+            elif kind == 'finish_reason':
+                finish_reason = value
+            else:
+                usage = value
+    finally:
+        events.close()
+    result = {"content": ''.join(parts), "finish_reason": finish_reason, "usage": usage, "model": gen.model}
+    value = completion_value(gen, result["content"])
+    if finish_reason == 'stop':
+        response_cache.set(gen.endpoint, key, result)
+        similarity_index.add(gen.endpoint, gen.fields, result, similarity_variant(gen))
+    return {gen.result_key: value, "finish_reason": finish_reason, "usage": usage,
+            "model": gen.model, "cache": cache_status}
+
+job_store = JobStore.from_env()
+job_pool = JobWorkerPool.from_env(job_store, run_generation_job)
+
+def submit_job(gen: GenerationRequest, spec: Dict[str, Any]) -> Response:
+    """Queue a built generation request as a background job and answer 202 with its id.
+
+    Identical requests share one job unless the client bypassed the cache. The
+    output format is part of the job, so the worker rebuilds a structured request.
+    """
+    bypass_cache = cache_bypass_requested(request.headers)
+    submitted = job_pool.submit(gen.endpoint, spec, request_tenant(),
+                                None if bypass_cache else generation_cache_key(gen),
+                                {"bypass_cache": bypass_cache, "structured": is_structured(gen)})
+    job = submitted["job"]
+    logger.info("%s %s job %s", 'Queued' if submitted['created'] else 'Deduplicated', gen.endpoint, job.id)
+    response = jsonify({
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "deduplicated": not submitted["created"],
+        "status_url": f"/api/jobs/{job.id}"
+    })
+    response.status_code = 202
+    response.headers['Location'] = f"/api/jobs/{job.id}"
+    return response
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Queue a lesson, rubric, unit plan or activities generation and return its job id at once.
+
+    The body is a batch item: ``type`` plus the fields of the matching
+    ``/api/generate-*`` endpoint. Generation routes also accept
+    ``Prefer: respond-async`` (or ``?async=1``) to the same effect.
+    """
+    try:
+        data = request.json
+        item_type = data.get('type') if isinstance(data, dict) else None
+        endpoint = BATCH_ITEM_TYPES.get(item_type)
+        if not endpoint:
+            return jsonify({"success": False, "error": f"Unknown item type: {item_type}"}), 400
+        spec = {k: v for k, v in data.items() if k != 'type'}
+        try:
+            gen = apply_output_format(PROMPT_BUILDERS[endpoint](spec))
+        except RequestValidationError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        return submit_job(gen, spec)
+    except Exception as e:
+        logger.error("Error queueing job: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Return a job's status, its partial output so far and, once finished, its result"""
+    try:
+        return jsonify({"success": True, "job": job_store.get(job_id).to_dict()})
+    except JobNotFound as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except Exception as e:
+        logger.error("Error reading job %s: %s", job_id, e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued job, or ask the worker running it to stop"""
+    try:
+        job = job_store.cancel(job_id)
+        logger.info("Cancellation requested for job %s (%s)", job_id, job.status)
+        return jsonify({"success": True, "job": job.to_dict()})
+    except JobNotFound as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except JobFinished as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    except Exception as e:
+        logger.error("Error cancelling job %s: %s", job_id, e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_response_cache', response_cache.stats,
+    per_endpoint=('memory_hits', 'disk_hits', 'misses', 'bypasses')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_catalog', artifact_catalog.stats, per_endpoint=('hits', 'misses'), gauges=('entries',)))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_idempotency', idempotency_store.stats, gauges=('entries', 'in_progress'),
+    counters=('claimed', 'replayed', 'waited', 'reused_keys', 'timed_out', 'stored', 'released')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_coalescing', coalescer.stats, per_endpoint=('leaders', 'followers', 'timeouts', 'errors'),
+    gauges=('in_flight',)))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_admission', admission.stats, gauges=(('waiting', 'priority'), 'requests_remaining', 'tokens_remaining'),
+    counters=('admitted', 'queued', 'rejected', 'upstream_429')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_resilience', upstream_policy.stats,
+    counters=('calls', 'hedged', 'hedge_wins', 'deadline_exceeded', 'fallbacks', 'rejected_open')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_similarity', similarity_index.stats, gauges=('documents',),
+    counters=('lookups', 'matches', 'evictions')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_jobs', job_pool.stats, gauges=(('by_status', 'status'),),
+    counters=('submitted', 'deduplicated', 'succeeded', 'failed', 'cancelled', 'requeued')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_model_router', model_router.stats, counters=('routed', 'rerouted', 'shadow_diverged')))
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_log', logging_stats, gauges=('queued',), counters=('dropped',)))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Expose request, upstream, token, cache and queue metrics in the Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Return response cache hit/miss counters per generation endpoint"""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/catalog/stats', methods=['GET'])
+def catalog_stats():
+    """Return pre-generated catalog size and hit/miss counters per generation endpoint"""
+    return jsonify(artifact_catalog.stats())
+
+@app.route('/api/idempotency/stats', methods=['GET'])
+def idempotency_stats():
+    """Return stored idempotent responses and replay, wait and conflict counters"""
+    return jsonify(idempotency_store.stats())
+
+@app.route('/api/similar/<endpoint>', methods=['POST'])
+def similar_generation(endpoint):
+    """Offer the closest prior generation for a request body without generating anything"""
+    builder = PROMPT_BUILDERS.get(endpoint)
+    if builder is None:
+        return jsonify({"success": False, "error": f"Unknown endpoint: {endpoint}"}), 404
+    try:
+        gen = apply_output_format(builder(request.json))
+    except RequestValidationError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        logger.error("Error looking up similar generation: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    threshold = request.args.get('threshold', type=float)
+    match = similarity_index.lookup(endpoint, gen.fields, threshold, similarity_variant(gen))
+    if match is None:
+        return jsonify({"success": True, "match": None})
+    return jsonify({
+        "success": True,
+        "match": {
+            "similarity": match["similarity"],
+            "fields": match["fields"],
+            gen.result_key: completion_value(gen, match["result"]["content"]),
+            "created_at": datetime.fromtimestamp(match["created_at"]).isoformat()
+        }
+    })
+
+@app.route('/api/similar/stats', methods=['GET'])
+def similarity_stats():
+    """Return similarity index size and hit counters"""
+    return jsonify(similarity_index.stats())
+
+@app.route('/api/curriculum/stats', methods=['GET'])
+def curriculum_stats():
+    """Return curriculum retrieval index size, rebuild and search counters"""
+    return jsonify(CURRICULUM_INDEX.stats())
+
+@app.route('/api/jobs/stats', methods=['GET'])
+def job_stats():
+    """Return background job counters and queue depth by status"""
+    return jsonify(job_pool.stats())
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats():
+    """Return upstream rate-limit budgets and admission queue counters"""
+    return jsonify(admission.stats())
+
+@app.route('/api/resilience/stats', methods=['GET'])
+def resilience_stats():
+    """Return upstream deadlines, hedging counters and circuit breaker states"""
+    return jsonify(upstream_policy.stats())
+
+@app.route('/api/router/stats', methods=['GET'])
+def router_stats():
+    """Return the model router's decisions and per-model latency and error counters"""
+    return jsonify(model_router.stats())
+
+@app.route('/api/coalescing/stats', methods=['GET'])
+def coalescing_stats():
+    """Return single-flight counters, including how many upstream calls were saved"""
+    return jsonify(coalescer.stats())
+
 @app.route('/api/test-lesson-plans', methods=['GET'])
 def test_lesson_plans():
-    """Return sample lesson plans for testing without authentication"""
-    logger.info("Test lesson plans endpoint called")
-    sample_plans = [
-        {
-            "id": "test-plan-1",
-            "subject": "English",
-            "grade": "8th Grade",
-            "topic": "Poetry Analysis",
-            "duration": 60,
-            "objectives": "Students will learn to identify literary devices in poetry and analyze their effect.",
-            "content": {
-                "introduction": "Begin with a reading of 'The Road Not Taken' by Robert Frost.",
-                "main_content": "Discuss metaphor, imagery, and symbolism in the poem.",
-                "activities": "Group work to identify literary devices in assigned poems.",
-                "assessment": "Students will write a short analysis of a poem using the techniques learned.",
-                "closure": "Class discussion on how poetry analysis skills transfer to other texts."
-            },
-            "created_at": "2023-03-30T14:30:00Z"
-        },
-        {
-            "id": "test-plan-2",
-            "subject": "Science",
-            "grade": "5th Grade",
-            "topic": "The Solar System",
-            "duration": 45,
-            "objectives": "Students will be able to identify the planets in our solar system and describe their key characteristics.",
-            "content": {
-                "introduction": "Show a video clip about space exploration.",
-                "main_content": "Present information about each planet with visual aids.",
-                "activities": "Create a scale model of the solar system in the classroom.",
-                "assessment": "Quiz on planet names, order, and key facts.",
-                "closure": "Discuss how understanding our solar system helps us understand our place in the universe."
-            },
-            "created_at": "2023-03-29T10:15:00Z"
-        },
-        {
-            "id": "test-plan-3",
-            "subject": "Mathematics",
-            "grade": "9th Grade",
-            "topic": "Algebra Basics",
-            "duration": 55,
-            "objectives": "Students will understand how to solve simple equations with one variable.",
-            "content": {
-                "introduction": "Review the concept of variables with real-world examples.",
-                "main_content": "Demonstrate solving for x in various equations.",
-                "activities": "Worksheet practice with graduated difficulty levels.",
-                "assessment": "Exit ticket with 3 equations to solve independently.",
-                "closure": "Discuss how algebraic thinking is used in daily life and various careers."
-            },
-            "created_at": "2023-03-28T09:45:00Z"
-        }
-    ]
-    
-    # Add any dynamically created plans if they exist
-    if hasattr(app, 'test_plans'):
-        sample_plans.extend(app.test_plans)
-    
-    return jsonify(sample_plans)
+    """Return stored lesson plans for testing without authentication.
+
+    Without query parameters this is the full list of test plans, as before
+    pagination existed; lessons stored by the generate endpoints are included
+    with ``source=generated`` or ``source=all``. Supports ``subject``/``grade``
+    filters and opt-in keyset pagination through ``limit``/``cursor``; the next
+    page is advertised in ``X-Next-Cursor`` and ``Link`` headers. Bodies are
+    pre-serialized and pre-compressed per store version, and unchanged
+    listings are answered with 304 via ``ETag``.
+    """
+    logger.debug("Test lesson plans endpoint called")
+    try:
+        subject = request.args.get('subject')
+        grade = request.args.get('grade')
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+        source = request.args.get('source', 'test')
+        if source not in LIST_SOURCES:
+            return jsonify({"success": False, "error": f"source must be one of: {', '.join(LIST_SOURCES)}"}), 400
+
+        version = plan_store.version()
+
+        def build():
+            plans, next_cursor = plan_store.list(subject=subject, grade=grade, limit=limit, cursor=cursor,
+                                                 source=source)
+            headers = {}
+            if next_cursor:
+                args = request.args.to_dict()
+                args['cursor'] = next_cursor
+                headers['X-Next-Cursor'] = next_cursor
+                headers['Link'] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+            return prepare_json(app, plans, cache_control='no-cache', headers=headers)
+
+        # Listings are serialized once per store version and query; ETags make unchanged polls 304
+        key = ('test-lesson-plans', version, subject, grade, limit, cursor, source)
+        return prepared_responses.get_or_build(key, build).to_response(request)
+    except InvalidCursor as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        logger.error("Error listing test lesson plans: %s", e)
+        return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/api/test-lesson-plans', methods=['POST'])
 def test_lesson_plans_post():
     """Handle POST requests to test-lesson-plans, for testing without authentication"""
-    logger.info("POST request to test lesson plans endpoint")
+    logger.debug("POST request to test lesson plans endpoint")
     try:
         plan_data = request.json
-        logger.info(f"Received plan data: {plan_data}")
+        if not isinstance(plan_data, dict):
+            return jsonify({"success": False, "error": "Lesson plan must be a JSON object"}), 400
+        request_log.log_body(request_route(), plan_data)
         
-        # Initialize the test_plans list if it doesn't exist
-        if not hasattr(app, 'test_plans'):
-            app.test_plans = []
-        
-        # Add the new plan to the in-memory list
-        app.test_plans.append(plan_data)
-        logger.info(f"Test lesson plan received and stored. Total plans: {len(app.test_plans)}")
+        # Persist the new plan
+        plan_store.add(plan_data)
+        logger.info("Test lesson plan received and stored. Total plans: %s", plan_store.count())
         
         return jsonify({
             "success": True,
@@ -382,7 +1224,7 @@ def test_lesson_plans_post():
             "data": plan_data
         })
     except Exception as e:
-        logger.error(f"Error handling POST to test-lesson-plans: {str(e)}")
+        logger.error("Error handling POST to test-lesson-plans: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -390,81 +1232,159 @@ def test_lesson_plans_post():
 
 @app.route('/api/test-create-plan', methods=['POST'])
 def create_test_plan():
-    """Add a new test lesson plan to the in-memory store"""
+    """Add a new test lesson plan to the persistent store"""
     try:
         plan_data = request.json
-        logger.info(f"Creating test lesson plan: {plan_data.get('topic')}")
-        
-        # Initialize the test_plans list if it doesn't exist
-        if not hasattr(app, 'test_plans'):
-            app.test_plans = []
+        if not isinstance(plan_data, dict):
+            return jsonify({"success": False, "error": "Lesson plan must be a JSON object"}), 400
+        logger.info("Creating test lesson plan: %s", plan_data.get('topic'))
         
-        # Add the new plan to the in-memory list
-        app.test_plans.append(plan_data)
-        logger.info(f"Test lesson plan created successfully. Total plans: {len(app.test_plans)}")
+        # Persist the new plan
+        plan_store.add(plan_data)
+        logger.info("Test lesson plan created successfully. Total plans: %s", plan_store.count())
         
         return jsonify({
             "success": True,
             "message": "Test lesson plan created successfully"
         })
     except Exception as e:
-        logger.error(f"Error creating test lesson plan: {str(e)}")
+        logger.error("Error creating test lesson plan: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
         }), 500
 
+@app.route('/api/lesson-plans/<plan_id>', methods=['GET'])
+def get_lesson_plan(plan_id):
+    """Return one stored lesson plan with its content split into sections"""
+    try:
+        plan = plan_store.get(plan_id)
+        plan["content"] = normalize_content(plan.get("content", ''))
+        return jsonify({"success": True, "plan": plan})
+    except PlanNotFound as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except Exception as e:
+        logger.error("Error reading lesson plan %s: %s", plan_id, e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/lesson-plans/<plan_id>/regenerate', methods=['POST'])
+def regenerate_lesson_sections(plan_id):
+    """Regenerate only the named sections of a stored lesson plan.
+
+    The body is ``{"sections": ["assessment", ...], "instructions": "..."}``.
+    The other sections go to the model as a short summary, so output tokens
+    and latency scale with what is rewritten. The new sections are merged into
+    the stored plan; streaming requests get them in the ``done`` frame.
+    """
+    try:
+        data = request.json or {}
+        try:
+            targets = validate_section_names(data.get('sections'))
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        instructions = str(data.get('instructions') or '')
+
+        plan = plan_store.get(plan_id)
+        stored_as_sections = isinstance(plan.get("content"), dict)
+        sections = normalize_content(plan.get("content", ''))
+        logger.info("Regenerating sections %s of lesson plan %s", ', '.join(targets), plan_id)
+
+        gen = build_section_request(plan, sections, targets, instructions)
+        # Key on the text being replaced: retries reuse a result, asking again gets a fresh one
+        gen.fields["replacing"] = make_cache_key(
+            gen.endpoint, {key: sections.get(key, '') for key in targets}, PROMPT_TEMPLATE_VERSION, {})[:16]
+
+        def apply(content: str) -> Dict[str, Any]:
+            updates = regenerated_sections(content, targets)
+            if not stored_as_sections:
+                # Legacy plain-text content is rewritten as sections on its first regeneration
+                updates = dict(sections, **updates)
+            updated = plan_store.update_content(plan_id, updates)
+            content = normalize_content(updated["content"])
+            result = {
+                "plan_id": plan_id,
+                "regenerated": [key for key in targets if key in updates],
+                "sections": {key: updates[key] for key in targets if key in updates},
+                "lesson_plan": join_sections(content),
+                "plan": dict(updated, content=content),
+            }
+            missing = [key for key in targets if key not in updates]
+            if missing:
+                result["missing"] = missing
+            return result
+
+        if streaming_requested(request.args, request.headers):
+            return stream_completion(gen, on_complete=apply)
+        return jsonify(dict({"success": True}, **apply(cached_completion(gen))))
+    except PlanNotFound as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except AdmissionRejected as e:
+        return rejected_response(e)
+    except Exception as e:
+        logger.error("Error regenerating sections of lesson plan %s: %s", plan_id, e)
+        return jsonify({"success": False, "error": str(e)}), 500
+
+SAMPLE_ACTIVITIES = [
+    {
+        "id": "activity-1",
+        "title": "Group Discussion on Literary Themes",
+        "subject": "English",
+        "grade": "High School",
+        "duration": 30,
+        "description": "Students form groups to discuss major themes in the assigned reading"
+    },
+    {
+        "id": "activity-2",
+        "title": "Science Experiment: Plant Growth",
+        "subject": "Science",
+        "grade": "Elementary",
+        "duration": 45,
+        "description": "Students observe and record plant growth under different conditions"
+    },
+    {
+        "id": "activity-3",
+        "title": "Math Problem Solving Challenge",
+        "subject": "Mathematics",
+        "grade": "Middle School",
+        "duration": 25,
+        "description": "Students work in pairs to solve real-world math problems"
+    }
+]
+
+CATALOG_CACHE_CONTROL = f"public, max-age={int(os.getenv('CATALOG_MAX_AGE', 60))}"
+prepared_responses = PreparedResponseCache()
+
 @app.route('/api/debug', methods=['GET'])
 def debug_endpoints():
     """Return a list of all available endpoints for debugging"""
-    endpoints = []
-    for rule in app.url_map.iter_rules():
-        endpoints.append({
-            'endpoint': rule.endpoint,
-            'methods': [method for method in rule.methods if method != 'OPTIONS' and method != 'HEAD'],
-            'path': str(rule)
-        })
-    return jsonify({
-        'endpoints': endpoints,
-        'total': len(endpoints)
-    })
+    def build():
+        endpoints = []
+        for rule in app.url_map.iter_rules():
+            endpoints.append({
+                'endpoint': rule.endpoint,
+                'methods': [method for method in rule.methods if method != 'OPTIONS' and method != 'HEAD'],
+                'path': str(rule)
+            })
+        return prepare_json(app, {
+            'endpoints': endpoints,
+            'total': len(endpoints)
+        }, cache_control=CATALOG_CACHE_CONTROL)
+
+    # The URL map is frozen once the first request is served, so this is built once
+    return prepared_responses.get_or_build('debug', build).to_response(request)
 
 @app.route('/api/activities', methods=['GET'])
 def get_activities():
     """Return a list of educational activities"""
-    logger.info("Activities endpoint called")
-    activities = [
-        {
-            "id": "activity-1",
-            "title": "Group Discussion on Literary Themes",
-            "subject": "English",
-            "grade": "High School",
-            "duration": 30,
-            "description": "Students form groups to discuss major themes in the assigned reading"
-        },
-        {
-            "id": "activity-2",
-            "title": "Science Experiment: Plant Growth",
-            "subject": "Science",
-            "grade": "Elementary",
-            "duration": 45,
-            "description": "Students observe and record plant growth under different conditions"
-        },
-        {
-            "id": "activity-3",
-            "title": "Math Problem Solving Challenge",
-            "subject": "Mathematics",
-            "grade": "Middle School",
-            "duration": 25,
-            "description": "Students work in pairs to solve real-world math problems"
-        }
-    ]
-    return jsonify(activities)
+    logger.debug("Activities endpoint called")
+    return prepared_responses.get_or_build(
+        'activities', lambda: prepare_json(app, SAMPLE_ACTIVITIES, cache_control=CATALOG_CACHE_CONTROL)
+    ).to_response(request)
 
 @app.route('/lesson-plans', methods=['GET'])
 def frontend_lesson_plans():
     """Handle direct requests to /lesson-plans (not through API)"""
-    logger.info("/lesson-plans direct endpoint called")
+    logger.debug("/lesson-plans direct endpoint called")
     # This endpoint is just to handle direct requests that might come from frontend
     # Typically, these should be handled by the frontend routing, not Flask
     return jsonify({
@@ -475,52 +1395,39 @@ def frontend_lesson_plans():
 @app.route('/api/proxy/activities', methods=['GET'])
 def proxy_activities():
     """Return a list of educational activities for proxy endpoint"""
-    logger.info("Proxy Activities endpoint called")
+    logger.debug("Proxy Activities endpoint called")
     return get_activities()
 
 @app.route('/api/proxy/lesson-plans', methods=['GET'])
 def proxy_lesson_plans():
     """Return lesson plans for proxy endpoint"""
-    logger.info("Proxy Lesson Plans endpoint called")
+    logger.debug("Proxy Lesson Plans endpoint called")
     return test_lesson_plans()
 
 @app.route('/api/test-openai-key', methods=['GET'])
 def test_openai_key():
-    """Test if the OpenAI API key is valid and working"""
+    """Report whether the OpenAI API key is valid, from the cached background check"""
     try:
-        if not api_key or api_key == 'your-api-key-here':
-            logger.error("OpenAI API key not configured")
+        health = upstream_client.health(refresh=request.args.get('refresh') == '1')
+        if health.get("pending"):
             return jsonify({
                 "valid": False,
-                "error": "OpenAI API key not configured"
+                "pending": True,
+                "error": "OpenAI API key validation in progress"
             })
-
-        # Test API key by making a simple request
-        try:
-            client = OpenAI(api_key=api_key)
-            models = client.models.list()
-            
-            # If we've reached here, the API key is valid
-            logger.info("OpenAI API key is valid")
-            
+        if health["valid"]:
             return jsonify({
                 "valid": True,
-                "models_available": len(models.data)
-            })
-        except AuthenticationError:
-            logger.error("Invalid OpenAI API key")
-            return jsonify({
-                "valid": False,
-                "error": "Invalid OpenAI API key"
-            })
-        except Exception as e:
-            logger.error(f"Error validating OpenAI API key: {str(e)}")
-            return jsonify({
-                "valid": False,
-                "error": f"Error validating OpenAI API key: {str(e)}"
+                "models_available": health["models_available"],
+                "checked_at": health["checked_at"]
             })
+        return jsonify({
+            "valid": False,
+            "error": health["error"],
+            "checked_at": health["checked_at"]
+        })
     except Exception as e:
-        logger.error(f"Unexpected error testing OpenAI key: {str(e)}")
+        logger.error("Unexpected error testing OpenAI key: %s", e)
         return jsonify({
             "valid": False,
             "error": f"Unexpected error: {str(e)}"
@@ -529,7 +1436,7 @@ def test_openai_key():
 @app.route('/api/check-db', methods=['GET'])
 def check_db():
     """Check database connectivity (simulated for now)"""
-    logger.info("Database check endpoint called")
+    logger.debug("Database check endpoint called")
     
     try:
         # This is a placeholder - in a real app, would check actual DB connection
@@ -545,7 +1452,7 @@ def check_db():
             "timestamp": datetime.now().isoformat()
         })
     except Exception as e:
-        logger.error(f"Database check failed: {str(e)}")
+        logger.error("Database check failed: %s", e)
         return jsonify({
             "status": "error",
             "error": str(e),
@@ -556,7 +1463,7 @@ def check_db():
 @app.route('/status', methods=['GET'])
 def status():
     """Status endpoint to verify the server is running correctly (simpler version of health check)"""
-    logger.info("Status endpoint called")
+    logger.debug("Status endpoint called")
     return jsonify({
         "status": "ok",
         "version": "1.0.0",
@@ -565,40 +1472,41 @@ def status():
 
 @app.route('/api/check-openai-key', methods=['GET'])
 def check_openai_key():
-    """Check if the OpenAI API key is valid"""
-    logger.info("OpenAI API key check endpoint called")
+    """Check if the OpenAI API key is valid, from the cached background check"""
+    logger.debug("OpenAI API key check endpoint called")
     
-    try:
-        # Try listing models to validate the key
-        openai.models.list()
+    health = upstream_client.health(refresh=request.args.get('refresh') == '1')
+    if health["valid"]:
         return jsonify({
             "valid": True,
             "message": "API key is valid and working",
+            "checked_at": health["checked_at"],
             "timestamp": datetime.now().isoformat()
         })
-    except Exception as e:
-        logger.error(f"OpenAI API key validation failed: {str(e)}")
-        return jsonify({
-            "valid": False,
-            "error": str(e),
-            "message": "API key validation failed",
-            "timestamp": datetime.now().isoformat()
-        })
+    return jsonify({
+        "valid": False,
+        "pending": bool(health.get("pending")),
+        "error": health.get("error", "OpenAI API key validation in progress"),
+        "message": "API key validation failed",
+        "checked_at": health["checked_at"],
+        "timestamp": datetime.now().isoformat()
+    })
 
-if __name__ == '__main__':
-    # Validate OpenAI API key
-    try:
-        # No need to re-validate here since we've already done it above
-        pass
-    except Exception as e:
-        logger.error(f"Failed to initialize OpenAI client: {str(e)}")
-        exit(1)
+def start_background_services():
+    """Start per-process background work: OpenAI key validation, the job workers and metrics snapshots."""
+    # Start validating the OpenAI API key in the background
+    upstream_client.health()
+    # Resume jobs left queued by a previous run
+    job_pool.start()
+    metrics.start_snapshot_writer()
 
+if __name__ == '__main__':
     # Get port from environment variable or use default
     port = int(os.getenv('FLASK_SERVER_PORT', 5338))
+    debug = os.getenv('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes')
     
-    # If the port is in use, find an available one
-    if is_port_in_use(port):
+    # In development, if the port is in use, find an available one
+    if debug and is_port_in_use(port):
         logger.warning(f"Port {port} is already in use. Searching for an available port...")
         try:
             # Try to find an available port starting from our original port
@@ -615,10 +1523,30 @@ if __name__ == '__main__':
     print(f"FLASK_SERVER_PORT={port}", flush=True)
     sys.stdout.flush()
     
-    logger.info(f"Starting Flask server on 0.0.0.0:{port}")
-    
     try:
-        app.run(host='0.0.0.0', port=port, debug=True)
+        if debug:
+            # Single-process development server with the reloader and debugger
+            logger.info(f"Starting Flask development server on 0.0.0.0:{port}")
+            start_background_services()
+            app.run(host='0.0.0.0', port=port, debug=True)
+        else:
+            # Prefork workers share the app imported above; each starts its own background services
+            config = ServerConfig.from_env(port)
+            # /metrics aggregates the workers through snapshots in a directory they share
+            metrics_dir = metrics.REGISTRY.multiprocess_dir
+            owned_metrics_dir = None
+            if metrics_dir is None and config.workers > 1:
+                metrics_dir = owned_metrics_dir = tempfile.mkdtemp(prefix='profechat-metrics-')
+            if metrics_dir:
+                metrics.enable_multiprocess(metrics_dir)
+            # Workers share one API key, so each admits its share of the upstream budget
+            admission.set_processes(config.workers)
+            try:
+                serve(app, config, post_fork=start_background_services,
+                      worker_exit=metrics.REGISTRY.write_snapshot)
+            finally:
+                if owned_metrics_dir:
+                    shutil.rmtree(owned_metrics_dir, ignore_errors=True)
     except Exception as e:
         logger.error(f"Error starting Flask server: {str(e)}")
-        exit(1) 
\ No newline at end of file
+        exit(1)
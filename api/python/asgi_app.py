@@ -0,0 +1,686 @@
+"""Asyncio serving mode for the ProfeChat API.
+
+The four ``/api/generate-*`` routes are served natively on the event loop
+through one shared ``AsyncOpenAI`` client, bounded by a global semaphore and
+per-endpoint limits, so a single process can keep hundreds of generations in
+flight. Every other route is delegated to the existing Flask app on a worker
+thread, so both serving modes expose the same API.
+
+Run with ``python asgi_app.py`` or ``uvicorn asgi_app:app``. The sync Flask
+server (``python app.py``) remains available for compatibility.
+"""
+import asyncio
+import io
+import json
+import math
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from openai import AsyncOpenAI, RateLimitError
+from werkzeug.datastructures import Headers
+
+import app as flask_module
+import metrics
+from admission import INTERACTIVE, AdmissionRejected, estimate_tokens
+from idempotency import (
+    IDEMPOTENCY_HEADER, REPLAYED_HEADER, IdempotencyError, IdempotencyInProgress, StoredResponse,
+    body_fingerprint, scoped_key, storable, stored_headers
+)
+from jobs import job_requested
+from prompts import PROMPT_BUILDERS, GenerationRequest, RequestValidationError
+from request_logging import access_entry, start_timings
+from response_cache import parse_endpoint_limits
+from singleflight import AsyncFlight, CoalescingTimeout, SingleFlight
+from structured_output import is_structured, parse_document, stream_framer, structured_request, structured_requested
+from sse import SSE_HEADERS, chunk_events, format_sse, streaming_requested, usage_to_dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 256
+
+GENERATE_ROUTES = {f"/api/{endpoint}": endpoint for endpoint in PROMPT_BUILDERS}
+
+
+class AsyncUpstream:
+    """Shared async upstream client with a global and per-endpoint concurrency bound."""
+
+    def __init__(self, api_key: Optional[str], max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 endpoint_limits: Optional[Dict[str, int]] = None):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.endpoint_limits = endpoint_limits or {}
+        self._client: Optional[AsyncOpenAI] = None
+        self._global: Optional[asyncio.Semaphore] = None
+        self._endpoint_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.in_flight: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> 'AsyncUpstream':
+        return cls(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_concurrency=int(os.getenv('ASYNC_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)),
+            endpoint_limits=parse_endpoint_limits(os.getenv('ASYNC_ENDPOINT_LIMITS', '')),
+        )
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            if not self.api_key or self.api_key == 'your-api-key-here':
+                raise ValueError("OpenAI API key not configured")
+            self._client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        return self._client
+
+    def _semaphores(self, endpoint: str) -> Tuple[asyncio.Semaphore, asyncio.Semaphore]:
+        if self._global is None:
+            self._global = asyncio.Semaphore(self.max_concurrency)
+        if endpoint not in self._endpoint_semaphores:
+            limit = self.endpoint_limits.get(endpoint, self.max_concurrency)
+            self._endpoint_semaphores[endpoint] = asyncio.Semaphore(limit)
+        return self._endpoint_semaphores[endpoint], self._global
+
+    async def _acquire(self, endpoint: str) -> None:
+        endpoint_sem, global_sem = self._semaphores(endpoint)
+        await endpoint_sem.acquire()
+        try:
+            await global_sem.acquire()
+        except BaseException:
+            endpoint_sem.release()
+            raise
+        self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+
+    def _release(self, endpoint: str) -> None:
+        endpoint_sem, global_sem = self._semaphores(endpoint)
+        self.in_flight[endpoint] -= 1
+        global_sem.release()
+        endpoint_sem.release()
+
+    async def _create(self, gen: GenerationRequest, model: str, tenant: str, expires_at: float,
+                      stream: bool = False, hedge: bool = False):
+        """Admit one call through the shared rate-limit scheduler and send it upstream.
+
+        The client timeout is whatever is left of the call's deadline after
+        admission. Streaming calls return the metrics recorder along with the
+        raw chunk stream.
+        """
+        with metrics.Timer(metrics.admission_wait.labels(INTERACTIVE), 'admission_ms'):
+            await admission.acquire_async(tenant, INTERACTIVE,
+                                          estimate_tokens(gen.messages, gen.params.get('max_tokens')),
+                                          max_wait=0 if hedge else None)
+        timeout = policy.remaining(gen.endpoint, expires_at)
+        kwargs = dict(gen.params, model=model, messages=gen.messages, timeout=timeout)
+        if stream:
+            kwargs.update(stream=True, stream_options={"include_usage": True})
+        call = metrics.UpstreamCall(gen.endpoint, model, stream, listener=model_router.record)
+        started = time.monotonic()
+        try:
+            raw = await self.client.chat.completions.with_raw_response.create(**kwargs)
+        except RateLimitError as e:
+            call.fail(e)
+            policy.record(gen.endpoint, model, time.monotonic() - started, e)
+            retry_after = admission.record_rate_limited(e.response.headers)
+            raise AdmissionRejected(f"Upstream rate limit reached: {str(e)}", retry_after) from e
+        except BaseException as e:
+            call.fail(e)
+            policy.record(gen.endpoint, model, time.monotonic() - started, e)
+            raise
+        policy.record(gen.endpoint, model, time.monotonic() - started, sample_latency=not stream)
+        admission.update_from_headers(raw.headers)
+        response = raw.parse()
+        if stream:
+            return call, response
+        call.event('usage', usage_to_dict(response.usage))
+        call.finish()
+        return response
+
+    @staticmethod
+    def select_model(gen: GenerationRequest) -> str:
+        """The routed model, or the breaker's fallback for it."""
+        return policy.select_model(flask_module.routed_model(gen))
+
+    async def complete(self, gen: GenerationRequest, tenant: str) -> Dict[str, Any]:
+        """Run a non-streaming completion, hedged and bounded by the endpoint's deadline."""
+        model = gen.model = self.select_model(gen)
+        metrics.record_prompt(gen.endpoint, gen.prompt_tokens, gen.truncated)
+        expires_at = time.monotonic() + policy.deadline_for(gen.endpoint)
+        await self._acquire(gen.endpoint)
+        try:
+            response = await policy.run_async(
+                gen.endpoint, lambda hedge: self._create(gen, model, tenant, expires_at, hedge=hedge))
+        finally:
+            self._release(gen.endpoint)
+        return {
+            "content": response.choices[0].message.content,
+            "finish_reason": response.choices[0].finish_reason,
+            "usage": usage_to_dict(response.usage),
+            "model": model
+        }
+
+    async def open_stream(self, gen: GenerationRequest, tenant: str):
+        """Open a streaming completion and return an async iterator of ``(kind, value)`` events.
+
+        The concurrency slot is held until the iterator is exhausted or closed;
+        admission, breaker and connection errors are raised here, before any
+        response is sent.
+        """
+        model = gen.model = self.select_model(gen)
+        metrics.record_prompt(gen.endpoint, gen.prompt_tokens, gen.truncated)
+        expires_at = time.monotonic() + policy.deadline_for(gen.endpoint)
+        await self._acquire(gen.endpoint)
+        try:
+            call, chunks = await self._create(gen, model, tenant, expires_at, stream=True)
+        except BaseException:
+            self._release(gen.endpoint)
+            raise
+
+        async def events():
+            async for chunk in chunks:
+                for event in chunk_events(chunk):
+                    yield event
+
+        async def observed():
+            try:
+                async for event in call.observe_async(events()):
+                    yield event
+            finally:
+                self._release(gen.endpoint)
+        return observed()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "endpoint_limits": self.endpoint_limits,
+            "in_flight": dict(self.in_flight),
+        }
+
+
+upstream = AsyncUpstream.from_env()
+admission = flask_module.admission
+policy = flask_module.upstream_policy
+model_router = flask_module.model_router
+coalescer = SingleFlight.from_env(flight_factory=AsyncFlight)
+metrics.REGISTRY.add_collector(metrics.stats_collector(
+    'profechat_async_coalescing', coalescer.stats, per_endpoint=('leaders', 'followers', 'timeouts', 'errors'),
+    gauges=('in_flight',)))
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def request_headers(scope) -> Headers:
+    return Headers([(k.decode('latin1'), v.decode('latin1')) for k, v in scope['headers']])
+
+
+def query_args(scope) -> Dict[str, str]:
+    return dict(parse_qsl(scope.get('query_string', b'').decode('latin1')))
+
+
+def response_headers(headers: Headers, content_type: str, extra: Optional[Dict[str, str]] = None) -> List[Tuple[bytes, bytes]]:
+    """Build raw response headers, mirroring the Flask-CORS policy of the sync app."""
+    result = [(b'content-type', content_type.encode('latin1'))]
+    origin = headers.get('Origin')
+    if origin in flask_module.CORS_ORIGINS:
+        result.append((b'access-control-allow-origin', origin.encode('latin1')))
+        result.append((b'access-control-expose-headers', b'X-Cache, X-Similarity, X-Prompt-Tokens-Estimated, '
+                       b'X-Prompt-Tokens, X-Request-Id, X-Model, Idempotent-Replayed, Retry-After'))
+        result.append((b'vary', b'Origin'))
+    for name, value in (extra or {}).items():
+        result.append((name.lower().encode('latin1'), value.encode('latin1')))
+    return result
+
+
+async def send_json(send, headers: Headers, status: int, payload: Any,
+                    extra: Optional[Dict[str, str]] = None) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': response_headers(headers, 'application/json', extra)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def handle_generation(scope, receive, send, endpoint: str) -> None:
+    """Async counterpart of the Flask generate handlers, sharing prompts and cache."""
+    headers = request_headers(scope)
+    body = await read_body(receive)
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        await send_json(send, headers, 400, {"success": False, "error": "Invalid JSON body"})
+        return
+    flask_module.request_log.log_body(scope['path'], data)
+
+    try:
+        gen = PROMPT_BUILDERS[endpoint](data)
+        if structured_requested(query_args(scope), headers):
+            gen = structured_request(gen)
+    except RequestValidationError as e:
+        await send_json(send, headers, 400, {"success": False, "error": str(e)})
+        return
+    except Exception as e:
+        logger.error("Error building %s request: %s", endpoint, e)
+        await send_json(send, headers, 500, {"success": False, "error": str(e)})
+        return
+
+    cache = flask_module.response_cache
+    key = flask_module.generation_cache_key(gen)
+    cached = None
+    if flask_module.cache_bypass_requested(headers):
+        cache.record_bypass(endpoint)
+        cache_status = "BYPASS"
+    else:
+        cached = await asyncio.to_thread(flask_module.artifact_catalog.get, endpoint, key)
+        if cached is not None:
+            cache_status = "CATALOG"
+        else:
+            cached = await asyncio.to_thread(cache.get, endpoint, key)
+            cache_status = "HIT" if cached is not None else "MISS"
+        if cached is None and flask_module.similar_results_accepted(headers):
+            cached = await asyncio.to_thread(flask_module.find_similar, gen)
+            if cached is not None:
+                cache_status = "SIMILAR"
+
+    flight = None
+    is_leader = False
+    if cached is None:
+        # Identical requests already in flight share one upstream call
+        flight, is_leader = coalescer.join(endpoint, key)
+        if not is_leader:
+            cache_status = "COALESCED"
+
+    tenant = headers.get('X-Tenant-Id') or (scope.get('client') or ('anonymous',))[0]
+    if streaming_requested(query_args(scope), headers):
+        events = None
+        if is_leader:
+            try:
+                events = await upstream.open_stream(gen, tenant)
+            except Exception as e:
+                flight.fail(e)
+                coalescer.leave(endpoint, key, flight)
+                await send_error(send, headers, endpoint, e, cache_status)
+                return
+        await stream_generation(send, headers, gen, key, cached, cache_status, flight, events)
+        return
+
+    try:
+        if flight is not None and not is_leader:
+            cached = await follow_flight(endpoint, flight.wait(coalescer.timeout))
+        elif flight is not None:
+            cached = await lead_flight(gen, key, flight, tenant)
+    except Exception as e:
+        await send_error(send, headers, endpoint, e, cache_status)
+        return
+
+    extra = {'X-Cache': cache_status, 'X-Prompt-Tokens-Estimated': str(gen.prompt_tokens)}
+    if cached.get("model"):
+        extra['X-Model'] = cached["model"]
+    if cached.get("similarity") is not None:
+        extra['X-Similarity'] = str(cached["similarity"])
+    actual_tokens = (cached.get("usage") or {}).get("prompt_tokens")
+    if actual_tokens is not None:
+        extra['X-Prompt-Tokens'] = str(actual_tokens)
+    payload = {"success": True, gen.result_key: flask_module.completion_value(gen, cached["content"])}
+    payload.update(await asyncio.to_thread(flask_module.completion_extras, gen, cached["content"]))
+    await send_json(send, headers, 200, payload, extra)
+
+
+async def send_error(send, headers: Headers, endpoint: str, e: Exception, cache_status: str) -> None:
+    """Map a generation failure to 429/503/504 (with Retry-After) or 500, like the Flask handlers."""
+    if isinstance(e, AdmissionRejected):
+        logger.warning("Rejecting %s request: %s", endpoint, e)
+        await send_json(send, headers, e.status_code,
+                        {"success": False, "error": str(e), "retry_after": round(e.retry_after, 1)},
+                        {'X-Cache': cache_status, 'Retry-After': str(max(1, math.ceil(e.retry_after)))})
+        return
+    logger.error("Error generating %s: %s", endpoint, e)
+    await send_json(send, headers, 500, {"success": False, "error": str(e)}, {'X-Cache': cache_status})
+
+
+def record_generation(gen: GenerationRequest, key: str, result: Dict[str, Any]) -> None:
+    """Store a fresh generation in the response cache and the similarity index."""
+    flask_module.response_cache.set(gen.endpoint, key, result)
+    flask_module.similarity_index.add(gen.endpoint, gen.fields, result, flask_module.similarity_variant(gen))
+
+
+async def follow_flight(endpoint: str, waiter):
+    try:
+        return await waiter
+    except CoalescingTimeout:
+        coalescer.record_timeout(endpoint)
+        raise
+
+
+async def lead_flight(gen: GenerationRequest, key: str, flight: AsyncFlight, tenant: str) -> Dict[str, Any]:
+    """Run the upstream call as the single-flight leader and fan the outcome out."""
+    try:
+        result = await upstream.complete(gen, tenant)
+        if is_structured(gen):
+            # Never cache (or share) JSON that does not parse
+            parse_document(result["content"])
+        await asyncio.to_thread(record_generation, gen, key, result)
+        flight.finish(result)
+        return result
+    except BaseException as e:
+        flight.fail(e)
+        raise
+    finally:
+        coalescer.leave(gen.endpoint, key, flight)
+
+
+async def stream_generation(send, headers: Headers, gen: GenerationRequest, key: str,
+                            cached: Optional[Dict[str, Any]], cache_status: str,
+                            flight: Optional[AsyncFlight], events) -> None:
+    """Stream a generation as SSE frames, matching the frames of the sync app.
+
+    ``events`` is the leader's already-opened upstream stream; followers pass None.
+    """
+    extra = dict(SSE_HEADERS, **{'X-Cache': cache_status, 'X-Prompt-Tokens-Estimated': str(gen.prompt_tokens)})
+    if cached is not None and cached.get("similarity") is not None:
+        extra['X-Similarity'] = str(cached["similarity"])
+    model = cached.get("model") if cached is not None else gen.model
+    if model:
+        extra['X-Model'] = model
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': response_headers(headers, 'text/event-stream; charset=utf-8', extra)})
+
+    async def emit(event: str, data: Dict[str, Any], more: bool = True) -> None:
+        await send({'type': 'http.response.body', 'body': format_sse(event, data).encode('utf-8'),
+                    'more_body': more})
+
+    async def emit_done(content: str, finish_reason: Optional[str], usage: Optional[Dict[str, Any]],
+                        model: Optional[str]) -> None:
+        done = {"success": True, "finish_reason": finish_reason, "usage": usage, "model": model}
+        done.update(await asyncio.to_thread(flask_module.completion_extras, gen, content))
+        await emit("done", done, more=False)
+
+    frames = stream_framer(gen)
+    if cached is not None:
+        for event, data in frames(cached["content"]):
+            await emit(event, data)
+        await emit_done(cached["content"], cached.get("finish_reason"), cached.get("usage"), cached.get("model"))
+        return
+
+    if events is None:
+        streamed = False
+        try:
+            async for chunk in flight.iter_chunks(coalescer.timeout):
+                streamed = True
+                for event, data in frames(chunk):
+                    await emit(event, data)
+        except Exception as e:
+            if isinstance(e, CoalescingTimeout):
+                coalescer.record_timeout(gen.endpoint)
+            await emit("error", {"success": False, "error": str(e)}, more=False)
+            return
+        result = flight.result
+        if not streamed:
+            # The leader was a non-streaming request; deliver its result at once
+            for event, data in frames(result["content"]):
+                await emit(event, data)
+        await emit_done(result["content"], result.get("finish_reason"), result.get("usage"), result.get("model"))
+        return
+
+    parts = []
+    finish_reason = None
+    usage = None
+    try:
+        async for kind, value in events:
+            if kind == 'delta':
+                parts.append(value)
+                flight.publish(value)
+                for event, data in frames(value):
+                    await emit(event, data)
+            elif kind == 'finish_reason':
+                finish_reason = value
+            else:
+                usage = value
+        result = {"content": ''.join(parts), "finish_reason": finish_reason, "usage": usage, "model": gen.model}
+        if finish_reason == 'stop':
+            if is_structured(gen):
+                # Never cache (or share) JSON that does not parse
+                parse_document(result["content"])
+            await asyncio.to_thread(record_generation, gen, key, result)
+        flight.finish(result)
+    except Exception as e:
+        logger.error("Error streaming %s: %s", gen.endpoint, e)
+        flight.fail(e)
+        await emit("error", {"success": False, "error": str(e)}, more=False)
+        return
+    finally:
+        if not flight.done:
+            # The leader's client disconnected mid-stream
+            flight.fail(ConnectionAbortedError("Coalesced stream was aborted"))
+        coalescer.leave(gen.endpoint, key, flight)
+    await emit_done(result["content"], finish_reason, usage, gen.model)
+
+
+def run_wsgi(environ: Dict[str, Any], deliver: Callable[[Any], None], gone: threading.Event) -> None:
+    """Run the Flask app for one request, handing its response to ``deliver`` as it is produced.
+
+    ``deliver`` gets ``(status, headers)``, then each body chunk, then None. The
+    whole iteration stays on one thread, so streamed bodies (NDJSON and SSE
+    batches, section regeneration) keep their request context and reach the
+    client chunk by chunk. Iteration stops once ``gone`` is set.
+    """
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = status
+        response_start['headers'] = headers
+
+    try:
+        iterable = flask_module.app.wsgi_app(environ, start_response)
+        try:
+            deliver((response_start['status'], response_start['headers']))
+            for chunk in iterable:
+                if gone.is_set():
+                    break
+                if chunk:
+                    deliver(chunk)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    finally:
+        deliver(None)
+
+
+async def handle_wsgi(scope, receive, send) -> None:
+    """Delegate a request to the sync Flask app on a worker thread."""
+    body = await read_body(receive)
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request_headers(scope).items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f"HTTP_{key}"
+        environ[key] = value
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    gone = threading.Event()
+    worker = asyncio.ensure_future(asyncio.to_thread(
+        run_wsgi, environ, lambda item: loop.call_soon_threadsafe(queue.put_nowait, item), gone))
+    try:
+        start = await queue.get()
+        if start is None:
+            await worker
+            return
+        status, headers = start
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers],
+        })
+        while (chunk := await queue.get()) is not None:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        gone.set()
+        await worker
+
+
+async def idempotent_native(scope, receive, send, handler) -> None:
+    """Run a natively served request under its Idempotency-Key, like the Flask hooks do for bridged routes.
+
+    ``handler(receive, send)`` runs only if this request claims the key; a retry
+    gets the stored response or waits for the original.
+    """
+    headers = request_headers(scope)
+    key = headers.get(IDEMPOTENCY_HEADER)
+    if not key:
+        await handler(receive, send)
+        return
+    body = await read_body(receive)
+    store = flask_module.idempotency_store
+    try:
+        outcome = await store.claim_async(
+            scoped_key(key, scope['method'], scope['path'], headers.get('X-Tenant-Id', '')), body_fingerprint(body, scope.get('query_string', b'')))
+    except IdempotencyError as e:
+        extra = {'Retry-After': str(max(1, math.ceil(e.retry_after)))} if isinstance(e, IdempotencyInProgress) else None
+        await send_json(send, headers, e.status_code, {"success": False, "error": str(e)}, extra)
+        return
+    if isinstance(outcome, StoredResponse):
+        stored = dict((name.lower(), value) for name, value in outcome.headers)
+        content_type = stored.pop('content-type', 'application/json')
+        await send({'type': 'http.response.start', 'status': outcome.status,
+                    'headers': response_headers(headers, content_type, dict(stored, **{REPLAYED_HEADER: 'true'}))})
+        await send({'type': 'http.response.body', 'body': outcome.body})
+        return
+
+    async def receive_body():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    sent = {'status': 500, 'headers': [], 'body': [], 'complete': False}
+
+    async def send_and_capture(message):
+        if message['type'] == 'http.response.start':
+            sent['status'] = message['status']
+            sent['headers'] = [(k.decode('latin1'), v.decode('latin1')) for k, v in message.get('headers', ())]
+        elif message['type'] == 'http.response.body':
+            sent['body'].append(message.get('body', b''))
+            sent['complete'] = not message.get('more_body', False)
+        await send(message)
+
+    try:
+        await handler(receive_body, send_and_capture)
+    finally:
+        response_body = b''.join(sent['body'])
+        if sent['complete'] and storable(sent['status'], sent['headers'], response_body):
+            await asyncio.to_thread(store.complete, outcome, sent['status'], stored_headers(sent['headers']),
+                                    response_body)
+        else:
+            await asyncio.to_thread(store.release, outcome)
+
+
+async def observe_native(scope, handler, send) -> None:
+    """Record request metrics and the access line for a natively served route.
+
+    Bridged routes get both from the Flask request hooks.
+    """
+    route, method = scope['path'], scope['method']
+    headers = request_headers(scope)
+    request_id = headers.get('X-Request-Id') or uuid.uuid4().hex
+    sent = {'status': 500, 'bytes': 0, 'cache': None, 'idempotency': None}
+
+    async def send_and_record(message):
+        if message['type'] == 'http.response.start':
+            sent['status'] = message['status']
+            response_fields = dict(message.get('headers', ()))
+            sent['cache'] = response_fields.get(b'x-cache', b'').decode() or None
+            if response_fields.get(REPLAYED_HEADER.lower().encode()):
+                sent['idempotency'] = "replayed"
+            message = dict(message, headers=list(message.get('headers', ()))
+                           + [(b'x-request-id', request_id.encode())])
+        elif message['type'] == 'http.response.body':
+            sent['bytes'] += len(message.get('body', b''))
+        await send(message)
+
+    started = time.perf_counter()
+    timings = start_timings()
+    metrics.http_in_flight.labels(route).inc()
+    try:
+        await handler(send_and_record)
+    finally:
+        metrics.http_in_flight.labels(route).dec()
+        metrics.http_request_duration.labels(route, method).observe(time.perf_counter() - started)
+        metrics.http_requests.labels(route, method, sent['status']).inc()
+        flask_module.request_log.log_access(access_entry(
+            method, route, route, sent['status'], started, timings,
+            request_id=request_id, bytes=sent['bytes'], cache=sent['cache'], idempotency=sent['idempotency']), route)
+
+
+async def app(scope, receive, send) -> None:
+    """ASGI entry point."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Key validation and the job workers, as the prefork server starts them in each worker
+                flask_module.start_background_services()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.to_thread(flask_module.job_pool.stop)
+                if upstream._client is not None:
+                    await upstream._client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    endpoint = GENERATE_ROUTES.get(scope['path'])
+    if endpoint and scope['method'] == 'POST' and job_requested(query_args(scope), request_headers(scope)):
+        # Job submission is a quick database write; the Flask handler queues it
+        await handle_wsgi(scope, receive, send)
+    elif endpoint and scope['method'] == 'POST':
+        async def generate(receive_, send_):
+            await handle_generation(scope, receive_, send_, endpoint)
+        await observe_native(scope, lambda send_: idempotent_native(scope, receive, send_, generate), send)
+    elif scope['path'] == '/api/upstream/stats' and scope['method'] == 'GET':
+        await read_body(receive)
+        await send_json(send, request_headers(scope), 200, upstream.stats())
+    elif scope['path'] == '/api/coalescing/stats' and scope['method'] == 'GET':
+        await read_body(receive)
+        await send_json(send, request_headers(scope), 200, coalescer.stats())
+    else:
+        await handle_wsgi(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        logger.error("uvicorn is required for the async serving mode: pip install uvicorn")
+        sys.exit(1)
+
+    port = int(os.getenv('FLASK_SERVER_PORT', 5338))
+    print(f"FLASK_SERVER_PORT={port}", flush=True)
+    logger.info(f"Starting async server on 0.0.0.0:{port}")
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level='info',
+                access_log=not flask_module.request_log.access_log)
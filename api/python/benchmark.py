@@ -0,0 +1,581 @@
+"""Load-test harness for the API against a local fake upstream.
+
+Starts ``fake_upstream.py`` and the API (prefork ``app.py``, ``asgi_app.py``
+or the debug server) as subprocesses with throwaway databases and
+``OPENAI_BASE_URL`` pointed at the fake, then drives each scenario with a
+closed loop of ``--concurrency`` keep-alive clients. Every scenario reports
+throughput, latency and time-to-first-byte percentiles (for streams, the
+first byte is the first token), status counts, and the server process tree's
+CPU time and peak RSS/PSS, as one JSON document:
+
+    python benchmark.py --duration 20 --concurrency 32 --output run.json
+    python benchmark.py --compare base.json run.json
+
+Generation bodies get a unique topic per request so the response cache and
+single-flight coalescing don't short-circuit the upstream path; pass
+``--repeat-bodies`` to measure the cached path instead. ``--target`` benchmarks
+an already running server (with ``--server-pid`` for resource sampling).
+Fake upstream behaviour flags (latency, chunk cadence, error and 429
+injection) are passed through; see ``fake_upstream.py``.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import fake_upstream
+from response_cache import parse_endpoint_limits
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_COMMANDS = {
+    'prefork': ['app.py'],
+    'asgi': ['asgi_app.py'],
+    'debug': ['app.py'],
+}
+STARTUP_TIMEOUT_SECONDS = 60.0
+SAMPLE_INTERVAL_SECONDS = 0.25
+
+
+class Scenario:
+    """One route under load: a request template whose body may vary per request."""
+
+    def __init__(self, name: str, method: str, path: str, body: Optional[Callable[[int], Dict[str, Any]]] = None,
+                 headers: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+
+    def request(self, n: int, repeat_bodies: bool) -> Tuple[Optional[bytes], Dict[str, str]]:
+        headers = dict(self.headers)
+        if self.body is None:
+            return None, headers
+        headers['Content-Type'] = 'application/json'
+        return json.dumps(self.body(0 if repeat_bodies else n), ensure_ascii=False).encode('utf-8'), headers
+
+
+def lesson_body(n: int) -> Dict[str, Any]:
+    return {"subject": "Matemática", "grade": "5to grado", "topic": f"Fracciones equivalentes {n}",
+            "duration": 45, "objectives": "Reconocer y representar fracciones equivalentes"}
+
+
+def rubric_body(n: int) -> Dict[str, Any]:
+    return {"assignmentType": f"Informe de laboratorio {n}", "gradeLevel": "2do de secundaria",
+            "criteria": ["Hipótesis", "Procedimiento", "Análisis de datos", "Conclusiones"]}
+
+
+def unit_plan_body(n: int) -> Dict[str, Any]:
+    return {"subject": "Ciencia y Tecnología", "grade": "3er grado", "mainTopic": f"El ciclo del agua {n}",
+            "duration": "4 semanas"}
+
+
+def activities_body(n: int) -> Dict[str, Any]:
+    return {"subject": "Comunicación", "grade": "4to grado", "topic": f"Textos narrativos {n}",
+            "activityType": "grupal"}
+
+
+def bundle_body(n: int) -> Dict[str, Any]:
+    return dict(lesson_body(n), rubric={"criteria": ["Comprensión", "Procedimiento", "Comunicación"]})
+
+
+def build_scenarios() -> Dict[str, Scenario]:
+    scenarios = [
+        Scenario('health', 'GET', '/api/health'),
+        Scenario('status', 'GET', '/status'),
+        Scenario('activities', 'GET', '/api/activities'),
+        Scenario('test-lesson-plans', 'GET', '/api/test-lesson-plans'),
+    ]
+    for endpoint, body in (('generate-lesson', lesson_body), ('generate-rubric', rubric_body),
+                           ('generate-unit-plan', unit_plan_body), ('generate-activities', activities_body)):
+        scenarios.append(Scenario(endpoint, 'POST', f'/api/{endpoint}', body))
+        scenarios.append(Scenario(f'{endpoint}-stream', 'POST', f'/api/{endpoint}?stream=1', body,
+                                  {'Accept': 'text/event-stream'}))
+    scenarios.append(Scenario('generate-bundle', 'POST', '/api/generate-bundle', bundle_body))
+    return {scenario.name: scenario for scenario in scenarios}
+
+
+SCENARIOS = build_scenarios()
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """Summarize seconds as milliseconds: p50/p90/p95/p99 (linear interpolation), mean and max."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def quantile(q: float) -> float:
+        position = (len(ordered) - 1) * q
+        low = int(position)
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+    summary = {f"p{int(q * 100)}": quantile(q) for q in (0.5, 0.9, 0.95, 0.99)}
+    summary.update(mean=sum(ordered) / len(ordered), max=ordered[-1])
+    return {name: round(value * 1000, 2) for name, value in summary.items()}
+
+
+class ProcessTreeSampler:
+    """Samples CPU time and memory of a process and its descendants from ``/proc``.
+
+    CPU includes the time of children that already exited and were reaped
+    (recycled workers). PSS splits copy-on-write pages shared by prefork
+    workers fairly, so it is the better memory figure; it needs
+    ``/proc/<pid>/smaps_rollup``. Off Linux every figure is None.
+    """
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.pid = pid
+        self.interval = interval
+        self.ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.available = os.path.exists(f'/proc/{pid}/stat')
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._peak_rss = 0
+        self._peak_pss = 0
+        self._peak_processes = 0
+
+    def _read_stat(self, pid: int) -> Optional[List[str]]:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # The command name may contain spaces; fields resume after its closing parenthesis
+                return f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            return None
+
+    def tree(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                fields = self._read_stat(int(entry))
+                if fields:
+                    children.setdefault(int(fields[1]), []).append(int(entry))
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending.extend(children.get(pid, ()))
+        return pids
+
+    def cpu_seconds(self) -> Optional[float]:
+        if not self.available:
+            return None
+        total = 0
+        for pid in self.tree():
+            fields = self._read_stat(pid)
+            if fields:
+                # utime, stime; the root also counts its reaped children (cutime, cstime)
+                total += int(fields[11]) + int(fields[12])
+                if pid == self.pid:
+                    total += int(fields[13]) + int(fields[14])
+        return total / self.ticks
+
+    def memory(self) -> Tuple[int, int, int]:
+        rss = pss = 0
+        pids = self.tree()
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    rss += int(f.read().split()[1]) * self.page_size
+                with open(f'/proc/{pid}/smaps_rollup') as f:
+                    match = re.search(r'^Pss:\s+(\d+) kB', f.read(), re.MULTILINE)
+                    pss += int(match.group(1)) * 1024 if match else 0
+            except OSError:
+                continue
+        return rss, pss, len(pids)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            rss, pss, processes = self.memory()
+            self._peak_rss = max(self._peak_rss, rss)
+            self._peak_pss = max(self._peak_pss, pss)
+            self._peak_processes = max(self._peak_processes, processes)
+            self._stop.wait(self.interval)
+
+    def start(self) -> Optional[float]:
+        self._peak_rss = self._peak_pss = self._peak_processes = 0
+        if not self.available:
+            return None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+        self._thread.start()
+        return self.cpu_seconds()
+
+    def stop(self, cpu_started: Optional[float], wall_seconds: float) -> Optional[Dict[str, Any]]:
+        if not self.available or self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        cpu = self.cpu_seconds() - cpu_started
+        return {
+            "cpu_seconds": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / wall_seconds, 1) if wall_seconds else None,
+            "rss_mb_peak": round(self._peak_rss / 2 ** 20, 1),
+            "pss_mb_peak": round(self._peak_pss / 2 ** 20, 1) if self._peak_pss else None,
+            "processes": self._peak_processes,
+        }
+
+
+class LoadRun:
+    """Closed-loop load on one scenario: each client sends its next request as soon as one completes."""
+
+    def __init__(self, base_url: str, scenario: Scenario, concurrency: int, timeout: float,
+                 repeat_bodies: bool = False):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.repeat_bodies = repeat_bodies
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.latencies: List[float] = []
+        self.ttfbs: List[float] = []
+        self.statuses: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.bytes_received = 0
+
+    def one_request(self, conn: http.client.HTTPConnection) -> None:
+        body, headers = self.scenario.request(next(self._sequence), self.repeat_bodies)
+        started = time.perf_counter()
+        conn.request(self.scenario.method, self.scenario.path, body=body, headers=headers)
+        response = conn.getresponse()
+        first_byte = None
+        received = 0
+        while True:
+            chunk = response.read1(65536)
+            if first_byte is None:
+                first_byte = time.perf_counter()
+            if not chunk:
+                break
+            received += len(chunk)
+        # read1() does not mark a fully read Content-Length response closed, which keep-alive needs
+        response.close()
+        finished = time.perf_counter()
+        with self._lock:
+            self.latencies.append(finished - started)
+            self.ttfbs.append(first_byte - started)
+            self.statuses[response.status] += 1
+            self.bytes_received += received
+
+    def client(self, deadline: float, budget: Optional[List[int]]) -> None:
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            while time.monotonic() < deadline:
+                if budget is not None:
+                    with self._lock:
+                        if budget[0] <= 0:
+                            return
+                        budget[0] -= 1
+                try:
+                    self.one_request(conn)
+                except (OSError, http.client.HTTPException) as e:
+                    with self._lock:
+                        self.failures[type(e).__name__] += 1
+                    conn.close()
+        finally:
+            conn.close()
+
+    def run(self, duration: float, max_requests: Optional[int] = None) -> float:
+        """Drive the scenario for ``duration`` seconds (or ``max_requests``); return the wall time."""
+        budget = [max_requests] if max_requests else None
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=self.client, args=(deadline, budget), daemon=True)
+                   for _ in range(self.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def summary(self, wall_seconds: float) -> Dict[str, Any]:
+        completed = len(self.latencies)
+        ok = sum(count for status, count in self.statuses.items() if 200 <= status < 400)
+        return {
+            "concurrency": self.concurrency,
+            "requests": completed,
+            "ok": ok,
+            "errors": completed - ok + sum(self.failures.values()),
+            "status_counts": {str(status): count for status, count in sorted(self.statuses.items())},
+            "failures": dict(self.failures),
+            "wall_seconds": round(wall_seconds, 3),
+            "throughput_rps": round(completed / wall_seconds, 2) if wall_seconds else None,
+            "latency_ms": percentiles(self.latencies),
+            "ttfb_ms": percentiles(self.ttfbs),
+            "bytes_received": self.bytes_received,
+        }
+
+
+class ManagedProcess:
+    """A child process whose stdout is logged to a file and scanned for a ``NAME=port`` line."""
+
+    def __init__(self, command: List[str], env: Dict[str, str], port_marker: str, log_path: str):
+        self.port_marker = port_marker
+        self.port: Optional[int] = None
+        self._ready = threading.Event()
+        self._log = open(log_path, 'w')
+        self.process = subprocess.Popen(command, cwd=HERE, env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, bufsize=1)
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def _pump(self) -> None:
+        for line in self.process.stdout:
+            self._log.write(line)
+            self._log.flush()
+            if self.port is None and line.startswith(f"{self.port_marker}="):
+                self.port = int(line.strip().split('=', 1)[1])
+                self._ready.set()
+        self._ready.set()
+
+    def wait_for_port(self, timeout: float) -> int:
+        if not self._ready.wait(timeout) or self.port is None:
+            raise RuntimeError(f"{self.port_marker} not reported; see {self._log.name}")
+        return self.port
+
+    def stop(self, timeout: float = 15.0) -> None:
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self._log.close()
+
+
+def wait_until_healthy(base_url: str, timeout: float) -> None:
+    parts = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request('GET', '/api/health')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Server at {base_url} did not become healthy")
+        time.sleep(0.2)
+
+
+def fetch_json(base_url: str, path: str) -> Optional[Dict[str, Any]]:
+    parts = urlsplit(base_url)
+    try:
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return json.loads(response.read()) if response.status == 200 else None
+    except (OSError, ValueError):
+        return None
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def server_env(args: argparse.Namespace, upstream_port: int, workdir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{upstream_port}/v1',
+        'FLASK_SERVER_PORT': str(args.port),
+        'RESPONSE_CACHE_DB': os.path.join(workdir, 'response_cache.sqlite3'),
+        'SIMILARITY_INDEX_DB': os.path.join(workdir, 'similarity_index.sqlite3'),
+        'PLAN_STORE_DB': os.path.join(workdir, 'lesson_plans.sqlite3'),
+        'JOB_STORE_DB': os.path.join(workdir, 'jobs.sqlite3'),
+        'CURRICULUM_INDEX_PATH': os.path.join(workdir, 'curriculum_index.idx'),
+        'PYTHONUNBUFFERED': '1',
+    })
+    if args.server == 'debug':
+        env['FLASK_DEBUG'] = '1'
+    else:
+        env.pop('FLASK_DEBUG', None)
+    if args.workers:
+        env['SERVER_WORKERS'] = str(args.workers)
+    return env
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    names = [name.strip() for name in args.scenarios.split(',')] if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+    overrides = parse_endpoint_limits(args.scenario_concurrency)
+
+    workdir = tempfile.mkdtemp(prefix='profechat-bench-')
+    upstream = api = None
+    try:
+        if args.target:
+            base_url = args.target.rstrip('/')
+            server_pid = args.server_pid
+            upstream_url = None
+        else:
+            upstream = ManagedProcess(
+                [sys.executable, 'fake_upstream.py', '--port', '0', '--latency', args.latency,
+                 '--chunk-interval', str(args.chunk_interval), '--chunk-tokens', str(args.chunk_tokens),
+                 '--completion-tokens', str(args.completion_tokens), '--error-rate', str(args.error_rate),
+                 '--rate-limit-rate', str(args.rate_limit_rate), '--rpm', str(args.rpm), '--tpm', str(args.tpm),
+                 '--prompt-cache-min', str(args.prompt_cache_min)],
+                dict(os.environ), 'FAKE_UPSTREAM_PORT', os.path.join(workdir, 'fake_upstream.log'))
+            upstream_port = upstream.wait_for_port(STARTUP_TIMEOUT_SECONDS)
+            upstream_url = f'http://127.0.0.1:{upstream_port}'
+            api = ManagedProcess([sys.executable] + SERVER_COMMANDS[args.server],
+                                 server_env(args, upstream_port, workdir), 'FLASK_SERVER_PORT',
+                                 os.path.join(workdir, 'server.log'))
+            base_url = f'http://127.0.0.1:{api.wait_for_port(STARTUP_TIMEOUT_SECONDS)}'
+            server_pid = api.process.pid
+        wait_until_healthy(base_url, STARTUP_TIMEOUT_SECONDS)
+        sampler = ProcessTreeSampler(server_pid) if server_pid else None
+
+        results = {}
+        for name in names:
+            concurrency = int(overrides.get(name, args.concurrency))
+            load = LoadRun(base_url, SCENARIOS[name], concurrency, args.timeout, args.repeat_bodies)
+            if args.warmup > 0:
+                load.run(args.warmup)
+                load.reset()
+            cpu_started = sampler.start() if sampler else None
+            wall = load.run(args.duration, args.requests)
+            results[name] = load.summary(wall)
+            results[name]["server"] = sampler.stop(cpu_started, wall) if sampler else None
+            logger.info(f"{name}: {results[name]['throughput_rps']} req/s, "
+                        f"p95 {(results[name]['latency_ms'] or {}).get('p95')} ms, {results[name]['errors']} errors")
+
+        return {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "git_commit": git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "server": 'external' if args.target else args.server,
+                "workers": args.workers or None,
+                "duration_seconds": args.duration,
+                "warmup_seconds": args.warmup,
+                "repeat_bodies": args.repeat_bodies,
+                "fake_upstream": None if args.target else {
+                    "latency": args.latency, "chunk_interval": args.chunk_interval,
+                    "chunk_tokens": args.chunk_tokens, "completion_tokens": args.completion_tokens,
+                    "error_rate": args.error_rate, "rate_limit_rate": args.rate_limit_rate,
+                    "rpm": args.rpm, "tpm": args.tpm, "prompt_cache_min": args.prompt_cache_min,
+                },
+            },
+            "scenarios": results,
+            "upstream": fetch_json(upstream_url, '/stats') if upstream_url else None,
+        }
+    finally:
+        if api is not None:
+            api.stop()
+        if upstream is not None:
+            upstream.stop()
+        if args.keep_logs:
+            logger.info(f"Logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def relative_change(base: Optional[float], new: Optional[float]) -> Optional[float]:
+    if base is None or new is None or base == 0:
+        return None
+    return round(100 * (new - base) / base, 1)
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """Percent changes per scenario between two result documents (negative latency = faster)."""
+    fields = {
+        "throughput_rps": lambda r: r.get("throughput_rps"),
+        "latency_p50": lambda r: (r.get("latency_ms") or {}).get("p50"),
+        "latency_p95": lambda r: (r.get("latency_ms") or {}).get("p95"),
+        "latency_p99": lambda r: (r.get("latency_ms") or {}).get("p99"),
+        "ttfb_p50": lambda r: (r.get("ttfb_ms") or {}).get("p50"),
+        "ttfb_p95": lambda r: (r.get("ttfb_ms") or {}).get("p95"),
+        "cpu_seconds": lambda r: (r.get("server") or {}).get("cpu_seconds"),
+        "pss_mb_peak": lambda r: (r.get("server") or {}).get("pss_mb_peak"),
+        "errors": lambda r: r.get("errors"),
+    }
+    scenarios = {}
+    for name in sorted(set(base["scenarios"]) & set(new["scenarios"])):
+        before, after = base["scenarios"][name], new["scenarios"][name]
+        scenarios[name] = {field: {"base": get(before), "new": get(after),
+                                   "change_percent": relative_change(get(before), get(after))}
+                           for field, get in fields.items()}
+    return {
+        "base": base["meta"].get("git_commit"),
+        "new": new["meta"].get("git_commit"),
+        "scenarios": scenarios,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the ProfeChat API against a fake upstream")
+    parser.add_argument('--scenarios', default='', help=f"comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent clients per scenario")
+    parser.add_argument('--scenario-concurrency', default='',
+                        help='per-scenario overrides, e.g. "health=64,generate-unit-plan=8"')
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of measured load per scenario")
+    parser.add_argument('--requests', type=int, default=0, help="stop a scenario after this many requests")
+    parser.add_argument('--warmup', type=float, default=1.0, help="seconds of unmeasured load first")
+    parser.add_argument('--timeout', type=float, default=120.0, help="per-request socket timeout")
+    parser.add_argument('--repeat-bodies', action='store_true',
+                        help="send identical generation bodies (measures the cached path)")
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='prefork')
+    parser.add_argument('--workers', type=int, default=0, help="SERVER_WORKERS for the prefork server")
+    parser.add_argument('--port', type=int, default=5390, help="port for the server under test")
+    parser.add_argument('--target', default='', help="benchmark a running server at this URL instead")
+    parser.add_argument('--server-pid', type=int, default=0, help="with --target, the server pid to sample")
+    parser.add_argument('--output', default='', help="write the JSON result here instead of stdout")
+    parser.add_argument('--keep-logs', action='store_true', help="keep the server and fake upstream logs")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help="compare two result files and exit")
+    fake_upstream.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        stream=sys.stderr)
+
+    if args.compare:
+        documents = []
+        for path in args.compare:
+            with open(path) as f:
+                documents.append(json.load(f))
+        result = compare(*documents)
+    else:
+        result = run_benchmark(args)
+
+    encoded = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(encoded + '\n')
+        logger.info(f"Wrote {args.output}")
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Pre-generated artifact catalog served in front of the response cache.
+
+``pregenerate.py`` fills the catalog offline for the predictable grid of
+curriculum subjects, grades and core topics, so those requests never reach
+the upstream during school hours. Entries are keyed by the same
+content-addressed key as the response cache (normalized fields, prompt
+template version and sampling parameters), so a hit is exact: the request
+would have produced that prompt.
+
+The store is one immutable file: a header, the endpoint names, the sorted
+32-byte keys, one endpoint id per entry, an offset table and the
+zlib-compressed JSON entries. It is memory-mapped, looked up by binary
+search and decompresses only the entry it returns, so workers share its
+pages. Rebuilding it replaces the file atomically; servers pick up the new
+file within ``CATALOG_CHECK_INTERVAL`` seconds. A missing file disables the
+catalog.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CATALOG_MAGIC = b'PCAT'
+CATALOG_VERSION = 1
+# magic, version, entries, built at (unix seconds)
+_HEADER = struct.Struct('<4sIIq')
+_SECTION = struct.Struct('<Q')
+KEY_SIZE = 32
+
+DEFAULT_CHECK_INTERVAL = 5.0
+
+
+def _write_section(out, data: bytes) -> None:
+    out.write(_SECTION.pack(len(data)))
+    out.write(data)
+
+
+def write_catalog(path: str, entries: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+    """Write ``(key, entry)`` pairs atomically (temp file + rename) and return the entry count.
+
+    An entry is ``{"endpoint": ..., "fields": ..., "result": ...}``, the key its
+    hex response cache key.
+    """
+    ordered = sorted((bytes.fromhex(key), entry) for key, entry in dict(entries).items())
+    endpoints = sorted({entry["endpoint"] for _, entry in ordered})
+    endpoint_ids = {endpoint: i for i, endpoint in enumerate(endpoints)}
+    keys, ids, offsets, payload = bytearray(), array('B'), array('Q', [0]), bytearray()
+    for digest, entry in ordered:
+        keys += digest
+        ids.append(endpoint_ids[entry["endpoint"]])
+        encoded = json.dumps({"fields": entry.get("fields"), "result": entry["result"]},
+                             ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        payload += zlib.compress(encoded, 9)
+        offsets.append(len(payload))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(_HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, len(ordered), int(time.time())))
+        for section in ('\n'.join(endpoints).encode('utf-8'), bytes(keys), ids.tobytes(),
+                        offsets.tobytes(), bytes(payload)):
+            _write_section(out, section)
+    os.replace(tmp_path, path)
+    return len(ordered)
+
+
+class CatalogSnapshot:
+    """Read-only view of one memory-mapped catalog file."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, version, self.num_entries, self.built_at = _HEADER.unpack_from(view, 0)
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            raise ValueError("Unsupported artifact catalog format")
+        sections = []
+        position = _HEADER.size
+        for _ in range(5):
+            (length,) = _SECTION.unpack_from(view, position)
+            position += _SECTION.size
+            sections.append(view[position:position + length])
+            position += length
+        endpoints, self._keys, ids, offsets, self._payload = sections
+        self.endpoints = bytes(endpoints).decode('utf-8').split('\n') if self.num_entries else []
+        self._ids = ids.cast('B')
+        self._offsets = offsets.cast('Q')
+
+    def _find(self, digest: bytes) -> int:
+        low, high = 0, self.num_entries
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self._keys[middle * KEY_SIZE:(middle + 1) * KEY_SIZE]) < digest:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.num_entries and bytes(self._keys[low * KEY_SIZE:(low + 1) * KEY_SIZE]) == digest:
+            return low
+        return -1
+
+    def _entry(self, index: int) -> Dict[str, Any]:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return json.loads(zlib.decompress(self._payload[start:end]))
+
+    def get(self, endpoint: str, key: str) -> Optional[Dict[str, Any]]:
+        """Return the stored result for ``key``, or None if absent or stored for another endpoint."""
+        index = self._find(bytes.fromhex(key))
+        if index < 0 or self.endpoints[self._ids[index]] != endpoint:
+            return None
+        return self._entry(index)["result"]
+
+    def entries(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Yield every ``(key, entry)`` pair, for rebuilding or inspecting the catalog."""
+        for index in range(self.num_entries):
+            entry = self._entry(index)
+            entry["endpoint"] = self.endpoints[self._ids[index]]
+            yield bytes(self._keys[index * KEY_SIZE:(index + 1) * KEY_SIZE]).hex(), entry
+
+    def entries_by_endpoint(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for endpoint_id in self._ids:
+            counts[self.endpoints[endpoint_id]] = counts.get(self.endpoints[endpoint_id], 0) + 1
+        return counts
+
+
+class ArtifactCatalog:
+    """The current catalog file, reopened when it is replaced, and its hit counters."""
+
+    def __init__(self, path: str, check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._identity: Optional[Tuple[int, int, int]] = None
+        self._entry_counts: Dict[str, int] = {}
+        self._checked_at = float('-inf')
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self.reloads = 0
+
+    @classmethod
+    def from_env(cls) -> 'ArtifactCatalog':
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'artifacts.catalog')
+        return cls(
+            path=os.getenv('CATALOG_PATH', default_path),
+            check_interval=float(os.getenv('CATALOG_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)),
+        )
+
+    def _current(self) -> Optional[CatalogSnapshot]:
+        """Return the live snapshot, re-checking the file at most every ``check_interval``."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self._snapshot
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                self._snapshot, self._identity, self._entry_counts = None, None, {}
+                return None
+            identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if identity != self._identity:
+                self._identity = identity
+                try:
+                    self._snapshot = CatalogSnapshot(self.path)
+                    self._entry_counts = self._snapshot.entries_by_endpoint()
+                    self.reloads += 1
+                    logger.info(f"Loaded artifact catalog: {self._snapshot.num_entries} entries from {self.path}")
+                except (OSError, ValueError) as e:
+                    self._snapshot, self._entry_counts = None, {}
+                    logger.error(f"Artifact catalog unavailable: {str(e)}")
+        return self._snapshot
+
+    def _count(self, endpoint: str, outcome: str) -> None:
+        with self._lock:
+            counters = self._stats.setdefault(endpoint, {'hits': 0, 'misses': 0})
+            counters[outcome] += 1
+
+    def get(self, endpoint: str, key: str) -> Optional[Dict[str, Any]]:
+        """Return the pre-generated result for a generation request's cache key, if cataloged."""
+        snapshot = self._current()
+        if snapshot is None:
+            return None
+        result = snapshot.get(endpoint, key)
+        self._count(endpoint, 'hits' if result is not None else 'misses')
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._current()
+        with self._lock:
+            endpoints = {endpoint: dict(counters, entries=self._entry_counts.get(endpoint, 0))
+                         for endpoint, counters in self._stats.items()}
+            for endpoint, count in self._entry_counts.items():
+                endpoints.setdefault(endpoint, {'hits': 0, 'misses': 0, 'entries': count})
+        return {
+            "path": self.path,
+            "loaded": snapshot is not None,
+            "entries": snapshot.num_entries if snapshot is not None else 0,
+            "built_at": snapshot.built_at if snapshot is not None else None,
+            "reloads": self.reloads,
+            "endpoints": endpoints,
+        }
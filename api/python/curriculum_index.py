@@ -0,0 +1,295 @@
+"""BM25 retrieval over the national curriculum for prompt grounding.
+
+``public/curriculum/curriculum-data.json`` (maintained by the Next.js side)
+is flattened into one document per competency standard and compiled into a
+compact binary inverted index on disk. The index is memory-mapped, so
+workers share its pages instead of each holding a parsed copy, and it is
+rebuilt when the source file changes: documents whose content hash is
+unchanged keep their term statistics from the previous index and only new
+or edited documents are re-tokenized.
+
+Queries use the same Spanish normalization as the similarity index.
+"""
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from similarity_index import normalize_grade, normalize_words
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b'PCIX'
+INDEX_VERSION = 1
+# magic, version, source mtime_ns, source size, docs, terms, average doc length
+_HEADER = struct.Struct('<4sIqqIIf')
+_SECTION = struct.Struct('<Q')
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_TOP_K = 3
+DEFAULT_CHECK_INTERVAL = 5.0
+# Field weights: a document's subject and competency name matter more than its criteria
+FIELD_WEIGHTS = (('subject', 3), ('level', 1), ('gradeLevel', 2), ('competency', 2),
+                 ('description', 1), ('criteria', 1))
+
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def flatten_curriculum(sections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One document per (area, competency, standard)."""
+    documents = []
+    for section in sections or []:
+        for competency in section.get('competencies') or []:
+            for standard in competency.get('standards') or [{}]:
+                documents.append({
+                    "subject": section.get('title', ''),
+                    "level": section.get('grade', ''),
+                    "competency": competency.get('name', ''),
+                    "gradeLevel": standard.get('gradeLevel', ''),
+                    "description": standard.get('description') or competency.get('description', ''),
+                    "criteria": list(standard.get('criteria') or []),
+                })
+    return documents
+
+
+def grade_terms(text: str) -> List[str]:
+    """Grade numbers as dedicated terms, so "5", "5°" and "quinto" match "5º grado"."""
+    return [f"grado{int(number)}" for number in re.findall(r'\d+', text)]
+
+
+def document_terms(document: Dict[str, Any]) -> Counter:
+    terms = Counter()
+    for name, weight in FIELD_WEIGHTS:
+        value = document.get(name)
+        text = ' '.join(value) if isinstance(value, list) else str(value or '')
+        for word in normalize_words(text):
+            terms[word] += weight
+    for term in grade_terms(document.get('gradeLevel', '')):
+        terms[term] += 1
+    return terms
+
+
+def document_hash(document: Dict[str, Any]) -> bytes:
+    return hashlib.blake2b(json.dumps(document, sort_keys=True, ensure_ascii=False).encode('utf-8'),
+                           digest_size=16).digest()
+
+
+def _write_section(out, data: bytes) -> None:
+    out.write(_SECTION.pack(len(data)))
+    out.write(data)
+
+
+def write_index(path: str, documents: List[Dict[str, Any]], term_counts: List[Counter],
+                source_mtime_ns: int, source_size: int) -> None:
+    """Write the binary index atomically (temp file + rename)."""
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    lengths = array('I')
+    for doc_id, terms in enumerate(term_counts):
+        lengths.append(sum(terms.values()))
+        for term, tf in terms.items():
+            postings.setdefault(term, []).append((doc_id, tf))
+    vocabulary = sorted(postings)
+    offsets, doc_ids, tfs = array('I', [0]), array('I'), array('H')
+    for term in vocabulary:
+        for doc_id, tf in postings[term]:
+            doc_ids.append(doc_id)
+            tfs.append(min(tf, 0xFFFF))
+        offsets.append(len(doc_ids))
+    payload_offsets, payload = array('I', [0]), bytearray()
+    for document in documents:
+        payload += json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        payload_offsets.append(len(payload))
+    hashes = b''.join(document_hash(document) for document in documents)
+    average = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, source_mtime_ns, source_size,
+                               len(documents), len(vocabulary), average))
+        for section in ('\n'.join(vocabulary).encode('utf-8'), offsets.tobytes(), doc_ids.tobytes(),
+                        tfs.tobytes(), lengths.tobytes(), payload_offsets.tobytes(), bytes(payload), hashes):
+            _write_section(out, section)
+    os.replace(tmp_path, path)
+
+
+class IndexSnapshot:
+    """Read-only view of one memory-mapped index file."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, version, self.source_mtime_ns, self.source_size, self.num_docs, num_terms, self.average_length = \
+            _HEADER.unpack_from(view, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("Unsupported curriculum index format")
+        sections = []
+        position = _HEADER.size
+        for _ in range(8):
+            (length,) = _SECTION.unpack_from(view, position)
+            position += _SECTION.size
+            sections.append(view[position:position + length])
+            position += length
+        vocabulary, offsets, doc_ids, tfs, lengths, payload_offsets, self._payload, hashes = sections
+        terms = bytes(vocabulary).decode('utf-8').split('\n') if num_terms else []
+        self._terms = {term: i for i, term in enumerate(terms)}
+        self._offsets = offsets.cast('I')
+        self._doc_ids = doc_ids.cast('I')
+        self._tfs = tfs.cast('H')
+        self._lengths = lengths.cast('I')
+        self._payload_offsets = payload_offsets.cast('I')
+        self._hashes = hashes
+
+    def document(self, doc_id: int) -> Dict[str, Any]:
+        start, end = self._payload_offsets[doc_id], self._payload_offsets[doc_id + 1]
+        return json.loads(bytes(self._payload[start:end]))
+
+    def terms_by_hash(self) -> Dict[bytes, Counter]:
+        """Rebuild the forward index (content hash -> term counts) from the postings."""
+        forward = [Counter() for _ in range(self.num_docs)]
+        for term, index in self._terms.items():
+            for position in range(self._offsets[index], self._offsets[index + 1]):
+                forward[self._doc_ids[position]][term] = self._tfs[position]
+        return {bytes(self._hashes[i * 16:(i + 1) * 16]): forward[i] for i in range(self.num_docs)}
+
+    def search(self, words: List[str], top_k: int, boost: List[str] = ()) -> List[Tuple[int, float]]:
+        """BM25 over ``words``; ``boost`` terms only add to documents that already matched."""
+        scores: Dict[int, float] = {}
+        for word, query_weight in list(Counter(words).items()) + [(term, 1) for term in boost]:
+            index = self._terms.get(word)
+            if index is None:
+                continue
+            start, end = self._offsets[index], self._offsets[index + 1]
+            idf = math.log(1 + (self.num_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            for position in range(start, end):
+                doc_id, tf = self._doc_ids[position], self._tfs[position]
+                if word in boost and doc_id not in scores:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / (self.average_length or 1))
+                scores[doc_id] = scores.get(doc_id, 0.0) + query_weight * idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+
+
+class CurriculumIndex:
+    """Memory-mapped BM25 index over the curriculum file, rebuilt when the file changes."""
+
+    def __init__(self, source_path: str, index_path: str, top_k: int = DEFAULT_TOP_K,
+                 check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.source_path = source_path
+        self.index_path = index_path
+        self.top_k = top_k
+        self.check_interval = check_interval
+        self._snapshot: Optional[IndexSnapshot] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+        self.reused_documents = 0
+        self.searches = 0
+
+    @classmethod
+    def from_env(cls) -> 'CurriculumIndex':
+        default_source = os.path.join(_REPO_ROOT, 'public', 'curriculum', 'curriculum-data.json')
+        default_index = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curriculum_index.idx')
+        return cls(
+            source_path=os.getenv('CURRICULUM_DATA_PATH', default_source),
+            index_path=os.getenv('CURRICULUM_INDEX_PATH', default_index),
+            top_k=int(os.getenv('CURRICULUM_TOP_K', DEFAULT_TOP_K)),
+            check_interval=float(os.getenv('CURRICULUM_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)),
+        )
+
+    def _current(self) -> Optional[IndexSnapshot]:
+        """Return the live snapshot, re-checking the source file at most every ``check_interval``."""
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            if self._snapshot is not None and now - self._checked_at < self.check_interval:
+                return self._snapshot
+            self._checked_at = now
+            try:
+                self._refresh()
+            except (OSError, ValueError) as e:
+                logger.error(f"Curriculum index unavailable: {str(e)}")
+        return self._snapshot
+
+    def _refresh(self) -> None:
+        stat = os.stat(self.source_path)
+        snapshot = self._snapshot
+        if snapshot is None and os.path.exists(self.index_path):
+            try:
+                snapshot = IndexSnapshot(self.index_path)
+            except ValueError:
+                snapshot = None
+        if snapshot is not None and (snapshot.source_mtime_ns, snapshot.source_size) == (stat.st_mtime_ns, stat.st_size):
+            self._snapshot = snapshot
+            return
+        self._rebuild(snapshot, stat)
+        self._snapshot = IndexSnapshot(self.index_path)
+
+    def _rebuild(self, previous: Optional[IndexSnapshot], stat: os.stat_result) -> None:
+        started = time.time()
+        with open(self.source_path, encoding='utf-8') as f:
+            documents = flatten_curriculum(json.load(f))
+        known = previous.terms_by_hash() if previous is not None else {}
+        term_counts, reused = [], 0
+        for document in documents:
+            terms = known.get(document_hash(document))
+            if terms is None:
+                terms = document_terms(document)
+            else:
+                reused += 1
+            term_counts.append(terms)
+        write_index(self.index_path, documents, term_counts, stat.st_mtime_ns, stat.st_size)
+        self.rebuilds += 1
+        self.reused_documents += reused
+        logger.info(f"Built curriculum index: {len(documents)} documents ({reused} unchanged) "
+                    f"in {time.time() - started:.3f}s")
+
+    def search(self, subject: str = '', grade: str = '', topic: str = '',
+               top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Return the top-k competency standards for a subject, grade and topic."""
+        snapshot = self._current()
+        if snapshot is None:
+            return []
+        self.searches += 1
+        # The subject is repeated so it dominates over incidental topic words; the grade only
+        # reorders standards that matched the subject or topic
+        words = normalize_words(subject) * 2 + normalize_words(topic)
+        grade_text = str(grade or '')
+        boost = normalize_words(grade_text) + [f"grado{normalize_grade(grade_text)}"]
+        results = []
+        for doc_id, score in snapshot.search(words, self.top_k if top_k is None else top_k, boost):
+            results.append(dict(snapshot.document(doc_id), score=round(score, 3)))
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "source": self.source_path,
+            "documents": snapshot.num_docs if snapshot is not None else 0,
+            "terms": len(snapshot._terms) if snapshot is not None else 0,
+            "rebuilds": self.rebuilds,
+            "reused_documents": self.reused_documents,
+            "searches": self.searches,
+            "top_k": self.top_k,
+        }
+
+
+def format_competencies(results: List[Dict[str, Any]], max_criteria: int = 3) -> str:
+    """Render matched standards as compact prompt lines."""
+    lines = []
+    for result in results:
+        criteria = '; '.join(result.get('criteria', [])[:max_criteria])
+        line = f"- {result['competency']} ({result['subject']}, {result['gradeLevel']}): {result['description']}"
+        lines.append(f"{line} Criterios: {criteria}" if criteria else line)
+    return '\n'.join(lines)
@@ -0,0 +1,395 @@
+"""Local stand-in for the OpenAI chat-completions API, for benchmarks.
+
+Serves ``POST /v1/chat/completions`` (plain and streamed) and
+``GET /v1/models`` with realistic timing instead of real generations:
+
+* time to first token is drawn from a latency distribution
+  (``fixed:0.5``, ``uniform:0.2:1.5``, ``lognormal:0.8:0.5`` as median and
+  sigma, or ``exponential:0.8`` as mean);
+* streamed content arrives in chunks of ``--chunk-tokens`` tokens every
+  ``--chunk-interval`` seconds, and plain responses take as long as the
+  stream would have;
+* ``--error-rate`` and ``--rate-limit-rate`` inject 500s and 429s, and
+  ``--rpm``/``--tpm`` enforce real request/token budgets with the
+  ``x-ratelimit-*`` and ``retry-after`` headers the admission scheduler reads;
+* usage reports a prompt token estimate and the generated completion tokens;
+* a ``json_schema`` response format is answered with a document of that
+  shape (three items per array, a few words per string), streamed in
+  four-character tokens;
+* provider prompt caching is simulated: a prompt whose leading
+  ``--prompt-cache-min`` tokens or more were seen recently reports them, in
+  128-token blocks, as ``prompt_tokens_details.cached_tokens``.
+
+Point the API at it with ``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+``GET /stats`` returns request counters.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+WORDS = ('la', 'clase', 'estudiantes', 'actividad', 'docente', 'aprendizaje', 'evaluación', 'grupo',
+         'observan', 'describen', 'comparan', 'materiales', 'tiempo', 'inicio', 'desarrollo', 'cierre',
+         'competencia', 'criterio', 'reflexionan', 'problema', 'ejemplo', 'explican', 'trabajo', 'equipo')
+
+
+class LatencyDistribution:
+    """Samples seconds from a ``kind:param[:param]`` spec."""
+
+    def __init__(self, spec: str):
+        kind, _, params = spec.partition(':')
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(p) for p in params.split(':') if p]
+        expected = {'fixed': 1, 'uniform': 2, 'lognormal': 2, 'exponential': 1}
+        if expected.get(kind) != len(self.params):
+            raise ValueError(f"Invalid latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return random.uniform(*self.params)
+        if self.kind == 'lognormal':
+            median, sigma = self.params
+            return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return random.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+
+
+class RateBudget:
+    """Per-minute budget that refills continuously, like the upstream's limits."""
+
+    def __init__(self, per_minute: int):
+        self.limit = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def take(self, amount: float) -> Tuple[bool, float]:
+        """Consume ``amount`` if available; return ``(ok, seconds_until_available)``."""
+        now = time.monotonic()
+        self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+        if amount <= self.available:
+            self.available -= amount
+            return True, 0.0
+        return False, (amount - self.available) * 60 / self.limit
+
+    def reset_seconds(self) -> float:
+        return (self.limit - self.available) * 60 / self.limit
+
+
+class FakeUpstream:
+    """Response generator and counters shared by the request handler threads."""
+
+    def __init__(self, latency: LatencyDistribution, chunk_interval: float = 0.02, chunk_tokens: int = 4,
+                 completion_tokens: int = 400, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 rpm: int = 0, tpm: int = 0, prompt_cache: Optional['PromptPrefixCache'] = None):
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        self.chunk_tokens = chunk_tokens
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests = RateBudget(rpm) if rpm else None
+        self.tokens = RateBudget(tpm) if tpm else None
+        self.prompt_cache = prompt_cache
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'streamed': 0, 'errors_injected': 0, 'rate_limited': 0,
+                      'completion_tokens': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'in_flight': 0}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += amount
+
+    def admit(self, tokens: int) -> Tuple[Optional[int], Dict[str, str]]:
+        """Return ``(error_status, headers)``; the status is None when the call may proceed."""
+        headers = {}
+        with self._lock:
+            retry_after = 0.0
+            limited = False
+            if self.requests is not None:
+                ok, wait = self.requests.take(1)
+                limited, retry_after = not ok, wait
+            if self.tokens is not None and not limited:
+                ok, wait = self.tokens.take(tokens)
+                if not ok:
+                    limited, retry_after = True, wait
+                    if self.requests is not None:
+                        self.requests.available += 1
+            for name, budget in (('requests', self.requests), ('tokens', self.tokens)):
+                if budget is not None:
+                    headers[f'x-ratelimit-limit-{name}'] = str(budget.limit)
+                    headers[f'x-ratelimit-remaining-{name}'] = str(int(budget.available))
+                    headers[f'x-ratelimit-reset-{name}'] = f"{budget.reset_seconds():.3f}s"
+        if not limited and random.random() < self.rate_limit_rate:
+            limited, retry_after = True, 1.0
+        if limited:
+            self.count('rate_limited')
+            headers['retry-after-ms'] = str(max(1, int(retry_after * 1000)))
+            return 429, headers
+        if random.random() < self.error_rate:
+            self.count('errors_injected')
+            return 500, headers
+        return None, headers
+
+    def completion_words(self, max_tokens: Optional[int]) -> List[str]:
+        count = min(self.completion_tokens, max_tokens or self.completion_tokens)
+        return [random.choice(WORDS) for _ in range(max(1, count))]
+
+    def completion_tokens_for(self, request: Dict[str, Any]) -> List[str]:
+        """The completion as token-sized pieces that concatenate to its text."""
+        schema = ((request.get('response_format') or {}).get('json_schema') or {}).get('schema')
+        if schema:
+            text = json.dumps(sample_document(schema, max(2, self.completion_tokens // 12)), ensure_ascii=False)
+            return [text[i:i + 4] for i in range(0, len(text), 4)]
+        words = self.completion_words(request.get('max_tokens'))
+        return [word + ' ' for word in words[:-1]] + words[-1:]
+
+    def usage(self, request: Dict[str, Any], completion_tokens: int) -> Dict[str, Any]:
+        prompt_tokens = estimate_prompt_tokens(request.get('messages'))
+        cached = self.prompt_cache.lookup(prompt_text(request.get('messages'))) if self.prompt_cache else 0
+        self.count('prompt_tokens', prompt_tokens)
+        self.count('cached_tokens', cached)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def completion(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        words = self.completion_tokens_for(request)
+        usage = self.usage(request, len(words))
+        time.sleep(self.latency.sample() + self.chunk_interval * len(words) / self.chunk_tokens)
+        self.count('completion_tokens', len(words))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get('model', 'gpt-4o'),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": ''.join(words)}}],
+            "usage": usage,
+        }
+
+    def stream(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        words = self.completion_tokens_for(request)
+        usage = self.usage(request, len(words))
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": request.get('model', 'gpt-4o')}
+        time.sleep(self.latency.sample())
+        for start in range(0, len(words), self.chunk_tokens):
+            if start:
+                time.sleep(self.chunk_interval)
+            text = ''.join(words[start:start + self.chunk_tokens])
+            yield dict(base, choices=[{"index": 0, "delta": {"content": text}, "finish_reason": None}])
+        yield dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self.count('completion_tokens', len(words))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            yield dict(base, choices=[], usage=usage)
+
+
+def sample_document(schema: Dict[str, Any], words_per_text: int) -> Any:
+    """A random value matching a (strict, structured-output) JSON schema."""
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: sample_document(prop, words_per_text) for name, prop in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [sample_document(schema.get('items', {}), words_per_text) for _ in range(3)]
+    if kind in ('integer', 'number'):
+        return random.randint(1, 4)
+    if kind == 'boolean':
+        return random.random() < 0.5
+    if 'enum' in schema:
+        return random.choice(schema['enum'])
+    return ' '.join(random.choice(WORDS) for _ in range(words_per_text))
+
+
+def prompt_text(messages: Any) -> str:
+    return ' '.join(str(m.get('content') or '') for m in messages or [] if isinstance(m, dict))
+
+
+def estimate_prompt_tokens(messages: Any) -> int:
+    return max(1, len(prompt_text(messages).encode('utf-8')) // 4)
+
+
+class PromptPrefixCache:
+    """Simulated provider prompt cache keyed on prompt prefixes.
+
+    Like OpenAI's, only prompts of at least ``min_tokens`` are cached, hits
+    cover the longest recently seen prefix in ``block_tokens`` steps, and
+    entries expire after ``ttl`` seconds. Tokens are approximated as 4 bytes.
+    """
+
+    def __init__(self, min_tokens: int = 1024, block_tokens: int = 128, ttl: float = 300.0,
+                 max_entries: int = 100000):
+        self.min_tokens = min_tokens
+        self.block_tokens = block_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[bytes, float]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, text: str) -> int:
+        """Return the cached prefix length in tokens, then remember this prompt's prefixes."""
+        data = text.encode('utf-8')
+        total = len(data) // 4
+        if total < self.min_tokens:
+            return 0
+        digest = hashlib.blake2b(digest_size=16)
+        keys, offset = [], 0
+        for boundary in range(self.min_tokens, total + 1, self.block_tokens):
+            digest.update(data[offset:boundary * 4])
+            offset = boundary * 4
+            keys.append((boundary, digest.copy().digest()))
+        now = time.monotonic()
+        cached = 0
+        with self._lock:
+            for boundary, key in keys:
+                seen = self._entries.get(key)
+                if seen is None or now - seen > self.ttl:
+                    break
+                cached = boundary
+            for _, key in keys:
+                self._entries[key] = now
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return cached
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstream: FakeUpstream = None
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format % args)
+
+    def send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {"object": "list", "data": [{"id": "gpt-4o", "object": "model"},
+                                                            {"id": "gpt-4o-mini", "object": "model"}]})
+        elif self.path == '/stats':
+            with self.upstream._lock:
+                self.send_json(200, dict(self.upstream.stats))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        upstream = self.upstream
+        upstream.count('requests')
+        status, headers = upstream.admit(estimate_prompt_tokens(request.get('messages'))
+                                         + (request.get('max_tokens') or upstream.completion_tokens))
+        if status is not None:
+            message = "Rate limit reached" if status == 429 else "Injected upstream error"
+            self.send_json(status, {"error": {"message": message, "type": "fake_upstream"}}, headers)
+            return
+
+        upstream.count('in_flight')
+        try:
+            if not request.get('stream'):
+                self.send_json(200, upstream.completion(request), headers)
+                return
+            upstream.count('streamed')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            for chunk in upstream.stream(request):
+                self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            upstream.count('in_flight', -1)
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+def make_server(upstream: FakeUpstream, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    handler = type('Handler', (FakeUpstreamHandler,), {'upstream': upstream})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Register the fake upstream's behaviour flags (shared with the benchmark CLI)."""
+    parser.add_argument('--latency', default='lognormal:0.8:0.4',
+                        help="time to first token: fixed:S, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA or exponential:MEAN")
+    parser.add_argument('--chunk-interval', type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument('--chunk-tokens', type=int, default=4, help="tokens per streamed chunk")
+    parser.add_argument('--completion-tokens', type=int, default=400,
+                        help="tokens generated per completion (capped by the request's max_tokens)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument('--rpm', type=int, default=0, help="enforced requests per minute (0 = unlimited)")
+    parser.add_argument('--tpm', type=int, default=0, help="enforced tokens per minute (0 = unlimited)")
+    parser.add_argument('--prompt-cache-min', type=int, default=1024,
+                        help="shortest prompt, in tokens, the simulated prompt cache applies to (0 = disabled)")
+
+
+def upstream_from_args(args: argparse.Namespace) -> FakeUpstream:
+    prompt_cache = PromptPrefixCache(args.prompt_cache_min) if args.prompt_cache_min > 0 else None
+    return FakeUpstream(LatencyDistribution(args.latency), args.chunk_interval, args.chunk_tokens,
+                        args.completion_tokens, args.error_rate, args.rate_limit_rate, args.rpm, args.tpm,
+                        prompt_cache)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI chat-completions server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help="0 picks a free port")
+    add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    server = make_server(upstream_from_args(args), args.host, args.port)
+    # The benchmark harness reads the port from this line
+    print(f"FAKE_UPSTREAM_PORT={server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""Idempotency-Key support for the mutating and generation routes.
+
+A client or the Next.js proxy that retries a POST after a timeout or a
+dropped connection would otherwise run it again: another full upstream
+completion, another stored plan. When a request carries an
+``Idempotency-Key`` header, the first request with that key runs and its
+response is stored. A retry with the same key and body
+
+* that arrives while the original is still running waits for it (up to
+  ``IDEMPOTENCY_WAIT_SECONDS``, then 409 with ``Retry-After``);
+* that arrives afterwards gets the stored status, headers and body byte for
+  byte, marked ``Idempotent-Replayed: true``.
+
+Keys are scoped to the method, path and ``X-Tenant-Id`` and bound to a hash
+of the query string and request body; reusing a key with a different body or
+query (``?format=``, ``?async=1``) is answered with 422. Only final outcomes
+are stored: server errors, rate limiting, streams that ended without their
+``done`` frame and content-encoded bodies (which depend on the request's
+``Accept-Encoding``) release the key, so the next retry runs again.
+
+Entries live in a SQLite table shared by all worker processes
+(``IDEMPOTENCY_DB``; empty for a per-process in-memory table) for
+``IDEMPOTENCY_TTL_SECONDS``, capped at ``IDEMPOTENCY_MAX_ENTRIES`` by
+evicting the oldest. A key still marked in progress after
+``IDEMPOTENCY_LEASE_SECONDS`` (its worker died) is taken over by the next
+request. Waiters in the same process are woken as soon as the original
+finishes; other processes poll.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+MAX_KEY_LENGTH = 255
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_WAIT_SECONDS = 120.0
+DEFAULT_LEASE_SECONDS = 600.0
+POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 0.5
+
+PENDING = 'pending'
+DONE = 'done'
+
+# Outcomes a retry should run again rather than replay
+RETRYABLE_STATUSES = (408, 425, 429)
+# Headers that belong to one delivery of a response, not to the stored response
+UNSTORED_HEADERS = ('content-length', 'date', 'server', 'connection', 'keep-alive', 'transfer-encoding',
+                    'x-request-id', 'vary', REPLAYED_HEADER.lower())
+
+
+class IdempotencyError(Exception):
+    """Raised when a request's Idempotency-Key cannot be used."""
+
+    status_code = 400
+
+
+class IdempotencyKeyReused(IdempotencyError):
+    """Raised when a key is sent again with a different request body."""
+
+    status_code = 422
+
+
+class IdempotencyInProgress(IdempotencyError):
+    """Raised when the original request is still running after the wait."""
+
+    status_code = 409
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class StoredResponse:
+    """A completed response, replayed to retries."""
+    status: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+
+
+@dataclass
+class Claim:
+    """The right to run a request and store its response under ``key``."""
+    key: str
+    token: str
+
+
+def scoped_key(key: str, method: str, path: str, tenant: str = '') -> str:
+    """Scope a client's key to the route and tenant; raise IdempotencyError if the key is unusable."""
+    if not key.strip() or len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+    return hashlib.sha256(f"{tenant}\n{method} {path}\n{key}".encode('utf-8')).hexdigest()
+
+
+def body_fingerprint(body: bytes, query: bytes = b'') -> str:
+    """Hash what a retry must repeat exactly: the query string and the body."""
+    return hashlib.sha256((query or b'') + b'\n' + (body or b'')).hexdigest()
+
+
+def stored_headers(headers: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """The headers worth replaying: not per-delivery ones, and not CORS, which depends on the retry's origin."""
+    return [(name, value) for name, value in headers
+            if name.lower() not in UNSTORED_HEADERS and not name.lower().startswith('access-control-')]
+
+
+def storable(status: int, headers: Iterable[Tuple[str, str]], body: bytes) -> bool:
+    """Return True if a response is a final outcome a retry should get instead of running again."""
+    headers = list(headers)
+    if status >= 500 or status in RETRYABLE_STATUSES:
+        return False
+    if any(name.lower() == 'content-encoding' for name, _ in headers):
+        # Encoded for this request's Accept-Encoding, which a retry need not share
+        return False
+    content_type = next((value for name, value in headers if name.lower() == 'content-type'), '')
+    if content_type.startswith('text/event-stream'):
+        # A stream is final only if it got to its done frame
+        frames = body.strip().split(b'\n\n')
+        return frames[-1].startswith(b'event: done')
+    return True
+
+
+class IdempotencyStore:
+    """Bounded, TTL'd table of in-progress and completed requests by scoped Idempotency-Key."""
+
+    def __init__(self, db_path: Optional[str] = None, ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, wait_seconds: float = DEFAULT_WAIT_SECONDS,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        self.lease_seconds = lease_seconds
+        self._db_path = db_path
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._stats = {'claimed': 0, 'replayed': 0, 'waited': 0, 'reused_keys': 0, 'timed_out': 0,
+                       'stored': 0, 'released': 0}
+        self._open_db()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_env(cls) -> 'IdempotencyStore':
+        default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'idempotency.sqlite3')
+        return cls(
+            db_path=os.getenv('IDEMPOTENCY_DB', default_db) or None,
+            ttl_seconds=int(os.getenv('IDEMPOTENCY_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+            wait_seconds=float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', DEFAULT_WAIT_SECONDS)),
+            lease_seconds=float(os.getenv('IDEMPOTENCY_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)),
+        )
+
+    def _open_db(self) -> None:
+        try:
+            self._db = self._connect(self._db_path or ':memory:')
+        except sqlite3.Error as e:
+            logger.error(f"Idempotency database unavailable, using a per-process table: {str(e)}")
+            self._db = self._connect(':memory:')
+
+    @staticmethod
+    def _connect(db_path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(db_path, timeout=10.0, check_same_thread=False, isolation_level=None)
+        if db_path != ':memory:':
+            db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                state TEXT NOT NULL,
+                token TEXT,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        db.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency (state, created_at)')
+        return db
+
+    def _after_fork(self) -> None:
+        """Give a forked worker its own connection; the parent's must not be used or closed there."""
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._inherited_db = self._db
+        self._open_db()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def try_claim(self, key: str, fingerprint: str) -> Optional[Union[Claim, StoredResponse]]:
+        """Claim ``key``, or return its stored response; None while another request holds it.
+
+        Raises IdempotencyKeyReused if the key was used with a different body.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(
+                    'SELECT fingerprint, state, status, headers, body, expires_at FROM idempotency WHERE key = ?',
+                    (key,)
+                ).fetchone()
+                claim = None
+                # Expired: a stale response, or an in-progress request whose worker died
+                if row is None or row[5] <= now:
+                    claim = Claim(key, uuid.uuid4().hex)
+                    self._db.execute(
+                        """INSERT OR REPLACE INTO idempotency (key, fingerprint, state, token, created_at, expires_at)
+                           VALUES (?, ?, ?, ?, ?, ?)""",
+                        (key, fingerprint, PENDING, claim.token, now, now + self.lease_seconds)
+                    )
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        if claim is not None:
+            return claim
+        if row[0] != fingerprint:
+            raise IdempotencyKeyReused(f"{IDEMPOTENCY_HEADER} was already used for a different request")
+        if row[1] == DONE:
+            return StoredResponse(row[2], [tuple(header) for header in json.loads(row[3])], bytes(row[4]))
+        return None
+
+    def _resolved(self, outcome: Union[Claim, StoredResponse], waited: bool) -> Union[Claim, StoredResponse]:
+        self._count('claimed' if isinstance(outcome, Claim) else 'replayed')
+        if waited:
+            self._count('waited')
+        return outcome
+
+    def _timed_out(self) -> IdempotencyInProgress:
+        self._count('timed_out')
+        return IdempotencyInProgress(
+            f"A request with this {IDEMPOTENCY_HEADER} is still in progress", retry_after=1.0)
+
+    def claim(self, key: str, fingerprint: str) -> Union[Claim, StoredResponse]:
+        """Claim ``key`` or return its stored response, waiting while the original request runs."""
+        deadline = time.monotonic() + self.wait_seconds
+        interval = POLL_INTERVAL
+        waited = False
+        while True:
+            try:
+                outcome = self.try_claim(key, fingerprint)
+            except IdempotencyKeyReused:
+                self._count('reused_keys')
+                raise
+            if outcome is not None:
+                return self._resolved(outcome, waited)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._timed_out()
+            waited = True
+            with self._changed:
+                self._changed.wait(min(interval, remaining))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    async def claim_async(self, key: str, fingerprint: str) -> Union[Claim, StoredResponse]:
+        """``claim`` for the event loop: the database calls run on a thread, the waiting does not."""
+        deadline = time.monotonic() + self.wait_seconds
+        interval = POLL_INTERVAL
+        waited = False
+        while True:
+            try:
+                outcome = await asyncio.to_thread(self.try_claim, key, fingerprint)
+            except IdempotencyKeyReused:
+                self._count('reused_keys')
+                raise
+            if outcome is not None:
+                return self._resolved(outcome, waited)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._timed_out()
+            waited = True
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    def complete(self, claim: Claim, status: int, headers: List[Tuple[str, str]], body: bytes) -> None:
+        """Store the claimed request's response and evict expired and excess entries."""
+        now = time.time()
+        try:
+            with self._lock:
+                self._db.execute(
+                    """UPDATE idempotency SET state = ?, token = NULL, status = ?, headers = ?, body = ?,
+                                              created_at = ?, expires_at = ?
+                       WHERE key = ? AND token = ?""",
+                    (DONE, status, json.dumps(headers), sqlite3.Binary(body), now, now + self.ttl_seconds,
+                     claim.key, claim.token)
+                )
+                self._db.execute('DELETE FROM idempotency WHERE state = ? AND expires_at <= ?', (DONE, now))
+                self._db.execute(
+                    """DELETE FROM idempotency WHERE key IN (
+                           SELECT key FROM idempotency WHERE state = ? ORDER BY created_at DESC LIMIT -1 OFFSET ?)""",
+                    (DONE, self.max_entries)
+                )
+                self._stats['stored'] += 1
+        except sqlite3.Error as e:
+            logger.error(f"Storing idempotent response failed: {str(e)}")
+        self._notify()
+
+    def release(self, claim: Claim) -> None:
+        """Drop a claim without storing a response, so the next retry runs the request again."""
+        try:
+            with self._lock:
+                self._db.execute('DELETE FROM idempotency WHERE key = ? AND token = ?', (claim.key, claim.token))
+                self._stats['released'] += 1
+        except sqlite3.Error as e:
+            logger.error(f"Releasing idempotency key failed: {str(e)}")
+        self._notify()
+
+    def _notify(self) -> None:
+        with self._changed:
+            self._changed.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            counts = dict(self._db.execute('SELECT state, COUNT(*) FROM idempotency GROUP BY state').fetchall())
+        return dict(
+            stats,
+            entries=counts.get(DONE, 0),
+            in_progress=counts.get(PENDING, 0),
+            max_entries=self.max_entries,
+            ttl_seconds=self.ttl_seconds,
+            persistent=bool(self._db_path),
+        )
@@ -0,0 +1,552 @@
+"""Background jobs for long-running generations.
+
+A generation submitted as a job returns its id at once; clients poll
+``GET /api/jobs/<id>`` for the status, the partial output streamed so far and
+the final result. Jobs live in a SQLite table (WAL mode), which is both the
+queue and the result store, so queued work survives restarts and every
+process sharing the database can run it:
+
+* thread workers run inside the API process and are woken on submit;
+* process workers (``python jobs.py --workers N``) poll the same database,
+  which lets a serverless or prefork API only enqueue. Worker processes the
+  pool spawned itself are restarted by a supervisor thread if they exit.
+
+Workers claim a job with a lease that is renewed whenever partial output is
+flushed; a job whose worker died is reclaimed once its lease lapses, up to
+``JOB_MAX_ATTEMPTS`` times. Identical requests (same content-addressed key)
+share one live or finished job, cancelling flags a running job for its worker
+to stop at the next flush, and finished jobs are purged after ``JOB_TTL_SECONDS``.
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from admission import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+LIVE_STATES = (QUEUED, RUNNING)
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_LEASE_SECONDS = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_PROGRESS_INTERVAL = 0.5
+DEFAULT_RUNNER = 'app:run_generation_job'
+PURGE_INTERVAL_SECONDS = 60.0
+SUPERVISE_INTERVAL_SECONDS = 5.0
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        endpoint TEXT NOT NULL,
+        dedup_key TEXT,
+        tenant TEXT NOT NULL,
+        spec TEXT NOT NULL,
+        options TEXT NOT NULL,
+        status TEXT NOT NULL,
+        partial TEXT NOT NULL DEFAULT '',
+        result TEXT,
+        error TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        lease_until REAL,
+        run_after REAL NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        expires_at REAL
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_queue_idx ON jobs (status, run_after, created_at)",
+    "CREATE INDEX IF NOT EXISTS jobs_dedup_idx ON jobs (dedup_key, status)",
+    "CREATE INDEX IF NOT EXISTS jobs_expires_idx ON jobs (expires_at)",
+]
+
+
+class JobCancelled(Exception):
+    """Raised inside a runner when its job was cancelled."""
+
+
+class JobNotFound(LookupError):
+    """Raised when a job id is unknown or its result has expired."""
+
+
+class JobFinished(ValueError):
+    """Raised when cancelling a job that already finished."""
+
+
+def job_requested(args, headers) -> bool:
+    """Return True if the request asked to run as a job via ``?async=1`` or ``Prefer: respond-async``."""
+    if args.get('async', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'respond-async' in headers.get('Prefer', '').lower()
+
+
+class Job:
+    """One row of the jobs table."""
+
+    def __init__(self, row: sqlite3.Row):
+        self.id = row['id']
+        self.endpoint = row['endpoint']
+        self.dedup_key = row['dedup_key']
+        self.tenant = row['tenant']
+        self.spec = json.loads(row['spec'])
+        self.options = json.loads(row['options'])
+        self.status = row['status']
+        self.partial = row['partial']
+        self.result = json.loads(row['result']) if row['result'] else None
+        self.error = row['error']
+        self.cancel_requested = bool(row['cancel_requested'])
+        self.attempts = row['attempts']
+        self.created_at = row['created_at']
+        self.updated_at = row['updated_at']
+        self.expires_at = row['expires_at']
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "type": self.endpoint,
+            "status": self.status,
+            "partial": self.partial,
+            "result": self.result,
+            "error": self.error,
+            "cancel_requested": self.cancel_requested,
+            "attempts": self.attempts,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "expires_at": self.expires_at,
+        }
+
+
+class JobStore:
+    """SQLite-backed job queue and result store, safe to share between threads and processes."""
+
+    def __init__(self, db_path: str, ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        self._last_purge = 0.0
+        db = self._connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    @classmethod
+    def from_env(cls) -> 'JobStore':
+        default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3')
+        return cls(
+            os.getenv('JOB_STORE_DB', default_db),
+            ttl_seconds=int(os.getenv('JOB_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+            max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)),
+        )
+
+    def _after_fork(self) -> None:
+        # Keep the parent's connections referenced (closing them in the child is unsafe) but unused
+        self._inherited_local = self._local
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=10.0, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a write transaction that takes the database lock up front."""
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _row(self, db: sqlite3.Connection, job_id: str) -> Optional[sqlite3.Row]:
+        return db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def submit(self, endpoint: str, spec: Dict[str, Any], tenant: str, dedup_key: Optional[str] = None,
+               options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Queue a job, or return the live or finished job for the same ``dedup_key``.
+
+        Returns ``{"job": Job, "created": bool}``.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            if dedup_key:
+                row = db.execute(
+                    """SELECT * FROM jobs WHERE dedup_key = ? AND cancel_requested = 0
+                           AND (status IN (?, ?) OR (status = ? AND expires_at > ?))
+                       ORDER BY created_at DESC LIMIT 1""",
+                    (dedup_key, QUEUED, RUNNING, SUCCEEDED, now)
+                ).fetchone()
+                if row is not None:
+                    return {"job": Job(row), "created": False}
+            job_id = f"job-{uuid.uuid4().hex}"
+            db.execute(
+                """INSERT INTO jobs (id, endpoint, dedup_key, tenant, spec, options, status,
+                                     run_after, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (job_id, endpoint, dedup_key, tenant, json.dumps(spec, ensure_ascii=False),
+                 json.dumps(options or {}), QUEUED, now, now, now)
+            )
+            return {"job": Job(self._row(db, job_id)), "created": True}
+
+    def get(self, job_id: str) -> Job:
+        row = self._row(self._connection(), job_id)
+        if row is None or (row['expires_at'] is not None and row['expires_at'] <= time.time()):
+            raise JobNotFound(f"Job not found: {job_id}")
+        return Job(row)
+
+    def claim(self, worker: str, lease_seconds: float) -> Optional[Job]:
+        """Lease the oldest runnable job (queued, or running with a lapsed lease) to ``worker``."""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                """SELECT * FROM jobs WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_until < ?)
+                   ORDER BY created_at LIMIT 1""",
+                (QUEUED, now, RUNNING, now)
+            ).fetchone()
+            if row is None:
+                return None
+            if row['cancel_requested'] or row['attempts'] >= self.max_attempts:
+                error = None if row['cancel_requested'] else f"Job abandoned after {row['attempts']} attempts"
+                self._finish(db, row['id'], CANCELLED if row['cancel_requested'] else FAILED, None, error, now)
+                return None
+            db.execute(
+                """UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1,
+                                   partial = '', updated_at = ? WHERE id = ?""",
+                (RUNNING, worker, now + lease_seconds, now, row['id'])
+            )
+            return Job(self._row(db, row['id']))
+
+    def append_partial(self, job_id: str, worker: str, text: str, lease_seconds: float) -> bool:
+        """Append streamed output and renew the lease; return whether cancellation was requested."""
+        now = time.time()
+        with self._transaction() as db:
+            updated = db.execute(
+                """UPDATE jobs SET partial = partial || ?, lease_until = ?, updated_at = ?
+                   WHERE id = ? AND worker = ? AND status = ?""",
+                (text, now + lease_seconds, now, job_id, worker, RUNNING)
+            ).rowcount
+            if not updated:
+                # The lease lapsed and another worker took the job over
+                return True
+            return bool(db.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()[0])
+
+    def _finish(self, db: sqlite3.Connection, job_id: str, status: str, result: Optional[Dict[str, Any]],
+                error: Optional[str], now: float, worker: Optional[str] = None) -> bool:
+        params = [status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                  error, now, now + self.ttl_seconds, job_id]
+        owner = ''
+        if worker is not None:
+            owner = ' AND worker = ? AND status = ?'
+            params.extend([worker, RUNNING])
+        return db.execute(
+            f"""UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated_at = ?,
+                                expires_at = ? WHERE id = ?{owner}""",
+            params
+        ).rowcount > 0
+
+    def finish(self, job_id: str, worker: str, status: str, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None) -> bool:
+        """Record a job's outcome if ``worker`` still holds its lease."""
+        with self._transaction() as db:
+            return self._finish(db, job_id, status, result, error, time.time(), worker)
+
+    def requeue(self, job_id: str, worker: str, delay: float, error: str) -> bool:
+        """Put a running job back in the queue to be retried after ``delay`` seconds."""
+        now = time.time()
+        with self._transaction() as db:
+            row = self._row(db, job_id)
+            if row is None or row['worker'] != worker or row['status'] != RUNNING:
+                return False
+            if row['attempts'] >= self.max_attempts:
+                return self._finish(db, job_id, FAILED, None, error, now, worker)
+            db.execute(
+                """UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL, run_after = ?, error = ?,
+                                   updated_at = ? WHERE id = ?""",
+                (QUEUED, now + delay, error, now, job_id)
+            )
+            return True
+
+    def cancel(self, job_id: str) -> Job:
+        """Cancel a queued job at once, or flag a running one for its worker to stop."""
+        now = time.time()
+        with self._transaction() as db:
+            row = self._row(db, job_id)
+            if row is None or (row['expires_at'] is not None and row['expires_at'] <= now):
+                raise JobNotFound(f"Job not found: {job_id}")
+            if row['status'] in FINISHED_STATES:
+                raise JobFinished(f"Job already {row['status']}")
+            if row['status'] == QUEUED:
+                self._finish(db, job_id, CANCELLED, None, None, now)
+            db.execute('UPDATE jobs SET cancel_requested = 1, updated_at = ? WHERE id = ?', (now, job_id))
+            return Job(self._row(db, job_id))
+
+    def purge_expired(self, force: bool = False) -> int:
+        """Delete finished jobs past their TTL, at most once a minute unless ``force``."""
+        now = time.time()
+        if not force and now - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return 0
+        self._last_purge = now
+        with self._transaction() as db:
+            return db.execute('DELETE FROM jobs WHERE expires_at <= ?', (now,)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        counts = {status: 0 for status in LIVE_STATES + FINISHED_STATES}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+
+class JobProgress:
+    """Buffers a runner's streamed output and flushes it to the store at a bounded rate."""
+
+    def __init__(self, store: JobStore, job: Job, worker: str, lease_seconds: float,
+                 interval: float = DEFAULT_PROGRESS_INTERVAL):
+        self.store = store
+        self.job = job
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self._buffer: List[str] = []
+        self._last_flush = time.monotonic()
+
+    def write(self, text: str) -> None:
+        """Record streamed output; raises JobCancelled once the job was cancelled."""
+        self._buffer.append(text)
+        if time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        text = ''.join(self._buffer)
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        if self.store.append_partial(self.job.id, self.worker, text, self.lease_seconds):
+            raise JobCancelled(f"Job {self.job.id} was cancelled")
+
+
+class JobWorkerPool:
+    """Runs queued jobs on local threads or on supervised worker processes.
+
+    ``runner(job, progress)`` builds and runs the generation, reporting
+    streamed text through ``progress.write`` and returning the result dict.
+    Process workers import the runner from ``runner_path`` (``module:function``).
+    """
+
+    def __init__(self, store: JobStore, runner: Optional[Callable[[Job, JobProgress], Dict[str, Any]]] = None,
+                 workers: int = 2, mode: str = 'thread', runner_path: str = DEFAULT_RUNNER,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 progress_interval: float = DEFAULT_PROGRESS_INTERVAL):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"Unknown job worker mode: {mode}")
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.mode = mode
+        self.runner_path = runner_path
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._processes: List[subprocess.Popen] = []
+        self._started = False
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'deduplicated': 0, 'succeeded': 0, 'failed': 0,
+                       'cancelled': 0, 'requeued': 0, 'process_restarts': 0}
+
+    @classmethod
+    def from_env(cls, store: JobStore, runner=None) -> 'JobWorkerPool':
+        return cls(
+            store, runner,
+            workers=int(os.getenv('JOB_WORKERS', 2)),
+            mode=os.getenv('JOB_WORKER_MODE', 'thread'),
+            runner_path=os.getenv('JOB_RUNNER', DEFAULT_RUNNER),
+            lease_seconds=float(os.getenv('JOB_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)),
+            poll_interval=float(os.getenv('JOB_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)),
+            progress_interval=float(os.getenv('JOB_PROGRESS_INTERVAL', DEFAULT_PROGRESS_INTERVAL)),
+        )
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def start(self) -> None:
+        """Start the workers once; later calls do nothing."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self.mode == 'thread':
+            for index in range(self.workers):
+                thread = threading.Thread(target=self.work, args=(f"{os.getpid()}-{index}",),
+                                          name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        else:
+            with self._lock:
+                self._processes = [self._spawn() for _ in range(self.workers)]
+            threading.Thread(target=self._supervise_loop, name='job-supervisor', daemon=True).start()
+        logger.info(f"Started {self.workers} {self.mode} job workers")
+
+    def _spawn(self) -> subprocess.Popen:
+        command = [sys.executable, os.path.abspath(__file__), '--workers', '1', '--db', self.store.db_path,
+                   '--runner', self.runner_path]
+        return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def _supervise_loop(self) -> None:
+        while not self._stop.wait(SUPERVISE_INTERVAL_SECONDS):
+            self._supervise()
+
+    def _supervise(self) -> None:
+        """Replace worker processes that exited."""
+        with self._lock:
+            if self._stop.is_set():
+                return
+            for index, process in enumerate(self._processes):
+                if process.poll() is not None:
+                    logger.warning(f"Job worker process {process.pid} exited with {process.returncode}, restarting")
+                    self._processes[index] = self._spawn()
+                    self._stats['process_restarts'] += 1
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def submit(self, endpoint: str, spec: Dict[str, Any], tenant: str, dedup_key: Optional[str] = None,
+               options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Queue a job (or join its duplicate) and wake a worker."""
+        self.start()
+        submitted = self.store.submit(endpoint, spec, tenant, dedup_key, options)
+        self._count('submitted' if submitted["created"] else 'deduplicated')
+        if submitted["created"]:
+            with self._wakeup:
+                self._wakeup.notify()
+        return submitted
+
+    def work(self, worker: str) -> None:
+        """Claim and run jobs until the pool is stopped."""
+        while not self._stop.is_set():
+            try:
+                job = self.store.claim(worker, self.lease_seconds)
+                if job is None:
+                    self.store.purge_expired()
+            except sqlite3.Error as e:
+                logger.error(f"Job store unavailable: {str(e)}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+            self.execute(job, worker)
+
+    def execute(self, job: Job, worker: str) -> None:
+        """Run one claimed job and record its outcome."""
+        runner = self.runner or self._import_runner()
+        progress = JobProgress(self.store, job, worker, self.lease_seconds, self.progress_interval)
+        logger.info(f"Running job {job.id} ({job.endpoint}, attempt {job.attempts})")
+        try:
+            result = runner(job, progress)
+            progress.flush()
+        except JobCancelled:
+            self.store.finish(job.id, worker, CANCELLED)
+            self._count('cancelled')
+            logger.info(f"Job {job.id} cancelled")
+        except AdmissionRejected as e:
+            # Rate limits, open circuits and deadlines are retried after the hinted delay
+            if self.store.requeue(job.id, worker, e.retry_after, str(e)):
+                self._count('requeued')
+                logger.warning(f"Job {job.id} requeued for {e.retry_after:.1f}s: {str(e)}")
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            self.store.finish(job.id, worker, FAILED, error=str(e))
+            self._count('failed')
+        else:
+            if self.store.finish(job.id, worker, SUCCEEDED, result):
+                self._count('succeeded')
+
+    def _import_runner(self) -> Callable[[Job, JobProgress], Dict[str, Any]]:
+        module_name, _, function = self.runner_path.partition(':')
+        self.runner = getattr(importlib.import_module(module_name), function)
+        return self.runner
+
+    def stats(self) -> Dict[str, Any]:
+        """Return job counters, queue depth by status and the worker configuration."""
+        with self._lock:
+            counters = dict(self._stats)
+        try:
+            counts = self.store.counts()
+        except sqlite3.Error as e:
+            logger.error(f"Job store unavailable: {str(e)}")
+            counts = {}
+        return dict(counters, mode=self.mode, workers=self.workers, started=self._started,
+                    ttl_seconds=self.store.ttl_seconds, by_status=counts)
+
+
+def main() -> None:
+    """Run process-backed job workers against a shared job store."""
+    parser = argparse.ArgumentParser(description="Run ProfeChat background job workers")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('JOB_WORKERS', 2)))
+    parser.add_argument('--db', default=None, help="job store database (default: JOB_STORE_DB)")
+    parser.add_argument('--runner', default=os.getenv('JOB_RUNNER', DEFAULT_RUNNER))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.db:
+        os.environ['JOB_STORE_DB'] = args.db
+    # Worker processes run jobs on their own threads; the runner's module must not start another pool
+    os.environ['JOB_WORKER_MODE'] = 'thread'
+    pool = JobWorkerPool.from_env(JobStore.from_env())
+    pool.runner_path = args.runner
+    pool.workers = args.workers
+    pool._import_runner()
+    pool.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Lesson plan sections: splitting generated text and summarizing it as context.
+
+Generated lesson plans are stored as a ``content`` dict keyed by section, the
+same shape as the sample plans (``introduction``, ``main_content``,
+``activities``, ``assessment``, ``closure``) plus ``materials``. The lesson
+prompt asks for one ``## <heading>`` per section in a fixed order; the
+splitter also accepts numbered, bold or colon-terminated headings and the
+Spanish titles, since models do not always follow the format exactly.
+When the text has markdown (or else numbered) section headings only those
+count, and headings are only recognized in section order, so a bold
+"Materials:" line inside an activity does not end the plan early. Text before the first heading
+(usually a title line) is kept under ``overview``.
+"""
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from prompt_compiler import truncate_text
+
+# (key, heading used in prompts, lowercase aliases a heading may start with)
+SECTIONS: Tuple[Tuple[str, str, Tuple[str, ...]], ...] = (
+    ('introduction', 'Introduction', ('introduction', 'warm-up', 'warm up', 'introducción', 'inicio')),
+    ('main_content', 'Main Content', ('main content', 'teaching activities', 'contenido principal', 'desarrollo')),
+    ('activities', 'Practice Activities', ('practice activities', 'practice', 'actividades de práctica', 'práctica')),
+    ('assessment', 'Assessment', ('assessment', 'evaluation', 'evaluación')),
+    ('closure', 'Closure', ('closure', 'closing', 'cierre')),
+    ('materials', 'Materials', ('materials', 'materiales', 'recursos')),
+)
+SECTION_KEYS = tuple(key for key, _, _ in SECTIONS)
+SECTION_TITLES = {key: title for key, title, _ in SECTIONS}
+OVERVIEW_KEY = 'overview'
+# Share of a full lesson's completion tokens each section usually takes
+SECTION_WEIGHTS = {
+    'introduction': 0.12, 'main_content': 0.32, 'activities': 0.22,
+    'assessment': 0.14, 'closure': 0.08, 'materials': 0.12,
+}
+
+# Longest line still treated as a heading; longer lines are body text that merely starts with a title
+MAX_HEADING_LENGTH = 80
+_MARKERS = re.compile(r'^(?:#{1,6}\s*)?(?:\*\*|__)?\s*(?:\d+[.)]\s*)?(?:\*\*|__)?\s*')
+_NUMBERED = re.compile(r'^(?:\*\*|__)?\s*\d+[.)]')
+# Heading strengths: markdown "## Title", numbered "3. Title", anything else ("**Title:**", "Title")
+MARKDOWN, NUMBERED, PLAIN = 2, 1, 0
+
+
+def heading_format() -> str:
+    """The heading lines the lesson prompts ask for, one per section, in order."""
+    return '\n'.join(f"## {title}" for _, title, _ in SECTIONS)
+
+
+def _heading_level(stripped: str) -> int:
+    if stripped.startswith('#'):
+        return MARKDOWN
+    return NUMBERED if _NUMBERED.match(stripped) else PLAIN
+
+
+def _match_heading(line: str, min_level: int = PLAIN) -> Optional[Tuple[str, str]]:
+    """Return ``(section_key, trailing_text)`` if ``line`` is a section heading."""
+    stripped = line.strip()
+    if not stripped or len(stripped) > MAX_HEADING_LENGTH and ':' not in stripped[:MAX_HEADING_LENGTH]:
+        return None
+    if _heading_level(stripped) < min_level:
+        return None
+    marked = _MARKERS.match(stripped).end() > 0
+    text = stripped[_MARKERS.match(stripped).end():]
+    lowered = text.lower()
+    for key, _, aliases in SECTIONS:
+        for alias in aliases:
+            if not lowered.startswith(alias):
+                continue
+            rest = text[len(alias):]
+            # "Closure" and "Closure/wrap-up:" are headings; "Practice makes perfect" is not
+            head, colon, trailing = rest.partition(':')
+            head = head.strip(' *_#-–—/()').strip()
+            if colon or marked or not head:
+                if len(head) > 40:
+                    return None
+                return key, trailing.strip(' *_').strip()
+    return None
+
+
+def split_sections(text: str) -> Dict[str, str]:
+    """Split a generated lesson plan into its sections.
+
+    Sections the model left out are omitted; text with no recognizable
+    headings ends up in ``main_content``.
+    """
+    lines = (text or '').splitlines()
+    # Use the strongest heading style the text has at least two section headings in
+    min_level = next((level for level in (MARKDOWN, NUMBERED)
+                      if sum(_match_heading(line, level) is not None for line in lines) >= 2), PLAIN)
+    sections: Dict[str, List[str]] = {}
+    current = OVERVIEW_KEY
+    position = -1
+    for line in lines:
+        match = _match_heading(line, min_level)
+        if match is not None and SECTION_KEYS.index(match[0]) > position:
+            current, trailing = match
+            position = SECTION_KEYS.index(current)
+            sections[current] = [trailing] if trailing else []
+            continue
+        sections.setdefault(current, []).append(line)
+
+    result = {key: '\n'.join(lines).strip() for key, lines in sections.items()}
+    result = {key: value for key, value in result.items() if value}
+    if position < 0:
+        return {'main_content': result.pop(OVERVIEW_KEY)} if result else {}
+    return result
+
+
+def normalize_content(content: Any) -> Dict[str, str]:
+    """Return a stored plan's ``content`` as a section dict, splitting legacy plain-text plans."""
+    if isinstance(content, dict):
+        return {str(key): str(value) for key, value in content.items() if value}
+    if isinstance(content, str):
+        return split_sections(content)
+    return {}
+
+
+def join_sections(sections: Dict[str, str]) -> str:
+    """Render sections back into one plan text, in section order."""
+    parts = [sections[OVERVIEW_KEY]] if sections.get(OVERVIEW_KEY) else []
+    for key in SECTION_KEYS:
+        if sections.get(key):
+            parts.append(f"## {SECTION_TITLES[key]}\n{sections[key]}")
+    parts.extend(value for key, value in sections.items()
+                 if key not in SECTION_TITLES and key != OVERVIEW_KEY and value)
+    return '\n\n'.join(parts)
+
+
+def validate_section_names(names: Any) -> List[str]:
+    """Return the requested section keys in plan order, or raise ValueError."""
+    if isinstance(names, str):
+        names = [names]
+    if not isinstance(names, list) or not names:
+        raise ValueError(f"Se requiere una lista 'sections' con al menos una de: {', '.join(SECTION_KEYS)}")
+    unknown = [name for name in names if name not in SECTION_TITLES]
+    if unknown:
+        raise ValueError(f"Secciones desconocidas: {', '.join(map(str, unknown))}. "
+                         f"Válidas: {', '.join(SECTION_KEYS)}")
+    return [key for key in SECTION_KEYS if key in names]
+
+
+def summarize_sections(sections: Dict[str, str], exclude: Iterable[str], max_tokens: int) -> str:
+    """Compact context for regeneration: each kept section cut to ``max_tokens`` on one line."""
+    excluded = set(exclude)
+    lines = []
+    for key in SECTION_KEYS:
+        if key in excluded or not sections.get(key):
+            continue
+        text = ' '.join(sections[key].split())
+        lines.append(f"{SECTION_TITLES[key]}: {truncate_text(text, max_tokens)}")
+    return '\n'.join(lines)
+
+
+def regenerated_sections(text: str, targets: List[str]) -> Dict[str, str]:
+    """Pick the requested sections out of a regeneration completion.
+
+    A single requested section may come back without its heading; then the
+    whole text is that section.
+    """
+    sections = split_sections(text)
+    picked = {key: sections[key] for key in targets if sections.get(key)}
+    if not picked and len(targets) == 1 and text.strip():
+        picked[targets[0]] = text.strip()
+    return picked
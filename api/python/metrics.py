@@ -0,0 +1,546 @@
+"""In-process metrics exposed at ``/metrics`` in the Prometheus text format.
+
+Counters, gauges and histograms are keyed by label values; each labelled
+series holds plain numbers behind its own lock, so recording costs one
+dictionary lookup and a short uncontended critical section. Feature stats
+that already exist (response cache, coalescing, admission queue, similarity
+index) are read by collectors at scrape time instead of being duplicated on
+the hot path.
+
+Under the prefork server each worker has its own registry, so a scrape
+would only see whichever worker answered it. With a multiprocess directory
+(created by the launcher, or ``METRICS_MULTIPROC_DIR`` for other process
+managers) every process writes a snapshot of its samples there every
+``METRICS_SNAPSHOT_INTERVAL`` seconds and on each scrape. ``/metrics`` then
+sums counters and histograms over all of them, including workers that have
+exited, and reports gauges per live process with a ``worker`` label. The
+answering worker's samples are current; the others lag by at most one
+snapshot interval.
+"""
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from request_logging import current_timings, record_timing
+from sse import cached_tokens
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; generations take from a few hundred milliseconds to well over a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+Sample = Tuple[str, Dict[str, str], float]
+Family = Tuple[str, str, str, List[Sample]]
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_INTERVAL = 5.0
+# Summed counters and histograms of exited processes
+ARCHIVE_FILE = 'archive.json'
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if value != value:
+        return 'NaN'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + '}'
+
+
+class _Metric:
+    """A named metric family; ``labels(...)`` returns the series for one label set."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        series = self._series.get(values)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                series = self._series.get(values)
+                if series is None:
+                    series = self._series[values] = self._new_series()
+        return series
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def samples(self) -> Iterable[Sample]:
+        with self._lock:
+            items = list(self._series.items())
+        for values, series in items:
+            labels = dict(zip(self.labelnames, values))
+            yield from series.samples(self.name, labels)
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = float(value)
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Sample]:
+        yield name, labels, self.value
+
+
+class _CounterValue(_Value):
+    __slots__ = ()
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Sample]:
+        yield f"{name}_total", labels, self.value
+
+
+class Counter(_Metric):
+    """Monotonic counter; the ``_total`` suffix is added on exposition."""
+
+    kind = 'counter'
+
+    def _new_series(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_series(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: Dict[str, str]) -> Iterable[Sample]:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            yield f"{name}_bucket", dict(labels, le=format_value(bound)), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_series(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+
+class Timer:
+    """Context manager observing the elapsed wall time into a histogram series.
+
+    With a ``timing`` name the time is also added to the current request's
+    access-log timing breakdown.
+    """
+
+    __slots__ = ('series', 'timing', 'started')
+
+    def __init__(self, series, timing: Optional[str] = None):
+        self.series = series
+        self.timing = timing
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self.started
+        self.series.observe(elapsed)
+        if self.timing:
+            record_timing(self.timing, elapsed)
+
+
+class Registry:
+    """Metric families plus scrape-time collectors."""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]] = []
+        self._lock = threading.Lock()
+        # Shared by every process whose samples are aggregated; None serves this process only
+        self.multiprocess_dir: Optional[str] = os.getenv('METRICS_MULTIPROC_DIR') or None
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]) -> None:
+        """Register a callable yielding ``(name, type, help, samples)`` families at scrape time."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> List[Family]:
+        """Return this process's metric families with their current samples."""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        families = [(m.name, m.kind, m.documentation, list(m.samples())) for m in metrics]
+        for collector in collectors:
+            families.extend((name, kind, documentation, list(samples))
+                            for name, kind, documentation, samples in collector())
+        return families
+
+    def write_snapshot(self) -> None:
+        """Publish this process's samples to the multiprocess directory."""
+        if self.multiprocess_dir is None:
+            return
+        path = os.path.join(self.multiprocess_dir, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.collect(), f)
+        os.replace(tmp_path, path)
+
+    def _collect_all(self) -> List[Family]:
+        """Merge the snapshots of every process, folding exited ones into the archive."""
+        import fcntl
+
+        self.write_snapshot()
+        directory = self.multiprocess_dir
+        with open(os.path.join(directory, 'lock'), 'a') as lock:
+            # Exclusive, so a concurrent scrape never sees an exited worker both archived and not
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            live, exited = [], []
+            for name in sorted(os.listdir(directory)):
+                pid = name[:-len('.json')]
+                if not name.endswith('.json') or not pid.isdigit():
+                    continue
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if process_alive(int(pid)):
+                    live.append((pid, snapshot))
+                else:
+                    exited.append((name, snapshot))
+            archive_path = os.path.join(directory, ARCHIVE_FILE)
+            try:
+                with open(archive_path) as f:
+                    archive = json.load(f)
+            except (OSError, ValueError):
+                archive = []
+            if exited:
+                archive = merge_families([(None, archive)] + [(None, snapshot) for _, snapshot in exited])
+                with open(f"{archive_path}.tmp", 'w') as f:
+                    json.dump(archive, f)
+                os.replace(f"{archive_path}.tmp", archive_path)
+                for name, _ in exited:
+                    os.remove(os.path.join(directory, name))
+        return merge_families(live + [(None, archive)])
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        families = self._collect_all() if self.multiprocess_dir else self.collect()
+        lines = []
+        for name, kind, documentation, samples in families:
+            if kind == 'counter':
+                name = f"{name}_total"
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge_families(snapshots: Sequence[Tuple[Optional[str], List[Family]]]) -> List[Family]:
+    """Sum counter and histogram samples across ``(worker, families)`` snapshots.
+
+    Gauges are kept per worker under a ``worker`` label, and dropped for a
+    snapshot without one (an exited process).
+    """
+    merged: Dict[str, Tuple[str, str, Dict[Tuple, Sample]]] = {}
+    for worker, families in snapshots:
+        for name, kind, documentation, samples in families:
+            family = merged.setdefault(name, (kind, documentation, {}))[2]
+            for sample_name, labels, value in samples:
+                if kind == 'gauge':
+                    if worker is None:
+                        continue
+                    labels = dict(labels, worker=worker)
+                key = (sample_name, tuple(sorted(labels.items())))
+                if key in family:
+                    value += family[key][2]
+                family[key] = (sample_name, labels, value)
+    return [(name, kind, documentation, list(family.values()))
+            for name, (kind, documentation, family) in merged.items()]
+
+
+def enable_multiprocess(directory: str) -> None:
+    """Aggregate ``/metrics`` over every process sharing ``directory``.
+
+    Called by the launcher before it forks the workers; snapshots left in the
+    directory by an earlier run are removed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(directory, name))
+    REGISTRY.multiprocess_dir = directory
+
+
+def start_snapshot_writer(interval: float = float(os.getenv('METRICS_SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL))) -> None:
+    """Publish this process's samples periodically; a no-op without a multiprocess directory."""
+    if REGISTRY.multiprocess_dir is None:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                REGISTRY.write_snapshot()
+            except OSError as e:
+                logger.error(f"Could not write metrics snapshot: {str(e)}")
+
+    threading.Thread(target=run, name='metrics-snapshot', daemon=True).start()
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter(
+    'profechat_http_requests', 'HTTP requests by route, method and status.', ('route', 'method', 'status'))
+http_request_duration = REGISTRY.histogram(
+    'profechat_http_request_duration_seconds',
+    'Time to produce the response headers (or the full body for native async routes).', ('route', 'method'))
+http_in_flight = REGISTRY.gauge(
+    'profechat_http_requests_in_flight', 'HTTP requests currently being handled.', ('route',))
+
+upstream_request_duration = REGISTRY.histogram(
+    'profechat_upstream_request_duration_seconds',
+    'Chat completion call duration, from send to last byte.', ('endpoint', 'model', 'stream'))
+upstream_ttft = REGISTRY.histogram(
+    'profechat_upstream_time_to_first_token_seconds', 'Time to the first streamed content token.', ('endpoint',))
+upstream_errors = REGISTRY.counter(
+    'profechat_upstream_errors', 'Failed chat completion calls by exception type.', ('endpoint', 'error'))
+upstream_in_flight = REGISTRY.gauge(
+    'profechat_upstream_requests_in_flight', 'Chat completion calls currently open.', ('endpoint',))
+upstream_tokens = REGISTRY.counter(
+    'profechat_upstream_tokens', 'Tokens reported in the completion usage.', ('endpoint', 'kind'))
+prompt_tokens_estimated = REGISTRY.counter(
+    'profechat_prompt_tokens_estimated', 'Prompt tokens counted locally before sending.', ('endpoint',))
+prompt_truncations = REGISTRY.counter(
+    'profechat_prompt_truncations', 'Request fields truncated to fit the prompt token budget.', ('endpoint', 'field'))
+admission_wait = REGISTRY.histogram(
+    'profechat_admission_wait_seconds', 'Time spent queued in the rate-limit scheduler.', ('priority',))
+
+
+def record_usage(endpoint: str, usage: Optional[Dict[str, int]]) -> None:
+    """Count prompt, completion and prompt-cache-hit tokens from a ``usage_to_dict`` result."""
+    if not usage:
+        return
+    for kind in ('prompt', 'completion'):
+        count = usage.get(f"{kind}_tokens")
+        if count:
+            upstream_tokens.labels(endpoint, kind).inc(count)
+    cached = cached_tokens(usage)
+    if cached:
+        upstream_tokens.labels(endpoint, 'cached').inc(cached)
+
+
+class UpstreamCall:
+    """Records one chat completion call: in-flight gauge, duration, TTFT, tokens and errors."""
+
+    __slots__ = ('endpoint', 'model', 'stream', 'started', 'first_token', 'open', 'timings',
+                 'completion_tokens', 'listener')
+
+    def __init__(self, endpoint: str, model: Optional[str], stream: bool = False,
+                 listener: Optional[Callable[..., None]] = None):
+        self.endpoint = endpoint
+        self.model = model or 'unknown'
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.open = True
+        self.completion_tokens = None
+        # Called as listener(endpoint, model, seconds, completion_tokens, error) when the call ends
+        self.listener = listener
+        # Stream events may be consumed outside the request's context (a Flask streaming generator)
+        self.timings = current_timings()
+        upstream_in_flight.labels(endpoint).inc()
+
+    def event(self, kind: str, value) -> None:
+        """Observe one ``(kind, value)`` stream event."""
+        if kind == 'delta' and self.first_token is None:
+            self.first_token = time.perf_counter()
+            upstream_ttft.labels(self.endpoint).observe(self.first_token - self.started)
+            record_timing('upstream_ttft_ms', self.first_token - self.started, self.timings)
+        elif kind == 'usage':
+            self.completion_tokens = (value or {}).get('completion_tokens')
+            record_usage(self.endpoint, value)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        if not self.open:
+            return
+        self.open = False
+        upstream_in_flight.labels(self.endpoint).dec()
+        elapsed = time.perf_counter() - self.started
+        upstream_request_duration.labels(self.endpoint, self.model, 'true' if self.stream else 'false').observe(elapsed)
+        record_timing('upstream_ms', elapsed, self.timings)
+        if self.listener is not None:
+            self.listener(self.endpoint, self.model, elapsed, self.completion_tokens, error)
+
+    def fail(self, error: BaseException) -> None:
+        upstream_errors.labels(self.endpoint, type(error).__name__).inc()
+        self.finish(error)
+
+    def observe(self, events: Iterable[Tuple[str, object]]) -> Iterator[Tuple[str, object]]:
+        """Pass a synchronous event stream through, recording as it goes."""
+        try:
+            for kind, value in events:
+                self.event(kind, value)
+                yield kind, value
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self.finish()
+
+    async def observe_async(self, events: AsyncIterator[Tuple[str, object]]) -> AsyncIterator[Tuple[str, object]]:
+        """Async counterpart of ``observe``."""
+        try:
+            async for kind, value in events:
+                self.event(kind, value)
+                yield kind, value
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self.finish()
+
+
+def record_prompt(endpoint: str, estimated_tokens: int, truncated: Sequence[str] = ()) -> None:
+    """Count the local prompt estimate; compare with ``profechat_upstream_tokens_total{kind="prompt"}``."""
+    prompt_tokens_estimated.labels(endpoint).inc(estimated_tokens)
+    for field in truncated:
+        prompt_truncations.labels(endpoint, field).inc()
+
+
+def stats_collector(prefix: str, stats: Callable[[], Dict], per_endpoint: Sequence[str] = (),
+                    gauges: Sequence = (), counters: Sequence[str] = ()):
+    """Build a collector exposing numeric fields of a ``stats()`` dict.
+
+    ``per_endpoint`` names counters found under ``stats()['endpoints'][name]``;
+    ``gauges`` and ``counters`` name top-level fields. A gauge given as
+    ``(field, label)`` expands a dict-valued field into one series per key.
+    """
+    def collect():
+        snapshot = stats()
+        families = []
+        endpoints = snapshot.get('endpoints', {})
+        for field in per_endpoint:
+            samples = [(f"{prefix}_{field}_total", {"endpoint": name}, values[field])
+                       for name, values in sorted(endpoints.items())
+                       if isinstance(values.get(field), (int, float))]
+            families.append((f"{prefix}_{field}", 'counter', f"{field.replace('_', ' ')} per endpoint.", samples))
+        for spec in gauges:
+            field, label = spec if isinstance(spec, tuple) else (spec, None)
+            value = snapshot.get(field)
+            if label and isinstance(value, dict):
+                samples = [(f"{prefix}_{field}", {label: key}, v) for key, v in sorted(value.items())
+                           if isinstance(v, (int, float))]
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                samples = [(f"{prefix}_{field}", {}, value)]
+            else:
+                continue
+            families.append((f"{prefix}_{field}", 'gauge', f"{field.replace('_', ' ')}.", samples))
+        for field in counters:
+            value = snapshot.get(field)
+            if isinstance(value, (int, float)):
+                families.append((f"{prefix}_{field}", 'counter', f"{field.replace('_', ' ')}.",
+                                 [(f"{prefix}_{field}_total", {}, value)]))
+        return families
+    return collect
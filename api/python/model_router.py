@@ -0,0 +1,240 @@
+"""Per-request model routing for generation endpoints.
+
+Prompts name a default model, but a three-line activity list does not need
+the same model as a four-week unit plan. The router picks the model for each
+upstream call from:
+
+* routing rules (``MODEL_ROUTER_RULES``, inline JSON or a path to a JSON
+  file): the first rule matching the endpoint and the request's expected
+  output size gives the candidate models in order of preference, e.g.
+  ``[{"endpoint": "generate-activities", "models": ["gpt-4o-mini", "gpt-3.5-turbo"]},
+  {"endpoint": "generate-unit-plan", "min_output_tokens": 1500, "models": ["gpt-4o"]}]``;
+  ``"*"`` matches every endpoint;
+* a latency SLO per endpoint (``MODEL_ROUTER_SLOS`` such as
+  ``"generate-lesson=20"`` seconds, else ``MODEL_ROUTER_SLO_SECONDS``, or a
+  rule's ``slo_seconds``);
+* live stats per model: recent upstream failure rate and seconds per output
+  token, from which the router predicts the call's p95 latency.
+
+The first candidate that is not failing (``MODEL_ROUTER_MAX_ERROR_RATE``) and
+is predicted to meet the SLO wins; models without enough samples yet are
+assumed to meet it. When none qualifies, the healthy candidate with the
+lowest predicted latency is used. The expected output size is the request's
+``max_tokens``, which each prompt sizes to what it asks for.
+
+``MODEL_ROUTER_MODE=shadow`` keeps the prompt's model and only logs and
+counts what the router would have chosen; ``off`` disables routing. The
+circuit breaker's fallback still applies after routing. Response cache keys
+keep the prompt's model, so a cached generation is served whichever model
+produced it; the model is stored with it and reported in ``X-Model``.
+"""
+import json
+import logging
+import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from resilience import is_upstream_failure
+from response_cache import parse_endpoint_limits
+
+logger = logging.getLogger(__name__)
+
+OFF = 'off'
+SHADOW = 'shadow'
+ON = 'on'
+MODES = (OFF, SHADOW, ON)
+
+DEFAULT_SLO_SECONDS = 30.0
+DEFAULT_MAX_ERROR_RATE = 0.2
+DEFAULT_MIN_SAMPLES = 10
+DEFAULT_QUANTILE = 0.95
+STATS_WINDOW = 200
+
+
+@dataclass
+class Route:
+    """One routing decision and why it was made."""
+    model: str
+    reason: str
+    predicted_seconds: Optional[float] = None
+
+
+class ModelStats:
+    """Recent outcomes of one model's upstream calls."""
+
+    def __init__(self, size: int = STATS_WINDOW):
+        self._outcomes: Deque[bool] = deque(maxlen=size)
+        # Seconds per output token of recent successful calls
+        self._token_seconds: Deque[float] = deque(maxlen=size)
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, completion_tokens: Optional[int], failed: bool) -> None:
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self._outcomes.append(failed)
+            if not failed and completion_tokens:
+                self._token_seconds.append(seconds / completion_tokens)
+
+    def error_rate(self, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._outcomes) < min_samples:
+                return None
+            return sum(self._outcomes) / len(self._outcomes)
+
+    def predict(self, output_tokens: int, quantile: float, min_samples: int) -> Optional[float]:
+        """Predicted latency of a call producing ``output_tokens``, or None without enough samples."""
+        with self._lock:
+            if len(self._token_seconds) < min_samples:
+                return None
+            ordered = sorted(self._token_seconds)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * output_tokens
+
+    def snapshot(self, quantile: float, min_samples: int) -> Dict[str, Any]:
+        per_token = self.predict(1000, quantile, min_samples)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "recent_error_rate": self.error_rate(min_samples),
+            "seconds_per_1k_tokens": round(per_token, 3) if per_token is not None else None,
+        }
+
+
+def load_rules(spec: str) -> List[Dict[str, Any]]:
+    """Parse routing rules from inline JSON or a JSON file path; raise ValueError if malformed."""
+    if not spec.strip():
+        return []
+    if not spec.lstrip().startswith('['):
+        with open(spec, encoding='utf-8') as f:
+            spec = f.read()
+    rules = json.loads(spec)
+    if not isinstance(rules, list):
+        raise ValueError("Model routing rules must be a JSON list")
+    for rule in rules:
+        models = rule.get('models') if isinstance(rule, dict) else None
+        if not isinstance(models, list) or not models or not all(isinstance(m, str) for m in models):
+            raise ValueError(f"Model routing rule needs a non-empty 'models' list: {rule}")
+    return rules
+
+
+class ModelRouter:
+    """Chooses the model for each upstream call and keeps the per-model stats it decides from."""
+
+    def __init__(self, mode: str = ON, rules: Optional[List[Dict[str, Any]]] = None,
+                 slos: Optional[Dict[str, float]] = None, default_slo: float = DEFAULT_SLO_SECONDS,
+                 max_error_rate: float = DEFAULT_MAX_ERROR_RATE, min_samples: int = DEFAULT_MIN_SAMPLES,
+                 quantile: float = DEFAULT_QUANTILE):
+        if mode not in MODES:
+            raise ValueError(f"Unknown model router mode {mode!r}; expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.rules = rules or []
+        self.slos = slos or {}
+        self.default_slo = default_slo
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self._models: Dict[str, ModelStats] = {}
+        self._decisions: Dict[Tuple[str, str, str], int] = {}
+        self._stats = {'routed': 0, 'rerouted': 0, 'shadow_diverged': 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'ModelRouter':
+        return cls(
+            mode=os.getenv('MODEL_ROUTER_MODE', ON).lower(),
+            rules=load_rules(os.getenv('MODEL_ROUTER_RULES', '')),
+            slos=parse_endpoint_limits(os.getenv('MODEL_ROUTER_SLOS', ''), cast=float),
+            default_slo=float(os.getenv('MODEL_ROUTER_SLO_SECONDS', DEFAULT_SLO_SECONDS)),
+            max_error_rate=float(os.getenv('MODEL_ROUTER_MAX_ERROR_RATE', DEFAULT_MAX_ERROR_RATE)),
+            min_samples=int(os.getenv('MODEL_ROUTER_MIN_SAMPLES', DEFAULT_MIN_SAMPLES)),
+            quantile=float(os.getenv('MODEL_ROUTER_QUANTILE', DEFAULT_QUANTILE)),
+        )
+
+    def _model_stats(self, model: str) -> ModelStats:
+        stats = self._models.get(model)
+        if stats is None:
+            with self._lock:
+                stats = self._models.setdefault(model, ModelStats())
+        return stats
+
+    def match_rule(self, endpoint: str, output_tokens: int) -> Optional[Dict[str, Any]]:
+        for rule in self.rules:
+            if rule.get('endpoint', '*') not in ('*', endpoint):
+                continue
+            if output_tokens < rule.get('min_output_tokens', 0):
+                continue
+            if 'max_output_tokens' in rule and output_tokens > rule['max_output_tokens']:
+                continue
+            return rule
+        return None
+
+    def decide(self, endpoint: str, default_model: str, output_tokens: int) -> Route:
+        """Pick a model for a call producing about ``output_tokens``, regardless of the mode."""
+        rule = self.match_rule(endpoint, output_tokens)
+        if rule is None:
+            return Route(default_model, 'default')
+        slo = rule.get('slo_seconds', self.slos.get(endpoint, self.default_slo))
+        fastest: Optional[Route] = None
+        skipped = None
+        for model in rule['models']:
+            stats = self._model_stats(model)
+            error_rate = stats.error_rate(self.min_samples)
+            if error_rate is not None and error_rate >= self.max_error_rate:
+                skipped = skipped or 'errors'
+                continue
+            predicted = stats.predict(output_tokens, self.quantile, self.min_samples)
+            if predicted is None or predicted <= slo:
+                return Route(model, skipped or 'preferred', predicted)
+            skipped = skipped or 'slo'
+            if fastest is None or predicted < fastest.predicted_seconds:
+                fastest = Route(model, 'fastest', predicted)
+        # Nothing meets the SLO: the quickest healthy model, else the first choice
+        return fastest or Route(rule['models'][0], 'all_failing')
+
+    def route(self, endpoint: str, default_model: str, max_tokens: Optional[int]) -> str:
+        """Return the model to call; in shadow mode the decision is only logged and counted."""
+        if self.mode == OFF:
+            return default_model
+        decision = self.decide(endpoint, default_model, max_tokens or 0)
+        with self._lock:
+            self._stats['routed'] += 1
+            key = (endpoint, decision.model, decision.reason)
+            self._decisions[key] = self._decisions.get(key, 0) + 1
+            if decision.model != default_model:
+                self._stats['shadow_diverged' if self.mode == SHADOW else 'rerouted'] += 1
+        if self.mode == SHADOW:
+            if decision.model != default_model:
+                logger.info(f"Model router (shadow) would send {endpoint} to {decision.model} instead of "
+                            f"{default_model} ({decision.reason}, predicted {decision.predicted_seconds})")
+            return default_model
+        return decision.model
+
+    def record(self, endpoint: str, model: str, seconds: float, completion_tokens: Optional[int],
+               error: Optional[BaseException] = None) -> None:
+        """Feed one finished upstream call; client errors and rate limiting do not count as failures."""
+        failed = error is not None and is_upstream_failure(error)
+        if error is not None and not failed:
+            return
+        self._model_stats(model).record(seconds, completion_tokens, failed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            models = dict(self._models)
+            decisions: Dict[str, Dict[str, Dict[str, int]]] = {}
+            for (endpoint, model, reason), count in sorted(self._decisions.items()):
+                decisions.setdefault(endpoint, {}).setdefault(model, {})[reason] = count
+        return dict(
+            stats,
+            mode=self.mode,
+            rules=len(self.rules),
+            default_slo_seconds=self.default_slo,
+            slos=self.slos,
+            decisions=decisions,
+            models={model: model_stats.snapshot(self.quantile, self.min_samples)
+                    for model, model_stats in sorted(models.items())},
+        )
@@ -0,0 +1,322 @@
+"""Persistent lesson plan store backing the test lesson plan endpoints.
+
+Plans live in a SQLite database in WAL mode, in a ``LessonPlan`` table that
+mirrors the Prisma model (``content`` holds the JSON-encoded sections). Any
+extra fields a client posts are kept in an ``extra`` JSON column, along with
+the model fields the typed columns cannot hold as sent (a missing field, a
+``null`` or a non-integer ``duration``), so plans round-trip exactly what
+was posted. The full listing keeps insertion order (the sample plans, then
+posted plans); paginated listings are newest first, with keyset pagination
+on ``(createdAt, id)``. A write counter lets callers build ETags without
+running the query. Lessons stored by the generate endpoints are marked
+``source: "generated"`` and listed only on request.
+"""
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# ``source`` of plans persisted from generated lessons; every other plan is a test plan
+GENERATED_SOURCE = 'generated'
+LIST_SOURCES = ('test', GENERATED_SOURCE, 'all')
+
+# Columns of the Prisma LessonPlan model that are stored natively
+CORE_FIELDS = ('id', 'subject', 'grade', 'topic', 'duration', 'objectives', 'content', 'created_at', 'userId')
+# Keys in ``extra`` for model fields posted with values their column cannot hold, and fields not posted
+ORIGINALS_KEY = '__originals__'
+ABSENT_KEY = '__absent__'
+
+SAMPLE_PLANS = [
+    {
+        "id": "test-plan-1",
+        "subject": "English",
+        "grade": "8th Grade",
+        "topic": "Poetry Analysis",
+        "duration": 60,
+        "objectives": "Students will learn to identify literary devices in poetry and analyze their effect.",
+        "content": {
+            "introduction": "Begin with a reading of 'The Road Not Taken' by Robert Frost.",
+            "main_content": "Discuss metaphor, imagery, and symbolism in the poem.",
+            "activities": "Group work to identify literary devices in assigned poems.",
+            "assessment": "Students will write a short analysis of a poem using the techniques learned.",
+            "closure": "Class discussion on how poetry analysis skills transfer to other texts."
+        },
+        "created_at": "2023-03-30T14:30:00Z"
+    },
+    {
+        "id": "test-plan-2",
+        "subject": "Science",
+        "grade": "5th Grade",
+        "topic": "The Solar System",
+        "duration": 45,
+        "objectives": "Students will be able to identify the planets in our solar system and describe their key characteristics.",
+        "content": {
+            "introduction": "Show a video clip about space exploration.",
+            "main_content": "Present information about each planet with visual aids.",
+            "activities": "Create a scale model of the solar system in the classroom.",
+            "assessment": "Quiz on planet names, order, and key facts.",
+            "closure": "Discuss how understanding our solar system helps us understand our place in the universe."
+        },
+        "created_at": "2023-03-29T10:15:00Z"
+    },
+    {
+        "id": "test-plan-3",
+        "subject": "Mathematics",
+        "grade": "9th Grade",
+        "topic": "Algebra Basics",
+        "duration": 55,
+        "objectives": "Students will understand how to solve simple equations with one variable.",
+        "content": {
+            "introduction": "Review the concept of variables with real-world examples.",
+            "main_content": "Demonstrate solving for x in various equations.",
+            "activities": "Worksheet practice with graduated difficulty levels.",
+            "assessment": "Exit ticket with 3 equations to solve independently.",
+            "closure": "Discuss how algebraic thinking is used in daily life and various careers."
+        },
+        "created_at": "2023-03-28T09:45:00Z"
+    }
+]
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS LessonPlan (
+        id TEXT PRIMARY KEY,
+        userId TEXT NOT NULL,
+        grade TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        duration INTEGER NOT NULL,
+        objectives TEXT NOT NULL,
+        content TEXT NOT NULL,
+        createdAt TEXT NOT NULL,
+        updatedAt TEXT NOT NULL,
+        extra TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS LessonPlan_createdAt_idx ON LessonPlan (createdAt, id)",
+    "CREATE INDEX IF NOT EXISTS LessonPlan_subject_idx ON LessonPlan (subject, createdAt, id)",
+    "CREATE INDEX IF NOT EXISTS LessonPlan_grade_idx ON LessonPlan (grade, createdAt, id)",
+    "CREATE TABLE IF NOT EXISTS plan_store_meta (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO plan_store_meta (id, version) VALUES (1, 0)",
+]
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+class PlanNotFound(LookupError):
+    """Raised when no lesson plan has the requested id."""
+
+
+def encode_cursor(created_at: str, plan_id: str) -> str:
+    raw = json.dumps([created_at, plan_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, plan_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(created_at), str(plan_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid pagination cursor") from e
+
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class LessonPlanStore:
+    """SQLite-backed lesson plan store, safe to share between threads."""
+
+    def __init__(self, db_path: str, seed_samples: bool = True):
+        self.db_path = db_path
+        self._local = threading.local()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+        db = self._connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        with db:
+            for statement in SCHEMA:
+                db.execute(statement)
+            if seed_samples and db.execute('SELECT COUNT(*) FROM LessonPlan').fetchone()[0] == 0:
+                for plan in SAMPLE_PLANS:
+                    self._insert(db, plan)
+
+    @classmethod
+    def from_env(cls) -> 'LessonPlanStore':
+        default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lesson_plans.sqlite3')
+        return cls(os.getenv('PLAN_STORE_DB', default_db))
+
+    def _after_fork(self) -> None:
+        # Keep the parent's connections referenced (closing them in the child is unsafe) but unused
+        self._inherited_local = self._local
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=5.0)
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    def _insert(self, db: sqlite3.Connection, plan: Dict[str, Any]) -> Dict[str, Any]:
+        plan = dict(plan)
+        plan.setdefault('id', f"plan-{uuid.uuid4().hex}")
+        plan.setdefault('created_at', utc_now())
+        content = plan.get('content', '')
+        raw_duration = plan.get('duration')
+        duration = raw_duration if isinstance(raw_duration, int) and not isinstance(raw_duration, bool) else 0
+        extra = {k: v for k, v in plan.items() if k not in CORE_FIELDS}
+        originals = {name: plan[name] for name in ('userId', 'grade', 'subject', 'topic', 'objectives')
+                     if name in plan and not isinstance(plan[name], str)}
+        if 'duration' in plan and duration is not raw_duration:
+            originals['duration'] = raw_duration
+        absent = [name for name in ('userId', 'grade', 'subject', 'topic', 'duration', 'objectives', 'content')
+                  if name not in plan]
+        if originals:
+            extra[ORIGINALS_KEY] = originals
+        if absent:
+            extra[ABSENT_KEY] = absent
+        db.execute(
+            """INSERT INTO LessonPlan (id, userId, grade, subject, topic, duration, objectives, content,
+                                       createdAt, updatedAt, extra)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (id) DO UPDATE SET
+                   userId = excluded.userId, grade = excluded.grade, subject = excluded.subject,
+                   topic = excluded.topic, duration = excluded.duration, objectives = excluded.objectives,
+                   content = excluded.content, updatedAt = excluded.updatedAt, extra = excluded.extra""",
+            (
+                str(plan['id']), str(plan.get('userId') or 'test-user'), str(plan.get('grade') or ''),
+                str(plan.get('subject') or ''), str(plan.get('topic') or ''), duration,
+                str(plan.get('objectives') or ''), json.dumps(content, ensure_ascii=False),
+                str(plan['created_at']), utc_now(), json.dumps(extra, ensure_ascii=False) if extra else None,
+            )
+        )
+        return plan
+
+    def add(self, plan: Dict[str, Any]) -> Dict[str, Any]:
+        """Insert (or replace by id) a plan and bump the store version."""
+        if not isinstance(plan, dict):
+            raise ValueError("Lesson plan must be a JSON object")
+        db = self._connection()
+        with db:
+            stored = self._insert(db, plan)
+            db.execute('UPDATE plan_store_meta SET version = version + 1 WHERE id = 1')
+        return stored
+
+    def get(self, plan_id: str) -> Dict[str, Any]:
+        row = self._connection().execute(
+            """SELECT id, userId, subject, grade, topic, duration, objectives, content, createdAt, extra
+               FROM LessonPlan WHERE id = ?""", (plan_id,)
+        ).fetchone()
+        if row is None:
+            raise PlanNotFound(f"Lesson plan not found: {plan_id}")
+        return self._row_to_plan(row)
+
+    def update_content(self, plan_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+        """Merge ``updates`` into a plan's content sections and bump the store version.
+
+        Runs read-modify-write in one immediate transaction so concurrent
+        regenerations of different sections of the same plan both land.
+        """
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT content FROM LessonPlan WHERE id = ?', (plan_id,)).fetchone()
+            if row is None:
+                raise PlanNotFound(f"Lesson plan not found: {plan_id}")
+            content = json.loads(row['content'])
+            content = dict(content if isinstance(content, dict) else {}, **updates)
+            db.execute('UPDATE LessonPlan SET content = ?, updatedAt = ? WHERE id = ?',
+                       (json.dumps(content, ensure_ascii=False), utc_now(), plan_id))
+            db.execute('UPDATE plan_store_meta SET version = version + 1 WHERE id = 1')
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        return self.get(plan_id)
+
+    def version(self) -> int:
+        """Monotonic write counter, shared by every process using the database."""
+        return self._connection().execute('SELECT version FROM plan_store_meta WHERE id = 1').fetchone()[0]
+
+    def count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM LessonPlan').fetchone()[0]
+
+    def list(self, subject: Optional[str] = None, grade: Optional[str] = None,
+             limit: Optional[int] = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+             source: str = 'test') -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return one page of plans, newest first, and the cursor for the next page.
+
+        ``limit=None`` returns every matching plan in insertion order, as the
+        listing did before pagination. ``source`` selects test plans, generated
+        lessons or ``all``.
+        """
+        if source not in LIST_SOURCES:
+            raise ValueError(f"source must be one of: {', '.join(LIST_SOURCES)}")
+        clauses, params = [], []
+        if source != 'all':
+            clauses.append(f"COALESCE(json_extract(extra, '$.source'), '') {'=' if source == GENERATED_SOURCE else '!='} ?")
+            params.append(GENERATED_SOURCE)
+        if subject:
+            clauses.append('subject = ?')
+            params.append(subject)
+        if grade:
+            clauses.append('grade = ?')
+            params.append(grade)
+        if cursor:
+            created_at, plan_id = decode_cursor(cursor)
+            clauses.append('(createdAt, id) < (?, ?)')
+            params.extend([created_at, plan_id])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        if limit is None:
+            rows = self._connection().execute(
+                f"""SELECT id, userId, subject, grade, topic, duration, objectives, content, createdAt, extra
+                    FROM LessonPlan {where} ORDER BY rowid""", params
+            ).fetchall()
+            return [self._row_to_plan(row) for row in rows], None
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        rows = self._connection().execute(
+            f"""SELECT id, userId, subject, grade, topic, duration, objectives, content, createdAt, extra
+                FROM LessonPlan {where} ORDER BY createdAt DESC, id DESC LIMIT ?""",
+            params + [limit + 1]
+        ).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['createdAt'], rows[-1]['id'])
+        return [self._row_to_plan(row) for row in rows], next_cursor
+
+    @staticmethod
+    def _row_to_plan(row: sqlite3.Row) -> Dict[str, Any]:
+        plan = json.loads(row['extra']) if row['extra'] else {}
+        originals = plan.pop(ORIGINALS_KEY, {})
+        absent = plan.pop(ABSENT_KEY, [])
+        plan.update({
+            "id": row['id'],
+            "userId": row['userId'],
+            "subject": row['subject'],
+            "grade": row['grade'],
+            "topic": row['topic'],
+            "duration": row['duration'],
+            "objectives": row['objectives'],
+            "content": json.loads(row['content']),
+            "created_at": row['createdAt'],
+        })
+        plan.update(originals)
+        for name in absent:
+            plan.pop(name, None)
+        return plan
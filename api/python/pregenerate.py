@@ -0,0 +1,367 @@
+"""Offline pre-generation of the artifact catalog.
+
+Unit plans, activities and rubrics are mostly requested for a predictable
+grid of curriculum subjects, grades and core topics. This job enumerates
+that grid, generates every artifact ahead of time and writes the results to
+the catalog file the API serves exact hits from (see ``catalog.py``):
+
+    python pregenerate.py --dry-run
+    python pregenerate.py --concurrency 4 --output artifacts.catalog
+    python pregenerate.py --grid grid.json --artifacts activities --structured
+
+Without ``--grid`` the grid comes from ``public/curriculum/curriculum-data.json``:
+each area is a subject, the grades are those its standards' cycles cover
+(``"Ciclo III (1º y 2º grado de primaria)"`` gives ``"1"`` and ``"2"``, as the
+forms send them) and its competencies are the topics. A grid file lists the
+cells explicitly and may override the per-artifact variants:
+
+    {"cells": [{"subject": "Matemática", "grades": ["3", "4"],
+                "topics": ["Fracciones", "Números decimales"]}],
+     "variants": {"unit-plan": {"duration": ["4 semanas", "8 semanas"]},
+                  "activities": {"activityType": ["individual", "grupal"]}}}
+
+Each variant field is a list of values and every combination is generated;
+``{topic}`` in a value is replaced by the cell's topic.
+Requests go through the same path as live traffic (admission scheduler at
+batch priority, circuit breaker, model router), ``--concurrency`` at a time,
+and reuse response cache entries unless ``--fresh``. Every finished artifact
+is appended to a checkpoint file, so a run that dies before writing the
+catalog resumes where it stopped; artifacts already in the catalog are
+carried over instead of regenerated. The catalog is rewritten atomically at
+the end (also after Ctrl-C), the checkpoint removed and a JSON summary
+printed. Entries no longer in the grid are dropped unless ``--keep-stale``.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from admission import BATCH, AdmissionRejected
+from catalog import CatalogSnapshot, write_catalog
+from curriculum_index import CurriculumIndex
+from request_logging import configure_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ARTIFACTS = ('unit-plan', 'activities', 'rubric')
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+# Values each artifact is generated with unless the grid file overrides them. The rubric and
+# activities defaults are the bundle endpoint's, so bundles hit the catalog too.
+DEFAULT_VARIANTS: Dict[str, Dict[str, List[Any]]] = {
+    'unit-plan': {"duration": ["4 semanas"]},
+    'activities': {"activityType": ["individual"]},
+    'rubric': {"assignmentType": ["la clase sobre {topic}"],
+               "criteria": [["Comprensión del tema", "Aplicación", "Comunicación", "Participación"]]},
+    'lesson': {"duration": [60]},
+}
+
+
+def artifact_body(artifact: str, subject: str, grade: str, topic: str, variant: Dict[str, Any]) -> Dict[str, Any]:
+    """The request body a client would send for one grid cell; ``{topic}`` in a variant value is filled in."""
+    if artifact == 'unit-plan':
+        body = {"subject": subject, "grade": grade, "mainTopic": topic}
+    elif artifact == 'rubric':
+        body = {"subject": subject, "gradeLevel": grade, "topic": topic}
+    else:
+        body = {"subject": subject, "grade": grade, "topic": topic}
+    return dict(body, **{name: value.replace('{topic}', topic) if isinstance(value, str) else value
+                         for name, value in variant.items()})
+
+
+def cycle_grades(grade_level: str) -> List[str]:
+    """Grades a cycle covers as the forms send them: ``"1º y 2º grado"`` gives ``["1", "2"]``."""
+    grades = re.findall(r'(\d+)\s*[º°]', grade_level)
+    return grades or ([grade_level] if grade_level else [])
+
+
+def curriculum_grid(sections: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One cell per curriculum area: its cycles' grades and its competencies as topics."""
+    cells = []
+    for section in sections or []:
+        grades: List[str] = []
+        topics: List[str] = []
+        for competency in section.get('competencies') or []:
+            if competency.get('name') and competency['name'] not in topics:
+                topics.append(competency['name'])
+            for standard in competency.get('standards') or []:
+                for grade in cycle_grades(standard.get('gradeLevel', '')):
+                    if grade not in grades:
+                        grades.append(grade)
+        if section.get('title') and grades and topics:
+            cells.append({"subject": section['title'], "grades": grades, "topics": topics})
+    return cells
+
+
+def load_grid(grid_path: Optional[str], curriculum_path: str) -> Dict[str, Any]:
+    """Read the grid file, or derive the grid from the curriculum; raise ValueError if malformed."""
+    if grid_path:
+        with open(grid_path, encoding='utf-8') as f:
+            grid = json.load(f)
+    else:
+        with open(curriculum_path, encoding='utf-8') as f:
+            grid = {"cells": curriculum_grid(json.load(f))}
+    if not isinstance(grid.get('cells'), list):
+        raise ValueError("The grid needs a 'cells' list")
+    for cell in grid['cells']:
+        if not cell.get('subject') or not cell.get('grades') or not cell.get('topics'):
+            raise ValueError(f"Grid cell needs a subject, grades and topics: {cell}")
+    return grid
+
+
+def expand_variants(variants: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    names = sorted(variants)
+    return [dict(zip(names, values)) for values in itertools.product(*(variants[name] for name in names))]
+
+
+def grid_requests(grid: Dict[str, Any], artifacts: List[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield ``(artifact, body)`` for every cell, grade, topic and variant combination."""
+    overrides = grid.get('variants') or {}
+    for artifact in artifacts:
+        variants = expand_variants(dict(DEFAULT_VARIANTS.get(artifact, {}), **overrides.get(artifact, {})))
+        for cell in grid['cells']:
+            for grade, topic, variant in itertools.product(cell['grades'], cell['topics'], variants):
+                yield artifact, artifact_body(artifact, cell['subject'], str(grade), topic, variant)
+
+
+class Checkpoint:
+    """Append-only JSON lines of finished artifacts, flushed as each one completes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    entries[record["key"]] = record["entry"]
+                except (ValueError, KeyError, TypeError):
+                    # A line cut short by an interrupted run
+                    continue
+        return entries
+
+    def append(self, key: str, entry: Dict[str, Any]) -> None:
+        line = json.dumps({"key": key, "entry": entry}, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def remove(self) -> None:
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Pregenerator:
+    """Generates the grid's missing artifacts with bounded concurrency, checkpointing each one."""
+
+    def __init__(self, api, checkpoint: Checkpoint, concurrency: int = DEFAULT_CONCURRENCY,
+                 retries: int = DEFAULT_RETRIES, fresh: bool = False, tenant: str = 'pregenerate'):
+        self.api = api
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.retries = retries
+        self.fresh = fresh
+        self.tenant = tenant
+        self.failures: List[Dict[str, Any]] = []
+        self.generated = 0
+        self.cache_hits = 0
+
+    def generate(self, gen) -> Tuple[Dict[str, Any], str]:
+        """Run one generation, waiting out rate limits and open circuits up to ``retries`` times."""
+        attempt = 0
+        while True:
+            try:
+                result, cache_status = self.api.run_completion(
+                    gen, bypass_cache=self.fresh, tenant=self.tenant, priority=BATCH)
+            except AdmissionRejected as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                logger.warning(f"{gen.endpoint} rejected ({str(e)}); retrying in {e.retry_after:.1f}s")
+                time.sleep(e.retry_after)
+                continue
+            if result.get("finish_reason") not in (None, 'stop'):
+                raise ValueError(f"Generation ended with finish_reason={result['finish_reason']}")
+            return result, cache_status
+
+    def _run_one(self, key: str, gen, body: Dict[str, Any]) -> str:
+        result, cache_status = self.generate(gen)
+        self.checkpoint.append(key, {"endpoint": gen.endpoint, "fields": body, "result": result})
+        return cache_status
+
+    def _collect(self, future, item: Tuple[str, Any, Dict[str, Any]]) -> None:
+        key, gen, body = item
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Failed {gen.endpoint} {json.dumps(body, ensure_ascii=False)}: {str(error)}")
+            self.failures.append({"key": key, "endpoint": gen.endpoint, "fields": body, "error": str(error)})
+            return
+        self.generated += 1
+        self.cache_hits += future.result() == "HIT"
+
+    def run(self, pending: List[Tuple[str, Any, Dict[str, Any]]]) -> bool:
+        """Generate ``(key, gen, body)`` items; return False if interrupted."""
+        total = len(pending)
+        items = iter(pending)
+        completed = 0
+        started = time.monotonic()
+        in_flight = {}
+        interrupted = False
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while True:
+                    # Keep at most ``concurrency`` generations submitted at a time
+                    while len(in_flight) < self.concurrency:
+                        item = next(items, None)
+                        if item is None:
+                            break
+                        in_flight[executor.submit(self._run_one, *item)] = item
+                    if not in_flight:
+                        break
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._collect(future, in_flight.pop(future))
+                        completed += 1
+                    if completed % max(1, self.concurrency * 5) == 0 or completed == total:
+                        logger.info(f"Pre-generated {completed}/{total} "
+                                    f"({self.generated} ok, {len(self.failures)} failed) "
+                                    f"in {time.monotonic() - started:.1f}s")
+            except KeyboardInterrupt:
+                logger.warning("Interrupted; waiting for running generations (rerun to resume)")
+                interrupted = True
+        # Generations still running when interrupted finished (and were checkpointed) on shutdown
+        for future, item in in_flight.items():
+            if not future.cancelled():
+                self._collect(future, item)
+        return not interrupted
+
+
+def build_requests(api, requests: Iterator[Tuple[str, Dict[str, Any]]], structured: bool
+                   ) -> Tuple[Dict[str, Tuple[Any, Dict[str, Any]]], List[Dict[str, Any]]]:
+    """Build each body's generation request; returns ``{key: (gen, body)}`` and the invalid bodies."""
+    built, invalid = {}, []
+    for artifact, body in requests:
+        try:
+            gen = api.PROMPT_BUILDERS[api.BATCH_ITEM_TYPES[artifact]](body)
+            if structured:
+                gen = api.structured_request(gen)
+        except api.RequestValidationError as e:
+            invalid.append({"artifact": artifact, "fields": body, "error": str(e)})
+            continue
+        built.setdefault(api.generation_cache_key(gen), (gen, body))
+    return built, invalid
+
+
+def main() -> None:
+    default_output = os.getenv('CATALOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'artifacts.catalog'))
+    parser = argparse.ArgumentParser(description="Pre-generate the artifact catalog for a curriculum grid")
+    parser.add_argument('--grid', default='', help="grid JSON file (default: derived from the curriculum)")
+    parser.add_argument('--curriculum', default=CurriculumIndex.from_env().source_path,
+                        help="curriculum-data.json to derive the grid from")
+    parser.add_argument('--artifacts', default=','.join(DEFAULT_ARTIFACTS),
+                        help="comma-separated subset of: unit-plan, activities, rubric, lesson")
+    parser.add_argument('--structured', action='store_true', help="generate the structured JSON variants")
+    parser.add_argument('--output', default=default_output, help="catalog file to write")
+    parser.add_argument('--checkpoint', default='', help="checkpoint file (default: <output>.checkpoint.jsonl)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="generations in flight")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help="retries per artifact after a rate limit or open circuit")
+    parser.add_argument('--limit', type=int, default=0, help="generate at most this many missing artifacts")
+    parser.add_argument('--fresh', action='store_true', help="bypass the response cache when generating")
+    parser.add_argument('--keep-stale', action='store_true',
+                        help="keep catalog entries that are no longer in the grid")
+    parser.add_argument('--dry-run', action='store_true', help="print the grid size and what is missing, then exit")
+    args = parser.parse_args()
+    # Claim the root logger before the app configures it: logs go to stderr, the summary to stdout
+    configure_logging(sys.stderr)
+    import app as api
+
+    artifacts = [name.strip() for name in args.artifacts.split(',') if name.strip()]
+    unknown = [name for name in artifacts if name not in api.BATCH_ITEM_TYPES]
+    if unknown:
+        parser.error(f"unknown artifacts: {', '.join(unknown)}")
+    try:
+        grid = load_grid(args.grid, args.curriculum)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot load the grid: {str(e)}")
+    built, invalid = build_requests(api, grid_requests(grid, artifacts), args.structured)
+
+    # Reuse what the current catalog and an interrupted run already produced
+    existing: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(args.output):
+        try:
+            existing = dict(CatalogSnapshot(args.output).entries())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable catalog {args.output}: {str(e)}")
+    checkpoint = Checkpoint(args.checkpoint or f"{args.output}.checkpoint.jsonl")
+    existing.update(checkpoint.load())
+    pending = [(key, gen, body) for key, (gen, body) in built.items() if key not in existing]
+    if args.limit:
+        pending = pending[:args.limit]
+
+    summary: Dict[str, Any] = {
+        "grid": len(built),
+        "invalid": invalid,
+        "reused": sum(1 for key in built if key in existing),
+        "pending": len(pending),
+    }
+    if args.dry_run:
+        by_endpoint: Dict[str, int] = {}
+        for _, gen, _ in pending:
+            by_endpoint[gen.endpoint] = by_endpoint.get(gen.endpoint, 0) + 1
+        summary["pending_by_endpoint"] = by_endpoint
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+        return
+
+    started = time.monotonic()
+    pregenerator = Pregenerator(api, checkpoint, max(1, args.concurrency), args.retries, args.fresh)
+    finished = pregenerator.run(pending)
+    checkpoint.close()
+
+    entries = dict(existing)
+    entries.update(checkpoint.load())
+    if not args.keep_stale:
+        entries = {key: entry for key, entry in entries.items() if key in built}
+    count = write_catalog(args.output, entries.items())
+    # The catalog now holds everything the checkpoint did; the next run starts from it
+    checkpoint.remove()
+    summary.update(
+        generated=pregenerator.generated,
+        response_cache_hits=pregenerator.cache_hits,
+        failed=pregenerator.failures,
+        interrupted=not finished,
+        entries=count,
+        bytes=os.path.getsize(args.output),
+        elapsed_seconds=round(time.monotonic() - started, 2),
+    )
+    logger.info(f"Wrote {count} artifacts to {args.output}")
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if pregenerator.failures or not finished:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Compiled prompt templates with local token accounting.
+
+Templates are compacted once at import (indentation and blank-line runs
+removed) and split into literal text and fields, so the token cost of the
+static text is counted once. At request time only the user-supplied values
+are counted; when the prompt would exceed the endpoint's token budget the
+designated free-text fields are truncated, longest first.
+
+Token counts use ``tiktoken`` when it is installed and its encoding is
+available locally, and a byte-length heuristic otherwise; neither makes a
+network call on the request path.
+"""
+import logging
+import math
+import os
+import re
+import string
+import textwrap
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from response_cache import parse_endpoint_limits
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROMPT_BUDGET = 600
+# Chat framing overhead per message and for priming the reply (per OpenAI's counting guide)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+TRUNCATION_MARK = '…'
+# Truncation never shrinks a field below this, even if the budget is still exceeded
+MIN_FIELD_TOKENS = 16
+
+_WORD = re.compile(r"\d+|[^\W\d_]+|[^\w\s]", re.UNICODE)
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _tiktoken_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                logger.warning(f"tiktoken encoding unavailable, using heuristic token counts: {str(e)}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Count (or closely estimate) the tokens of ``text``."""
+    if not text:
+        return 0
+    encoding = _tiktoken_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    tokens = 0
+    for word in _WORD.findall(text):
+        if word.isdigit():
+            tokens += math.ceil(len(word) / 3)
+        else:
+            tokens += max(1, math.ceil(len(word.encode('utf-8')) / 5))
+    return tokens
+
+
+def count_message_tokens(messages: Sequence[Dict[str, str]]) -> int:
+    return sum(TOKENS_PER_MESSAGE + count_tokens(m.get('content') or '') for m in messages) + TOKENS_PER_REPLY
+
+
+def compact(text: str) -> str:
+    """Dedent, strip every line and collapse runs of blank lines."""
+    lines = [line.strip() for line in textwrap.dedent(text).strip().splitlines()]
+    result = []
+    for line in lines:
+        if line or (result and result[-1]):
+            result.append(line)
+    return '\n'.join(result)
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Cut ``text`` at a word boundary so it fits in ``max_tokens``."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(' '.join(words[:middle]) + TRUNCATION_MARK) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return ' '.join(words[:low]) + TRUNCATION_MARK if low else ''
+
+
+def value_tokens(value: Any) -> int:
+    if isinstance(value, (list, tuple)):
+        return count_tokens(', '.join(str(item) for item in value))
+    return count_tokens(str(value))
+
+
+def truncate_value(value: Any, max_tokens: int) -> Any:
+    """Shrink a text or list value to ``max_tokens``; lists lose trailing items first."""
+    if isinstance(value, (list, tuple)):
+        items = [str(item) for item in value]
+        while len(items) > 1 and value_tokens(items) > max_tokens:
+            items.pop()
+        if items and value_tokens(items) > max_tokens:
+            items[0] = truncate_text(items[0], max_tokens)
+        return items
+    return truncate_text(str(value), max_tokens)
+
+
+class PromptTemplate:
+    """A compacted ``str.format`` template whose static token cost is known."""
+
+    def __init__(self, source: str):
+        self.text = compact(source)
+        parsed = list(string.Formatter().parse(self.text))
+        self.fields = [name for _, name, _, _ in parsed if name]
+        self.static_tokens = count_tokens(''.join(literal for literal, _, _, _ in parsed))
+
+    def render(self, **values: Any) -> str:
+        formatted = {name: ', '.join(str(v) for v in value) if isinstance(value, (list, tuple)) else value
+                     for name, value in values.items()}
+        return self.text.format(**formatted)
+
+
+class CompiledPrompt:
+    """System message plus user template, rendered under a token budget."""
+
+    def __init__(self, system: str, user: str, truncatable: Sequence[str] = ()):
+        self.system = compact(system)
+        self.user = PromptTemplate(user)
+        self.truncatable = tuple(truncatable)
+        self.fixed_tokens = (2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+                             + count_tokens(self.system) + self.user.static_tokens)
+
+    def build(self, values: Dict[str, Any],
+              budget: Optional[int]) -> Tuple[List[Dict[str, str]], int, List[str], Dict[str, Any]]:
+        """Return ``(messages, estimated_prompt_tokens, truncated_fields, rendered_values)``."""
+        values = dict(values)
+        sizes = {name: value_tokens(values[name]) for name in self.user.fields}
+        total = self.fixed_tokens + sum(sizes.values())
+        truncated = []
+        if budget is not None and total > budget:
+            # Shrink the largest truncatable field first, each down to what the budget leaves it
+            for name in sorted(self.truncatable, key=lambda n: sizes.get(n, 0), reverse=True):
+                if total <= budget or name not in sizes:
+                    continue
+                allowed = max(MIN_FIELD_TOKENS, sizes[name] - (total - budget))
+                if allowed >= sizes[name]:
+                    continue
+                values[name] = truncate_value(values[name], allowed)
+                new_size = value_tokens(values[name])
+                total -= sizes[name] - new_size
+                sizes[name] = new_size
+                truncated.append(name)
+        messages = [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.render(**values)},
+        ]
+        return messages, total, truncated, values
+
+
+class PromptBudgets:
+    """Per-endpoint prompt token budgets from ``PROMPT_TOKEN_BUDGET`` / ``PROMPT_TOKEN_BUDGETS``."""
+
+    def __init__(self, default: Optional[int] = DEFAULT_PROMPT_BUDGET, budgets: Optional[Dict[str, int]] = None):
+        self.default = default
+        self.budgets = budgets or {}
+
+    @classmethod
+    def from_env(cls) -> 'PromptBudgets':
+        default = int(os.getenv('PROMPT_TOKEN_BUDGET', DEFAULT_PROMPT_BUDGET))
+        return cls(default if default > 0 else None, parse_endpoint_limits(os.getenv('PROMPT_TOKEN_BUDGETS', '')))
+
+    def for_endpoint(self, endpoint: str) -> Optional[int]:
+        return self.budgets.get(endpoint, self.default)
+
+
+def clamp(value: float, low: int, high: int) -> int:
+    return int(max(low, min(high, value)))
+
+
+def leading_number(value: Any, default: float) -> float:
+    """Parse the number in values such as ``60``, ``"45 min"`` or ``"4 semanas"``."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    match = re.search(r'\d+(?:[.,]\d+)?', str(value or ''))
+    return float(match.group().replace(',', '.')) if match else default
@@ -0,0 +1,360 @@
+"""Prompt builders shared by the sync (Flask) and async (ASGI) generation routes.
+
+Each builder validates the request body and returns a ``GenerationRequest``
+carrying everything needed to call the upstream and to key the response cache.
+Templates are compiled once at import; each request is rendered under its
+endpoint's prompt token budget and gets a ``max_tokens`` sized to what it asks for.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from curriculum_index import CurriculumIndex, format_competencies
+from lesson_sections import SECTION_TITLES, SECTION_WEIGHTS, heading_format, summarize_sections
+from prompt_compiler import CompiledPrompt, PromptBudgets, clamp, count_tokens, leading_number, truncate_text
+
+# Bump whenever a generation prompt changes so stale cached completions are not served
+PROMPT_TEMPLATE_VERSION = "7"
+
+PROMPT_BUDGETS = PromptBudgets.from_env()
+# Fixed size of the shared course context, so it is byte-identical across endpoints
+CONTEXT_TOKENS = int(os.getenv('PROMPT_CONTEXT_TOKENS', 320))
+CONTEXT_FIELD_TOKENS = 40
+CURRICULUM_INDEX = CurriculumIndex.from_env()
+
+
+class RequestValidationError(ValueError):
+    """Raised when a generation request is missing required data."""
+
+
+@dataclass
+class GenerationRequest:
+    endpoint: str
+    result_key: str
+    fields: Dict[str, Any]
+    messages: List[Dict[str, str]]
+    params: Dict[str, Any] = field(default_factory=dict)
+    # Locally counted prompt tokens and the fields cut to fit the budget
+    prompt_tokens: int = 0
+    truncated: List[str] = field(default_factory=list)
+    # Model the upstream call went to, once routed (params['model'] is the prompt's default)
+    model: Optional[str] = None
+
+
+def validate_request_data(data: Dict[str, Any], required_fields: list) -> Optional[str]:
+    """Validate request data and return error message if invalid."""
+    if not data:
+        return "No se proporcionaron datos"
+
+    missing_fields = [field for field in required_fields if not data.get(field)]
+    if missing_fields:
+        return f"Faltan campos requeridos: {', '.join(missing_fields)}"
+
+    return None
+
+
+# Every prompt is laid out stable-first so upstream prompt caching can reuse the prefix:
+# one system message shared by all endpoints, then the course context (subject, grade,
+# topic and the matching curriculum standards), and only then the per-artifact
+# instructions and fields. Calls for the same class share everything up to the
+# instructions, whichever artifact they ask for. The language each artifact is written
+# in is set by its own instructions, as it was with the per-endpoint system messages.
+SYSTEM_PROMPT = """
+    Eres un asistente docente experto en diseño curricular, familiarizado con los estándares
+    educativos peruanos y el Currículo Nacional de Educación Básica del Perú. Creas planes de
+    clase, rúbricas de evaluación, planes de unidad y actividades educativas atractivas,
+    alineados con estándares educativos, que el docente pueda usar directamente.
+    """
+
+LESSON_PROMPT = CompiledPrompt(
+    system=SYSTEM_PROMPT,
+    user="""
+        {context}
+
+        Create a detailed lesson plan for this class.
+        Duration: {duration} minutes
+        Learning Objectives: {objectives}
+
+        The lesson plan should include an introduction/warm-up activity, the main content/teaching
+        activities, practice activities, assessment, closure and the materials needed, under exactly
+        these headings, each on its own line and in this order:
+        {headings}
+
+        Please structure it in a clear, organized format that a teacher can easily follow.
+        Write the lesson plan in English.
+        """,
+    truncatable=('objectives',),
+)
+
+SECTION_PROMPT = CompiledPrompt(
+    system=SYSTEM_PROMPT,
+    user="""
+        {context}
+
+        Rewrite part of an existing lesson plan for this class.
+        Duration: {duration} minutes
+        Learning Objectives: {objectives}
+
+        The sections you are not rewriting, summarized; keep the new sections consistent with them:
+        {summary}
+
+        Write only these sections, each under its heading on its own line, in English:
+        {headings}
+        {instructions}
+        """,
+    truncatable=('summary', 'instructions', 'objectives'),
+)
+
+RUBRIC_PROMPT = CompiledPrompt(
+    system=SYSTEM_PROMPT,
+    user="""
+        {context}
+
+        Como especialista en evaluación, crea una rúbrica detallada, alineada con estándares educativos,
+        para {assignmentType} de {gradeLevel}° grado con los siguientes criterios: {criteria}.
+        Incluye:
+        1. Niveles de desempeño específicos
+        2. Criterios de calificación
+        3. Descriptores para cada nivel
+        4. Puntajes
+
+        Todas tus respuestas deben ser en español.""",
+    truncatable=('criteria', 'assignmentType'),
+)
+
+UNIT_PLAN_PROMPT = CompiledPrompt(
+    system=SYSTEM_PROMPT,
+    user="""
+        {context}
+
+        Como especialista en planificación curricular, crea un plan de unidad de {duration} para esta clase,
+        enfocado en el tema indicado.
+        Incluye:
+        1. Objetivos de la unidad
+        2. Desglose semanal
+        3. Actividades principales
+        4. Plan de evaluación
+        5. Materiales requeridos
+
+        Asegúrate de que esté alineado con el Currículo Nacional de Educación Básica del Perú.
+        Todas tus respuestas deben ser en español.""",
+)
+
+ACTIVITIES_PROMPT = CompiledPrompt(
+    system=SYSTEM_PROMPT,
+    user="""
+        {context}
+
+        Crea {count} actividades {activityType}s atractivas para esta clase, sobre el tema indicado.
+        Para cada actividad incluye:
+        1. Descripción de la actividad
+        2. Duración
+        3. Materiales necesarios
+        4. Instrucciones paso a paso
+        5. Criterios de evaluación
+
+        Asegúrate de que las actividades sean apropiadas para el nivel y estén alineadas con el Currículo Nacional.
+        Todas tus respuestas deben ser en español.""",
+    truncatable=('activityType',),
+)
+
+# Tokens each kept section may take in the regeneration context
+SECTION_CONTEXT_TOKENS = 60
+
+DEFAULT_ACTIVITY_COUNT = 3
+MAX_ACTIVITY_COUNT = 10
+
+
+def curriculum_context(subject: str, grade: str, topic: str) -> str:
+    """The top-k matching competencies and standards, or an empty string when nothing matches."""
+    matches = CURRICULUM_INDEX.search(subject, grade, topic)
+    if not matches:
+        return ''
+    return "Competencias y estándares del Currículo Nacional a trabajar:\n" + format_competencies(matches)
+
+
+def course_context(subject: Any = '', grade: Any = '', topic: Any = '') -> str:
+    """The shared prompt prefix for one class: its subject, grade and topic plus curriculum standards.
+
+    Sized independently of the endpoint's budget, so every artifact for the
+    same class renders the identical text.
+    """
+    lines = ["Contexto de la clase:"]
+    for label, value in (("Área", subject), ("Grado", grade), ("Tema", topic)):
+        if value:
+            lines.append(f"{label}: {truncate_text(str(value), CONTEXT_FIELD_TOKENS)}")
+    fixed = len(lines)
+    if subject and grade and topic:
+        lines.extend(curriculum_context(str(subject), str(grade), str(topic)).splitlines())
+    # Drop the lowest-ranked standards first; the class description always stays
+    while len(lines) > fixed and count_tokens('\n'.join(lines)) > CONTEXT_TOKENS:
+        lines.pop()
+    if len(lines) == fixed + 1:
+        lines.pop()  # only the standards header is left
+    return '\n'.join(lines)
+
+
+def compile_request(endpoint: str, result_key: str, prompt: CompiledPrompt, fields: Dict[str, Any],
+                    max_tokens: Union[int, Callable[[Dict[str, Any]], int]],
+                    extra: Optional[Dict[str, Any]] = None) -> GenerationRequest:
+    """Render ``prompt`` under the endpoint's budget.
+
+    ``max_tokens`` may be a function of the values actually rendered (after
+    truncation); ``extra`` holds template values that are not request fields.
+    """
+    messages, prompt_tokens, truncated, values = prompt.build(
+        dict(fields, **(extra or {})), PROMPT_BUDGETS.for_endpoint(endpoint))
+    if callable(max_tokens):
+        max_tokens = max_tokens(values)
+    return GenerationRequest(
+        endpoint=endpoint,
+        result_key=result_key,
+        fields=fields,
+        messages=messages,
+        params={"model": "gpt-3.5-turbo", "max_tokens": max_tokens},
+        prompt_tokens=prompt_tokens,
+        truncated=truncated,
+    )
+
+
+def build_lesson_request(data: Dict[str, Any]) -> GenerationRequest:
+    """Build the lesson plan prompt for /api/generate-lesson."""
+    subject = data.get('subject', '')
+    grade = data.get('grade', '')
+    topic = data.get('topic', '')
+    duration = data.get('duration', 60)
+    objectives = data.get('objectives', '')
+
+    gen = compile_request(
+        'generate-lesson', 'lesson_plan', LESSON_PROMPT,
+        {"subject": subject, "grade": grade, "topic": topic, "duration": duration, "objectives": objectives},
+        lesson_max_tokens(duration),
+        extra={"context": course_context(subject, grade, topic), "headings": heading_format()},
+    )
+    gen.params["temperature"] = 0.7
+    return gen
+
+
+def lesson_max_tokens(duration: Any) -> int:
+    # About 18 completion tokens per lesson minute; a 60 minute lesson keeps the former 1500
+    return clamp(420 + 18 * leading_number(duration, 60), 800, 2500)
+
+
+def build_section_request(plan: Dict[str, Any], sections: Dict[str, str], targets: List[str],
+                          instructions: str = '') -> GenerationRequest:
+    """Build the prompt for /api/lesson-plans/<id>/regenerate: only ``targets`` are written.
+
+    The other sections are passed as a compact summary, and ``max_tokens`` is
+    the share of a full lesson's budget the target sections usually take.
+    """
+    duration = plan.get('duration') or 60
+    summary = summarize_sections(sections, targets, SECTION_CONTEXT_TOKENS)
+    fields = {
+        "subject": plan.get('subject') or '', "grade": plan.get('grade') or '', "topic": plan.get('topic') or '',
+        "duration": duration, "objectives": plan.get('objectives') or '',
+        "sections": targets, "summary": summary, "instructions": instructions,
+    }
+    share = sum(SECTION_WEIGHTS[key] for key in targets)
+    gen = compile_request(
+        'regenerate-sections', 'sections', SECTION_PROMPT, fields,
+        clamp(80 + share * lesson_max_tokens(duration), 200, 2500),
+        extra={
+            "context": course_context(fields["subject"], fields["grade"], fields["topic"]),
+            "summary": summary or "(none)",
+            "headings": '\n'.join(f"## {SECTION_TITLES[key]}" for key in targets),
+            "instructions": f"Teacher's notes: {instructions}" if instructions else '',
+        },
+    )
+    gen.params["temperature"] = 0.7
+    return gen
+
+
+def build_rubric_request(data: Dict[str, Any]) -> GenerationRequest:
+    """Build the rubric prompt for /api/generate-rubric.
+
+    Optional ``subject`` and ``topic`` put the rubric in the same course
+    context (and prompt prefix) as the class's lesson and activities.
+    """
+    error = validate_request_data(data, ['assignmentType', 'criteria', 'gradeLevel'])
+    if error:
+        raise RequestValidationError(error)
+
+    assignment_type = data['assignmentType']
+    criteria = data['criteria']
+    grade_level = data['gradeLevel']
+    if isinstance(criteria, str):
+        criteria = [criteria]
+
+    fields = {"assignmentType": assignment_type, "criteria": criteria, "gradeLevel": grade_level}
+    for name in ('subject', 'topic'):
+        if data.get(name):
+            fields[name] = data[name]
+    return compile_request(
+        'generate-rubric', 'rubric', RUBRIC_PROMPT, fields,
+        lambda values: clamp(300 + 150 * len(values['criteria']), 500, 2000),
+        extra={"context": course_context(fields.get('subject'), grade_level, fields.get('topic'))},
+    )
+
+
+def build_unit_plan_request(data: Dict[str, Any]) -> GenerationRequest:
+    """Build the unit plan prompt for /api/generate-unit-plan."""
+    error = validate_request_data(data, ['subject', 'grade', 'mainTopic'])
+    if error:
+        raise RequestValidationError(error)
+
+    subject = data['subject']
+    grade = data['grade']
+    duration = data.get('duration', '4 semanas')
+    main_topic = data['mainTopic']
+
+    weeks = leading_number(duration, 4)
+    if 'mes' in str(duration).lower():
+        weeks *= 4
+    return compile_request(
+        'generate-unit-plan', 'unit_plan', UNIT_PLAN_PROMPT,
+        {"subject": subject, "grade": grade, "duration": duration, "mainTopic": main_topic},
+        clamp(400 + 250 * weeks, 800, 3000),
+        extra={"context": course_context(subject, grade, main_topic)},
+    )
+
+
+def build_activities_request(data: Dict[str, Any]) -> GenerationRequest:
+    """Build the activities prompt for /api/generate-activities."""
+    if not data:
+        raise RequestValidationError("No data provided")
+
+    subject = data.get('subject')
+    grade = data.get('grade')
+    topic = data.get('topic')
+    activity_type = data.get('activityType', 'individual')
+
+    # Validate required fields
+    if not all([subject, grade, topic]):
+        missing = []
+        if not subject: missing.append("subject")
+        if not grade: missing.append("grade")
+        if not topic: missing.append("topic")
+        raise RequestValidationError(f"Missing required fields: {', '.join(missing)}")
+
+    try:
+        count = int(data.get('count', DEFAULT_ACTIVITY_COUNT))
+    except (TypeError, ValueError):
+        raise RequestValidationError("count must be a number")
+    count = max(1, min(count, MAX_ACTIVITY_COUNT))
+
+    fields = {"subject": subject, "grade": grade, "topic": topic, "activityType": activity_type}
+    if count != DEFAULT_ACTIVITY_COUNT:
+        fields["count"] = count
+    return compile_request(
+        'generate-activities', 'activities', ACTIVITIES_PROMPT, fields,
+        clamp(200 + 350 * count, 500, 3000),
+        extra={"count": count, "context": course_context(subject, grade, topic)},
+    )
+
+
+PROMPT_BUILDERS: Dict[str, Callable[[Dict[str, Any]], GenerationRequest]] = {
+    'generate-lesson': build_lesson_request,
+    'generate-rubric': build_rubric_request,
+    'generate-unit-plan': build_unit_plan_request,
+    'generate-activities': build_activities_request,
+}
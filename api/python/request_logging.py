@@ -0,0 +1,252 @@
+"""Logging off the request path: a queued root handler, sampled bodies and access lines.
+
+``configure_logging()`` replaces the stdout ``StreamHandler`` with a handler
+that only appends the record to a bounded in-memory queue; a background
+thread formats and writes it. Records are formatted lazily on that thread,
+so ``logger.info("... %s", value)`` costs the request a queue append, and
+when the queue is full records are dropped and counted rather than blocking
+a request. The queue and its thread are recreated in forked workers.
+
+``RequestLogPolicy`` decides what gets logged about each request:
+
+* request bodies only for a sampled fraction per route
+  (``LOG_BODY_SAMPLE_RATE``, overridden per route by ``LOG_BODY_SAMPLING``),
+  with fields that carry generated content or personal data redacted
+  (``LOG_REDACT_FIELDS``) and the result capped at ``LOG_BODY_MAX_BYTES``;
+* one JSON access line per request on the ``profechat.access`` logger, with
+  the status, size, cache outcome and a timing breakdown (admission wait,
+  upstream time to first token and duration, handler and total time),
+  sampled per route by ``LOG_ACCESS_SAMPLING`` (errors are always logged).
+
+Both per-route settings are keyed by the route as the access line's
+``route`` field shows it, the URL rule such as
+``"/api/generate-lesson=0.1,/api/test-lesson-plans=0"``.
+
+Timings are collected in a context variable, so upstream calls made while
+serving a request are attributed to it in both serving modes.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from response_cache import parse_endpoint_limits
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+ACCESS_LOGGER = 'profechat.access'
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BODY_MAX_BYTES = 1024
+# Generated content, credentials and personal data
+DEFAULT_REDACT_FIELDS = (
+    'content', 'lesson_plan', 'rubric', 'unit_plan', 'sections', 'instructions',
+    'password', 'token', 'apiKey', 'api_key', 'authorization', 'secret',
+    'email', 'phone', 'name', 'firstName', 'lastName', 'studentName', 'userId', 'dni',
+)
+
+_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_timings() -> Dict[str, float]:
+    """Start collecting timings for the current request and return the dict they go into."""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def current_timings() -> Optional[Dict[str, float]]:
+    return _timings.get()
+
+
+def record_timing(name: str, seconds: float, timings: Optional[Dict[str, float]] = None) -> None:
+    """Add ``seconds`` (as milliseconds) to the named timing of the current (or given) request."""
+    if timings is None:
+        timings = _timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + seconds * 1000, 2)
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted; drops them (counted) when the queue is full."""
+
+    def __init__(self, maxsize: int):
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        # Waits for the listener to write out what is queued, so logging.shutdown() in a
+        # worker about to os._exit loses no records
+        listener = self.listener
+        if listener is not None and listener._thread is not None:
+            self.queue.join()
+
+
+class AsyncLogging:
+    """The queued root handler and the listener thread writing its records out."""
+
+    def __init__(self, handlers: Iterable[logging.Handler], maxsize: int = DEFAULT_QUEUE_SIZE):
+        self.handlers = list(handlers)
+        self.queue_handler = QueuedHandler(maxsize)
+        self.running = False
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def start(self) -> None:
+        listener = logging.handlers.QueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+        listener.start()
+        self.queue_handler.listener = listener
+        self.running = True
+
+    def stop(self) -> None:
+        """Flush what is queued and stop the listener thread."""
+        self.running = False
+        listener, self.queue_handler.listener = self.queue_handler.listener, None
+        if listener is not None:
+            listener.stop()
+
+    def _after_fork(self) -> None:
+        # The listener thread did not survive the fork and may have held the queue's lock
+        self.queue_handler.queue = queue.Queue(self.queue_handler.maxsize)
+        self.queue_handler.dropped = 0
+        self.queue_handler.listener = None
+        if self.running:
+            self.start()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"queued": self.queue_handler.queue.qsize(), "dropped": self.queue_handler.dropped}
+
+
+_async_logging: Optional[AsyncLogging] = None
+
+
+def configure_logging(stream=None) -> Optional[AsyncLogging]:
+    """Route the root logger through the queue (``LOG_ASYNC=0`` keeps a direct stream handler)."""
+    global _async_logging
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    if os.getenv('LOG_ASYNC', '1').lower() in ('0', 'false', 'no'):
+        root.handlers[:] = [handler]
+        return None
+    if _async_logging is None:
+        _async_logging = AsyncLogging([handler], int(os.getenv('LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)))
+        _async_logging.start()
+        atexit.register(_async_logging.stop)
+    root.handlers[:] = [_async_logging.queue_handler]
+    return _async_logging
+
+
+def logging_stats() -> Dict[str, Any]:
+    return _async_logging.stats() if _async_logging is not None else {"queued": 0, "dropped": 0}
+
+
+def redact(value: Any, fields: frozenset) -> Any:
+    """Copy ``value`` with the values of ``fields`` (at any depth) replaced by a size marker."""
+    if isinstance(value, dict):
+        return {key: (f"[redacted {len(str(item))} chars]" if key in fields else redact(item, fields))
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item, fields) for item in value]
+    return value
+
+
+class LazyJSON:
+    """Serializes (and redacts and caps) a value only when a handler formats the record."""
+
+    __slots__ = ('value', 'redact_fields', 'max_bytes')
+
+    def __init__(self, value: Any, redact_fields: frozenset = frozenset(), max_bytes: int = 0):
+        self.value = value
+        self.redact_fields = redact_fields
+        self.max_bytes = max_bytes
+
+    def __str__(self) -> str:
+        value = redact(self.value, self.redact_fields) if self.redact_fields else self.value
+        text = json.dumps(value, ensure_ascii=False, default=str, separators=(',', ':'))
+        if self.max_bytes and len(text) > self.max_bytes:
+            return f"{text[:self.max_bytes]}…(+{len(text) - self.max_bytes} chars)"
+        return text
+
+
+class RequestLogPolicy:
+    """Per-route sampling, redaction and size caps for body logs and access lines."""
+
+    def __init__(self, body_sample_rate: float = 0.0, body_sampling: Optional[Dict[str, float]] = None,
+                 body_max_bytes: int = DEFAULT_BODY_MAX_BYTES, redact_fields: Iterable[str] = DEFAULT_REDACT_FIELDS,
+                 access_log: bool = True, access_sampling: Optional[Dict[str, float]] = None):
+        self.body_sample_rate = body_sample_rate
+        self.body_sampling = body_sampling or {}
+        self.body_max_bytes = body_max_bytes
+        self.redact_fields = frozenset(redact_fields)
+        self.access_log = access_log
+        self.access_sampling = access_sampling or {}
+        self.body_logger = logging.getLogger('profechat.requests')
+        self.access_logger = logging.getLogger(ACCESS_LOGGER)
+
+    @classmethod
+    def from_env(cls) -> 'RequestLogPolicy':
+        redact_fields = os.getenv('LOG_REDACT_FIELDS')
+        return cls(
+            body_sample_rate=float(os.getenv('LOG_BODY_SAMPLE_RATE', 0.0)),
+            body_sampling=parse_endpoint_limits(os.getenv('LOG_BODY_SAMPLING', ''), cast=float),
+            body_max_bytes=int(os.getenv('LOG_BODY_MAX_BYTES', DEFAULT_BODY_MAX_BYTES)),
+            redact_fields=[f.strip() for f in redact_fields.split(',') if f.strip()]
+            if redact_fields is not None else DEFAULT_REDACT_FIELDS,
+            access_log=os.getenv('LOG_ACCESS', '1').lower() not in ('0', 'false', 'no'),
+            access_sampling=parse_endpoint_limits(os.getenv('LOG_ACCESS_SAMPLING', ''), cast=float),
+        )
+
+    def log_body(self, route: str, body: Any) -> None:
+        """Log a redacted, size-capped request body for a sampled fraction of ``route``'s requests.
+
+        ``route`` is the URL rule, the same key ``log_access`` samples by.
+        """
+        rate = self.body_sampling.get(route, self.body_sample_rate)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return
+        self.body_logger.info("Request body for %s: %s", route,
+                              LazyJSON(body, self.redact_fields, self.body_max_bytes))
+
+    def log_access(self, entry: Dict[str, Any], route: str) -> None:
+        """Write one access line; successful requests on sampled routes are thinned out."""
+        if not self.access_log:
+            return
+        rate = self.access_sampling.get(route, 1.0)
+        if entry.get("status", 500) < 400 and rate < 1 and random.random() >= rate:
+            return
+        self.access_logger.info("%s", LazyJSON(entry))
+
+
+def access_entry(method: str, path: str, route: str, status: int, started: float,
+                 timings: Optional[Dict[str, float]], **fields: Any) -> Dict[str, Any]:
+    """Build an access-log entry; ``started`` is the request's ``time.perf_counter()`` start."""
+    entry = {
+        "ts": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + 'Z',
+        "method": method,
+        "path": path,
+        "route": route,
+        "status": status,
+    }
+    entry.update((key, value) for key, value in fields.items() if value is not None)
+    entry["timing"] = dict(timings or {}, total_ms=round((time.perf_counter() - started) * 1000, 2))
+    return entry
@@ -0,0 +1,379 @@
+"""Deadlines, hedged requests and circuit breaking for upstream completions.
+
+Every generation endpoint has a deadline for its upstream call. Non-streaming
+calls that are still running after the endpoint's recent p95 latency get one
+hedged duplicate; whichever answers first wins and the other is cancelled (or,
+on the thread-based sync path, abandoned and bounded by the deadline).
+
+A circuit breaker per model watches the recent error and slow-call rates. Once
+it trips, calls fail fast with 503 and a Retry-After hint, or go to the
+configured fallback model, until a half-open probe succeeds.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from admission import AdmissionRejected
+from response_cache import parse_endpoint_limits
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEADLINE_SECONDS = 60.0
+DEFAULT_HEDGE_QUANTILE = 0.95
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_MIN_DELAY = 1.0
+DEFAULT_HEDGE_MAX_RATIO = 0.1
+LATENCY_WINDOW = 200
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(AdmissionRejected):
+    """Raised when the breaker for the requested (and fallback) model is open."""
+
+    status_code = 503
+
+
+class DeadlineExceeded(AdmissionRejected):
+    """Raised when no attempt answered within the endpoint's deadline."""
+
+    status_code = 504
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Errors that count against a model's health; client errors and 429s do not."""
+    if isinstance(error, (APITimeoutError, APIConnectionError, DeadlineExceeded)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+class LatencyWindow:
+    """Recent successful call durations for one endpoint."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over a sliding window of call outcomes."""
+
+    def __init__(self, window: int = 20, min_calls: int = 10, error_rate: float = 0.5,
+                 slow_rate: float = 0.8, slow_seconds: float = 30.0, cooldown: float = 30.0):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trips = 0
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=window)
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Return True if a call may go out now; in half-open state only one probe is let through."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_started = None
+            # A probe that never reported back (e.g. rejected before sending) is replaced after a cooldown
+            if self._probe_started is not None and now - self._probe_started < self.cooldown:
+                return False
+            self._probe_started = now
+            return True
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(1.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record(self, seconds: float, failed: bool) -> None:
+        slow = seconds >= self.slow_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probe_started = None
+                if failed or slow:
+                    self._trip()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append((failed, slow))
+            if self.state == CLOSED and len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for f, _ in self._outcomes if f)
+                slow_calls = sum(1 for _, s in self._outcomes if s)
+                if (failures / len(self._outcomes) >= self.error_rate
+                        or slow_calls / len(self._outcomes) >= self.slow_rate):
+                    self._trip()
+
+    def _trip(self) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._outcomes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "trips": self.trips, "recent_calls": len(self._outcomes)}
+
+
+class UpstreamPolicy:
+    """Per-endpoint deadlines and hedging plus per-model circuit breakers."""
+
+    def __init__(self, default_deadline: float = DEFAULT_DEADLINE_SECONDS,
+                 deadlines: Optional[Dict[str, float]] = None, hedge: bool = True,
+                 hedge_quantile: float = DEFAULT_HEDGE_QUANTILE, hedge_min_samples: int = DEFAULT_HEDGE_MIN_SAMPLES,
+                 hedge_min_delay: float = DEFAULT_HEDGE_MIN_DELAY, hedge_max_ratio: float = DEFAULT_HEDGE_MAX_RATIO,
+                 fallback_model: Optional[str] = None, breaker_factory: Callable[[], CircuitBreaker] = CircuitBreaker,
+                 hedge_workers: int = 32):
+        self.default_deadline = default_deadline
+        self.deadlines = deadlines or {}
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.fallback_model = fallback_model
+        self._breaker_factory = breaker_factory
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latency: Dict[str, LatencyWindow] = {}
+        self._lock = threading.Lock()
+        self._hedge_workers = hedge_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        self._stats = {'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'deadline_exceeded': 0,
+                       'fallbacks': 0, 'rejected_open': 0}
+
+    @classmethod
+    def from_env(cls) -> 'UpstreamPolicy':
+        breaker_settings = dict(
+            window=int(os.getenv('CIRCUIT_WINDOW', 20)),
+            min_calls=int(os.getenv('CIRCUIT_MIN_CALLS', 10)),
+            error_rate=float(os.getenv('CIRCUIT_ERROR_RATE', 0.5)),
+            slow_rate=float(os.getenv('CIRCUIT_SLOW_RATE', 0.8)),
+            slow_seconds=float(os.getenv('CIRCUIT_SLOW_SECONDS', 30)),
+            cooldown=float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', 30)),
+        )
+        return cls(
+            default_deadline=float(os.getenv('UPSTREAM_DEADLINE_SECONDS', DEFAULT_DEADLINE_SECONDS)),
+            deadlines=parse_endpoint_limits(os.getenv('UPSTREAM_DEADLINES', ''), cast=float),
+            hedge=os.getenv('UPSTREAM_HEDGE', '1').lower() in ('1', 'true', 'yes'),
+            hedge_quantile=float(os.getenv('HEDGE_QUANTILE', DEFAULT_HEDGE_QUANTILE)),
+            hedge_min_samples=int(os.getenv('HEDGE_MIN_SAMPLES', DEFAULT_HEDGE_MIN_SAMPLES)),
+            hedge_min_delay=float(os.getenv('HEDGE_MIN_DELAY_SECONDS', DEFAULT_HEDGE_MIN_DELAY)),
+            hedge_max_ratio=float(os.getenv('HEDGE_MAX_RATIO', DEFAULT_HEDGE_MAX_RATIO)),
+            fallback_model=os.getenv('UPSTREAM_FALLBACK_MODEL') or None,
+            breaker_factory=lambda: CircuitBreaker(**breaker_settings),
+        )
+
+    def deadline_for(self, endpoint: str) -> float:
+        return self.deadlines.get(endpoint, self.default_deadline)
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(model, self._breaker_factory())
+        return breaker
+
+    def _latency_window(self, endpoint: str) -> LatencyWindow:
+        window = self._latency.get(endpoint)
+        if window is None:
+            with self._lock:
+                window = self._latency.setdefault(endpoint, LatencyWindow())
+        return window
+
+    def select_model(self, model: str) -> str:
+        """Return the model to call, switching to the fallback while the primary's breaker is open."""
+        breaker = self.breaker(model)
+        if breaker.allow():
+            return model
+        if self.fallback_model and self.fallback_model != model and self.breaker(self.fallback_model).allow():
+            with self._lock:
+                self._stats['fallbacks'] += 1
+            logger.warning(f"Circuit open for {model}, falling back to {self.fallback_model}")
+            return self.fallback_model
+        with self._lock:
+            self._stats['rejected_open'] += 1
+        raise CircuitOpen(f"Upstream model {model} is unavailable (circuit open)", breaker.retry_after())
+
+    def record(self, endpoint: str, model: str, seconds: float, error: Optional[BaseException] = None,
+               sample_latency: bool = True) -> None:
+        """Feed one attempt's outcome to the model's breaker and the endpoint's latency window."""
+        # Client errors and rate limiting still mean the model answered
+        failed = error is not None and is_upstream_failure(error)
+        self.breaker(model).record(seconds, failed)
+        if error is None and sample_latency:
+            self._latency_window(endpoint).add(seconds)
+
+    def hedge_delay(self, endpoint: str) -> Optional[float]:
+        """Delay after which a duplicate is sent, or None when hedging is off or over budget."""
+        if not self.hedge:
+            return None
+        with self._lock:
+            if self._stats['hedged'] >= self.hedge_max_ratio * max(self._stats['calls'], 1):
+                return None
+        delay = self._latency_window(endpoint).quantile(self.hedge_quantile, self.hedge_min_samples)
+        if delay is None:
+            return None
+        return max(delay, self.hedge_min_delay)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _pool(self) -> ThreadPoolExecutor:
+        pid = os.getpid()
+        if self._executor_pid != pid:
+            with self._lock:
+                if self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self._hedge_workers,
+                                                        thread_name_prefix='upstream-hedge')
+                    self._executor_pid = pid
+        return self._executor
+
+    def remaining(self, endpoint: str, expires_at: float) -> float:
+        """Seconds left before ``expires_at`` (monotonic) for an attempt's upstream call."""
+        left = expires_at - time.monotonic()
+        if left <= 0:
+            raise self._deadline_error(endpoint, self.deadline_for(endpoint))
+        return left
+
+    def _deadline_error(self, endpoint: str, deadline: float) -> DeadlineExceeded:
+        self._count('deadline_exceeded')
+        return DeadlineExceeded(f"Upstream did not answer {endpoint} within {deadline:.0f}s", 1.0)
+
+    def run(self, endpoint: str, attempt: Callable[[bool], Any]) -> Any:
+        """Run ``attempt(hedge)`` under the endpoint's deadline, hedging once after the p95 delay.
+
+        Attempts are expected to bound their own upstream call by the time left
+        (see ``remaining``); a client-side timeout is reported as DeadlineExceeded.
+        """
+        self._count('calls')
+        deadline = self.deadline_for(endpoint)
+        try:
+            return self._run(endpoint, attempt, deadline)
+        except APITimeoutError:
+            raise self._deadline_error(endpoint, deadline) from None
+
+    def _run(self, endpoint: str, attempt: Callable[[bool], Any], deadline: float) -> Any:
+        delay = self.hedge_delay(endpoint)
+        if delay is None or delay >= deadline:
+            return attempt(False)
+
+        started = time.monotonic()
+        primary = self._pool().submit(attempt, False)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        self._count('hedged')
+        hedged = self._pool().submit(attempt, True)
+        pending = {primary, hedged}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, started + deadline - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    future.cancel()
+                raise self._deadline_error(endpoint, deadline)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if future is hedged:
+                        self._count('hedge_wins')
+                    return future.result()
+                if future is primary or error is None:
+                    error = future.exception()
+        raise error
+
+    async def run_async(self, endpoint: str, attempt: Callable[[bool], Any]) -> Any:
+        """Async counterpart of ``run``; the losing attempt is cancelled."""
+        self._count('calls')
+        deadline = self.deadline_for(endpoint)
+        try:
+            return await self._run_async(endpoint, attempt, deadline)
+        except APITimeoutError:
+            raise self._deadline_error(endpoint, deadline) from None
+
+    async def _run_async(self, endpoint: str, attempt: Callable[[bool], Any], deadline: float) -> Any:
+        delay = self.hedge_delay(endpoint)
+        if delay is None or delay >= deadline:
+            try:
+                return await asyncio.wait_for(attempt(False), deadline)
+            except asyncio.TimeoutError:
+                raise self._deadline_error(endpoint, deadline) from None
+
+        started = time.monotonic()
+        primary = asyncio.ensure_future(attempt(False))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        self._count('hedged')
+        hedged = asyncio.ensure_future(attempt(True))
+        pending = {primary, hedged}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, started + deadline - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise self._deadline_error(endpoint, deadline)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            self._count('hedge_wins')
+                        return task.result()
+                    if task is primary or error is None:
+                        error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            breakers = dict(self._breakers)
+            endpoints = sorted(set(self.deadlines) | set(self._latency))
+            stats = dict(self._stats)
+        return dict(
+            stats,
+            default_deadline_seconds=self.default_deadline,
+            fallback_model=self.fallback_model,
+            endpoints={
+                endpoint: {
+                    "deadline_seconds": self.deadline_for(endpoint),
+                    "hedge_delay_seconds": self._latency_window(endpoint).quantile(
+                        self.hedge_quantile, self.hedge_min_samples),
+                }
+                for endpoint in endpoints
+            },
+            breakers={model: breaker.stats() for model, breaker in breakers.items()},
+        )
@@ -0,0 +1,215 @@
+"""Two-tier response cache for the generation endpoints.
+
+Completions are stored under a content-addressed key built from the
+normalized request fields, the prompt template version, the model and the
+sampling parameters. Lookups go to an in-process LRU (with TTL) first and
+fall back to a persistent SQLite tier shared across restarts and workers.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 512
+
+
+def normalize_value(value: Any) -> Any:
+    """Normalize a request field so trivially different inputs share a key."""
+    if isinstance(value, str):
+        text = unicodedata.normalize('NFC', value)
+        return ' '.join(text.split()).casefold()
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(k): normalize_value(v) for k, v in sorted(value.items())}
+    return value
+
+
+def make_cache_key(endpoint: str, fields: Dict[str, Any], template_version: str,
+                   params: Dict[str, Any]) -> str:
+    """Build the content-addressed key for a generation request."""
+    payload = {
+        'endpoint': endpoint,
+        'fields': normalize_value(fields),
+        'template_version': template_version,
+        'params': params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def parse_endpoint_limits(spec: str, cast=int) -> Dict[str, Any]:
+    """Parse ``"generate-lesson=1000,generate-rubric=200"`` into a dict."""
+    limits = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        name, _, value = item.partition('=')
+        try:
+            limits[name.strip()] = cast(value)
+        except ValueError:
+            logger.warning(f"Ignoring invalid endpoint limit: {item}")
+    return limits
+
+
+class ResponseCache:
+    """In-process LRU with TTL in front of an optional SQLite tier."""
+
+    def __init__(self, db_path: Optional[str] = None, ttl_seconds: int = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 endpoint_limits: Optional[Dict[str, int]] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.endpoint_limits = endpoint_limits or {}
+        self._memory: Dict[str, OrderedDict] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._db_path = db_path
+        if db_path:
+            self._open_db(db_path)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_env(cls) -> 'ResponseCache':
+        """Create a cache configured from RESPONSE_CACHE_* environment variables."""
+        default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'response_cache.sqlite3')
+        return cls(
+            db_path=os.getenv('RESPONSE_CACHE_DB', default_db) or None,
+            ttl_seconds=int(os.getenv('RESPONSE_CACHE_TTL', DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+            endpoint_limits=parse_endpoint_limits(os.getenv('RESPONSE_CACHE_LIMITS', '')),
+        )
+
+    def _open_db(self, db_path: str) -> None:
+        try:
+            db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            db.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_endpoint '
+                       'ON response_cache (endpoint, created_at)')
+            self._db = db
+        except sqlite3.Error as e:
+            logger.error(f"Response cache database unavailable, using memory only: {str(e)}")
+            self._db = None
+
+    def _after_fork(self) -> None:
+        """Give a forked worker its own connection; the parent's must not be used or closed there."""
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        if self._db is not None:
+            self._inherited_db = self._db
+            self._open_db(self._db_path)
+
+    def limit_for(self, endpoint: str) -> int:
+        return self.endpoint_limits.get(endpoint, self.max_entries)
+
+    def _count(self, endpoint: str, name: str) -> None:
+        counters = self._stats.setdefault(endpoint, {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'bypasses': 0})
+        counters[name] += 1
+
+    def record_bypass(self, endpoint: str) -> None:
+        with self._lock:
+            self._count(endpoint, 'bypasses')
+
+    def get(self, endpoint: str, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached value for ``key`` or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entries = self._memory.get(endpoint)
+            if entries is not None and key in entries:
+                created_at, value = entries[key]
+                if now - created_at < self.ttl_seconds:
+                    entries.move_to_end(key)
+                    self._count(endpoint, 'memory_hits')
+                    return value
+                del entries[key]
+
+        row = self._db_get(key, now)
+        with self._lock:
+            if row is None:
+                self._count(endpoint, 'misses')
+                return None
+            self._count(endpoint, 'disk_hits')
+            self._memory_put(endpoint, key, row[0], row[1])
+        return row[1]
+
+    def set(self, endpoint: str, key: str, value: Dict[str, Any]) -> None:
+        """Store ``value`` in both tiers, evicting beyond the endpoint limit."""
+        now = time.time()
+        with self._lock:
+            self._memory_put(endpoint, key, now, value)
+        self._db_put(endpoint, key, now, value)
+
+    def _memory_put(self, endpoint: str, key: str, created_at: float, value: Dict[str, Any]) -> None:
+        entries = self._memory.setdefault(endpoint, OrderedDict())
+        entries[key] = (created_at, value)
+        entries.move_to_end(key)
+        while len(entries) > self.limit_for(endpoint):
+            entries.popitem(last=False)
+
+    def _db_get(self, key: str, now: float) -> Optional[Tuple[float, Dict[str, Any]]]:
+        if self._db is None:
+            return None
+        try:
+            with self._db_lock:
+                row = self._db.execute(
+                    'SELECT created_at, value FROM response_cache WHERE key = ? AND created_at > ?',
+                    (key, now - self.ttl_seconds)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Response cache read failed: {str(e)}")
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _db_put(self, endpoint: str, key: str, created_at: float, value: Dict[str, Any]) -> None:
+        if self._db is None:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO response_cache (key, endpoint, value, created_at) VALUES (?, ?, ?, ?)',
+                    (key, endpoint, json.dumps(value, ensure_ascii=False), created_at)
+                )
+                self._db.execute(
+                    """DELETE FROM response_cache WHERE endpoint = ? AND (created_at <= ? OR key NOT IN (
+                           SELECT key FROM response_cache WHERE endpoint = ? ORDER BY created_at DESC LIMIT ?))""",
+                    (endpoint, created_at - self.ttl_seconds, endpoint, self.limit_for(endpoint))
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Response cache write failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current sizes per endpoint."""
+        with self._lock:
+            endpoints = {}
+            for endpoint, counters in self._stats.items():
+                endpoints[endpoint] = dict(counters)
+                endpoints[endpoint]['memory_entries'] = len(self._memory.get(endpoint, ()))
+                endpoints[endpoint]['limit'] = self.limit_for(endpoint)
+            return {
+                'ttl_seconds': self.ttl_seconds,
+                'persistent': self._db is not None,
+                'endpoints': endpoints,
+            }
@@ -0,0 +1,380 @@
+"""Prefork production server for the Flask API.
+
+``python app.py`` serves through this launcher unless ``FLASK_DEBUG`` is set.
+The master imports the app once and then forks the workers, so modules,
+compiled prompts and the curriculum index are shared copy-on-write
+(``gc.freeze`` keeps the collector from dirtying those pages). Each worker
+answers requests on a bounded thread pool.
+
+The listening socket is opened with ``SO_REUSEPORT``. By default the master
+binds it and every worker accepts from that one queue, so a draining worker
+never strands queued connections, and a second launcher can bind the same
+port while the old one drains (a zero-downtime code deploy). With
+``SERVER_LISTENER=per-worker`` each worker binds its own ``SO_REUSEPORT``
+socket and the kernel spreads connections across them; connections still
+queued on a worker when it exits are reset unless
+``net.ipv4.tcp_migrate_req`` is enabled.
+
+Signals to the master:
+
+* ``SIGHUP`` forks a fresh generation of workers, then drains the old one
+  (code is preloaded, so deploying new code still needs a restart);
+* ``SIGTERM``/``SIGINT`` drain every worker and exit; a second one kills them.
+
+A draining worker stops accepting, finishes its in-flight requests for at
+most ``SERVER_GRACEFUL_TIMEOUT`` seconds and exits. Workers also recycle
+themselves after ``SERVER_MAX_REQUESTS`` requests, plus a random jitter so
+they do not all restart together, and the master replaces any worker that
+exits.
+
+Per-process state stays per worker: each one admits ``1/workers`` of the
+upstream rate-limit budget (briefly overlapping while a reload drains the
+old generation), and the circuit breakers, hedging latencies and router
+statistics are learned by each worker from its own traffic. The response
+cache, similarity index, jobs and ``/metrics`` are shared.
+"""
+import gc
+import logging
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 8
+DEFAULT_MAX_REQUESTS = 10000
+DEFAULT_MAX_REQUESTS_JITTER = 1000
+DEFAULT_GRACEFUL_TIMEOUT = 30.0
+DEFAULT_KEEPALIVE = 5.0
+DEFAULT_BACKLOG = 1024
+# Workers that die sooner than this after being forked are respawned with a delay
+CRASH_BACKOFF_SECONDS = 1.0
+
+
+def available_cpus() -> int:
+    """Count the cores this process may run on (respecting CPU affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ServerConfig:
+    """Launcher settings from ``SERVER_*`` environment variables."""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = 5338, workers: Optional[int] = None,
+                 threads: int = DEFAULT_THREADS, max_requests: int = DEFAULT_MAX_REQUESTS,
+                 max_requests_jitter: int = DEFAULT_MAX_REQUESTS_JITTER,
+                 graceful_timeout: float = DEFAULT_GRACEFUL_TIMEOUT, keepalive: float = DEFAULT_KEEPALIVE,
+                 backlog: int = DEFAULT_BACKLOG, per_worker_listeners: bool = False):
+        self.host = host
+        self.port = port
+        self.workers = workers or available_cpus()
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.keepalive = keepalive
+        self.backlog = backlog
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.per_worker_listeners = per_worker_listeners and self.reuse_port
+
+    @classmethod
+    def from_env(cls, port: Optional[int] = None) -> 'ServerConfig':
+        return cls(
+            host=os.getenv('SERVER_HOST', '0.0.0.0'),
+            port=port if port is not None else int(os.getenv('FLASK_SERVER_PORT', 5338)),
+            workers=int(os.getenv('SERVER_WORKERS', 0)) or None,
+            threads=int(os.getenv('SERVER_THREADS', DEFAULT_THREADS)),
+            max_requests=int(os.getenv('SERVER_MAX_REQUESTS', DEFAULT_MAX_REQUESTS)),
+            max_requests_jitter=int(os.getenv('SERVER_MAX_REQUESTS_JITTER', DEFAULT_MAX_REQUESTS_JITTER)),
+            graceful_timeout=float(os.getenv('SERVER_GRACEFUL_TIMEOUT', DEFAULT_GRACEFUL_TIMEOUT)),
+            keepalive=float(os.getenv('SERVER_KEEPALIVE', DEFAULT_KEEPALIVE)),
+            backlog=int(os.getenv('SERVER_BACKLOG', DEFAULT_BACKLOG)),
+            per_worker_listeners=os.getenv('SERVER_LISTENER', 'shared').lower() == 'per-worker',
+        )
+
+
+def bind_socket(host: str, port: int, backlog: int, reuse_port: bool, listen: bool = True) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        if listen:
+            sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class RequestHandler(WSGIRequestHandler):
+    """HTTP/1.1 handler that closes keep-alive connections idle for ``SERVER_KEEPALIVE`` seconds."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        self.timeout = self.server.keepalive
+        super().setup()
+
+    def handle_one_request(self) -> None:
+        super().handle_one_request()
+        if self.server.draining:
+            self.close_connection = True
+
+    def log_request(self, code='-', size='-') -> None:
+        # The app writes its own JSON access line per request (request_logging)
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server running connections on a fixed thread pool, with graceful drain.
+
+    The accept loop waits for a free thread before accepting again, so excess
+    connections stay in the kernel backlog instead of piling up in the worker.
+    """
+
+    multithread = True
+
+    def __init__(self, sock: socket.socket, app, threads: int, keepalive: float, max_requests: int = 0):
+        self.keepalive = keepalive
+        self.max_requests = max_requests
+        self.requests = 0
+        self.draining = False
+        self._slots = threading.BoundedSemaphore(threads)
+        self._lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        host, port = sock.getsockname()[:2]
+        super().__init__(host, port, self._count_requests(app), handler=RequestHandler, fd=sock.fileno())
+
+    def _count_requests(self, app):
+        def counted(environ, start_response):
+            with self._lock:
+                self.requests += 1
+                recycle = self.max_requests and self.requests >= self.max_requests
+            if recycle:
+                logger.info(f"Worker {os.getpid()} served {self.requests} requests, recycling")
+                self.drain()
+            return app(environ, start_response)
+        return counted
+
+    def process_request(self, request, client_address) -> None:
+        self._slots.acquire()
+        try:
+            self.pool.submit(self._process, request, client_address)
+        except RuntimeError:
+            # The pool was shut down while this connection was being accepted
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _process(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def drain(self) -> None:
+        """Stop accepting new connections; ``serve_forever`` returns shortly after."""
+        with self._lock:
+            if self.draining:
+                return
+            self.draining = True
+        # shutdown() blocks until the accept loop exits, so it can't run on that loop's thread
+        threading.Thread(target=self.shutdown, name='drain', daemon=True).start()
+
+    def finish(self, timeout: float) -> bool:
+        """Close the listener and wait for in-flight requests; return False if some were cut off."""
+        self.server_close()
+        waiter = threading.Thread(target=self.pool.shutdown, kwargs={'wait': True}, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        return not waiter.is_alive()
+
+
+def run_worker(app, sock: socket.socket, config: ServerConfig, max_requests: int,
+               post_fork: Optional[Callable[[], None]] = None,
+               worker_exit: Optional[Callable[[], None]] = None) -> int:
+    """Serve requests in a worker until it is drained or recycled; return its exit code.
+
+    ``worker_exit`` runs after the last request, since workers leave through
+    ``os._exit`` and skip ``atexit`` handlers.
+    """
+    server = PooledWSGIServer(sock, app, config.threads, config.keepalive, max_requests)
+    # The server accepts on its own duplicate of the listening descriptor
+    sock.close()
+    for name in ('SIGTERM', 'SIGINT', 'SIGHUP'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), lambda *_: server.drain())
+    if post_fork is not None:
+        post_fork()
+    server.serve_forever()
+    if not server.finish(config.graceful_timeout):
+        logger.warning(f"Worker {os.getpid()} exited with requests still in flight after "
+                       f"{config.graceful_timeout}s")
+    if worker_exit is not None:
+        worker_exit()
+    return 0
+
+
+class Arbiter:
+    """Prefork master: binds, forks and supervises the workers and handles reload/stop signals."""
+
+    def __init__(self, app, config: ServerConfig, post_fork: Optional[Callable[[], None]] = None,
+                 worker_exit: Optional[Callable[[], None]] = None):
+        self.app = app
+        self.config = config
+        self.post_fork = post_fork
+        self.worker_exit = worker_exit
+        self.generation = 0
+        self.workers: Dict[int, Tuple[int, float]] = {}
+        self.listener: Optional[socket.socket] = None
+        self.stopping = False
+        self.stop_deadline = 0.0
+        self.respawn_after = 0.0
+        self._signals = []
+
+    def run(self) -> None:
+        config = self.config
+        if config.per_worker_listeners:
+            # Probe the port (without listening) so a taken one fails fast instead of crash-looping workers
+            bind_socket(config.host, config.port, config.backlog, True, listen=False).close()
+        else:
+            self.listener = bind_socket(config.host, config.port, config.backlog, config.reuse_port)
+            # Workers race for each connection; the losers must not block in accept()
+            self.listener.setblocking(False)
+        wake_read, wake_write = os.pipe()
+        os.set_blocking(wake_write, False)
+        signal.set_wakeup_fd(wake_write)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, lambda signum, _: self._signals.append(signum))
+
+        # Everything imported so far is shared copy-on-write; keep the collector off those pages
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        logger.info(f"Prefork server on {config.host}:{config.port}: {config.workers} workers x "
+                    f"{config.threads} threads, {'per-worker' if config.per_worker_listeners else 'shared'} listener, "
+                    f"recycling after {config.max_requests} requests")
+        self.spawn_missing()
+        while self.workers or not self.stopping:
+            select.select([wake_read], [], [], 1.0)
+            try:
+                os.read(wake_read, 4096)
+            except BlockingIOError:
+                pass
+            while self._signals:
+                self.handle_signal(self._signals.pop(0))
+            self.reap()
+            if self.stopping:
+                if self.workers and time.monotonic() > self.stop_deadline:
+                    self.kill_all(signal.SIGKILL)
+            else:
+                self.spawn_missing()
+        logger.info("Prefork server stopped")
+
+    def handle_signal(self, signum: int) -> None:
+        if signum == signal.SIGHUP and not self.stopping:
+            old = [pid for pid, (generation, _) in self.workers.items() if generation == self.generation]
+            self.generation += 1
+            logger.info(f"Reloading: starting generation {self.generation}, draining {len(old)} workers")
+            self.spawn_missing()
+            for pid in old:
+                self.signal_worker(pid, signal.SIGTERM)
+        elif signum in (signal.SIGTERM, signal.SIGINT):
+            if self.stopping:
+                logger.warning("Second stop signal, killing workers")
+                self.kill_all(signal.SIGKILL)
+                return
+            logger.info(f"Stopping: draining {len(self.workers)} workers")
+            self.stopping = True
+            self.stop_deadline = time.monotonic() + self.config.graceful_timeout + 5
+            self.kill_all(signal.SIGTERM)
+
+    def spawn_missing(self) -> None:
+        current = sum(1 for generation, _ in self.workers.values() if generation == self.generation)
+        if current < self.config.workers and time.monotonic() < self.respawn_after:
+            return
+        for _ in range(self.config.workers - current):
+            self.spawn()
+
+    def spawn(self) -> None:
+        max_requests = self.config.max_requests
+        if max_requests and self.config.max_requests_jitter:
+            max_requests += random.randint(0, self.config.max_requests_jitter)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (self.generation, time.monotonic())
+            return
+        # Worker process: drop the master's signal plumbing and never return into its loop
+        code = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            random.seed()
+            sock = self.listener
+            if sock is None:
+                sock = bind_socket(self.config.host, self.config.port, self.config.backlog, True)
+            code = run_worker(self.app, sock, self.config, max_requests, self.post_fork, self.worker_exit)
+        except BaseException:
+            logger.exception(f"Worker {os.getpid()} crashed")
+        finally:
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            generation, started = self.workers.pop(pid, (None, 0.0))
+            if generation is None:
+                continue
+            code = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+            if code and not self.stopping:
+                logger.warning(f"Worker {pid} exited with status {code}")
+                if time.monotonic() - started < CRASH_BACKOFF_SECONDS:
+                    self.respawn_after = time.monotonic() + CRASH_BACKOFF_SECONDS
+
+    def signal_worker(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+    def kill_all(self, signum: int) -> None:
+        for pid in list(self.workers):
+            self.signal_worker(pid, signum)
+
+
+def serve(app, config: ServerConfig, post_fork: Optional[Callable[[], None]] = None,
+          worker_exit: Optional[Callable[[], None]] = None) -> None:
+    """Serve ``app`` with the prefork launcher (a single in-process worker where fork is unavailable)."""
+    if hasattr(os, 'fork'):
+        Arbiter(app, config, post_fork, worker_exit).run()
+        return
+    logger.info(f"fork() unavailable, serving from one process on {config.host}:{config.port}")
+    sock = bind_socket(config.host, config.port, config.backlog, False)
+    # Without a master to replace it, this worker must not recycle itself
+    run_worker(app, sock, config, 0, post_fork, worker_exit)
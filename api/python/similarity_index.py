@@ -0,0 +1,450 @@
+"""Near-duplicate index over past generation requests.
+
+Requests are split into an exact-match partition (endpoint, prompt variant,
+subject, grade, activity type, duration) and free text (topic, objectives,
+criteria...). The variant is the prompt template version and sampling
+parameters, so results of older prompts, other models or the structured
+output format are never offered. The free text is normalized as Spanish into
+a set of word stems and summarized with MinHash; an LSH banding table narrows
+lookups to a handful of candidates, so a query costs a few dictionary probes
+regardless of how many generations are stored.
+
+Candidates are scored exactly by the share of the shorter request's terms
+found in the other, so a refined topic ("fracciones equivalentes") still
+matches a prior "fracciones" lesson. A candidate whose Jaccard similarity is
+below half the threshold is rejected, so a one-word topic does not match
+every longer request that mentions it.
+
+Generated content lives in SQLite, shared by all worker processes. Each
+process keeps its own LSH table over it and picks up rows added by other
+workers every ``SIMILARITY_SYNC_INTERVAL`` seconds; without a database the
+index is per process. Entries expire after ``SIMILARITY_TTL_SECONDS`` and at
+most ``SIMILARITY_MAX_ENTRIES`` are kept (about 2 KB of memory each), least
+recently matched out first.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 32
+DEFAULT_BANDS = 16
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_SYNC_INTERVAL = 2.0
+# Expired and surplus rows are deleted from the database at most this often
+TRIM_INTERVAL = 60.0
+
+# Fields compared for exact equality; every other field is free text
+PARTITION_FIELDS = ('subject', 'grade', 'gradeLevel', 'activityType', 'duration')
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+SPANISH_STOPWORDS = {
+    'a', 'al', 'como', 'con', 'de', 'del', 'e', 'el', 'en', 'la', 'las', 'lo', 'los', 'o',
+    'para', 'por', 'que', 'se', 'sobre', 'su', 'sus', 'u', 'un', 'una', 'unos', 'unas', 'y',
+}
+
+ORDINAL_GRADES = {
+    'primero': '1', 'primer': '1', 'segundo': '2', 'tercero': '3', 'tercer': '3', 'cuarto': '4',
+    'quinto': '5', 'sexto': '6', 'septimo': '7', 'octavo': '8', 'noveno': '9', 'decimo': '10',
+}
+
+
+def strip_accents(text: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def normalize_words(text: str) -> List[str]:
+    """Lowercase, strip accents and punctuation, drop stopwords and plural endings."""
+    words = re.findall(r'[a-z0-9]+', strip_accents(text).casefold())
+    result = []
+    for word in words:
+        if word in SPANISH_STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('es'):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith('s'):
+            word = word[:-1]
+        result.append(word)
+    return result
+
+
+def normalize_grade(value: Any) -> str:
+    """Map "5", "5°", "5to", "quinto" and "5th Grade" to the same token."""
+    text = strip_accents(str(value)).casefold()
+    digits = re.search(r'\d+', text)
+    if digits:
+        return str(int(digits.group()))
+    for word in normalize_words(text):
+        if word in ORDINAL_GRADES:
+            return ORDINAL_GRADES[word]
+    return ' '.join(normalize_words(text))
+
+
+def partition_key(endpoint: str, fields: Dict[str, Any], variant: str = '') -> str:
+    parts = [endpoint, f"variant={variant}"]
+    for name in PARTITION_FIELDS:
+        if name not in fields:
+            continue
+        value = fields[name]
+        normalized = normalize_grade(value) if name in ('grade', 'gradeLevel') else ' '.join(normalize_words(str(value)))
+        parts.append(f"{name}={normalized}")
+    return '|'.join(parts)
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+
+
+def free_text(fields: Dict[str, Any]) -> str:
+    """Join the non-partition fields; list fields such as rubric criteria are order-insensitive."""
+    parts = []
+    for name in sorted(fields):
+        if name in PARTITION_FIELDS:
+            continue
+        value = fields[name]
+        if isinstance(value, (list, tuple)):
+            parts.extend(sorted(' '.join(normalize_words(str(item))) for item in value))
+        else:
+            parts.append(' '.join(normalize_words(str(value))))
+    return ' '.join(part for part in parts if part)
+
+
+def shingles(text: str, size: int = 1) -> Set[int]:
+    """Word n-gram shingles of normalized text, hashed to 32 bits."""
+    words = text.split()
+    if len(words) <= size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))}
+    return {zlib.crc32(' '.join(words[i:i + size]).encode('utf-8')) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """Deterministic MinHash over 32-bit shingle hashes."""
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+
+    def signature(self, hashed_shingles: Iterable[int]) -> array:
+        values = list(hashed_shingles)
+        return array('I', (
+            min(((a * x + b) % _MERSENNE_PRIME) & _MAX_HASH for x in values)
+            for a, b in self._perms
+        ))
+
+
+class SimilarityIndex:
+    """MinHash LSH index of past generations over a shared SQLite store."""
+
+    def __init__(self, db_path: Optional[str] = None, threshold: float = DEFAULT_THRESHOLD,
+                 num_perm: int = DEFAULT_NUM_PERM, bands: int = DEFAULT_BANDS,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 sync_interval: float = DEFAULT_SYNC_INTERVAL):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.sync_interval = sync_interval
+        self.hasher = MinHasher(num_perm)
+        # doc id -> (partition digest, sorted shingles, created at), least recently matched first
+        self._entries: 'OrderedDict[int, Tuple[bytes, array, float]]' = OrderedDict()
+        self._buckets: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._memory_docs: Dict[int, Tuple[str, str, float]] = {}
+        self._next_memory_id = -1
+        self._synced_id = 0
+        self._synced_at = time.monotonic()
+        self._trimmed_at = float('-inf')
+        self.lookups = 0
+        self.matches = 0
+        self.evictions = 0
+        self._db_path = db_path
+        if db_path:
+            self._open_db(db_path)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @classmethod
+    def from_env(cls) -> 'SimilarityIndex':
+        default_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'similarity_index.sqlite3')
+        return cls(
+            db_path=os.getenv('SIMILARITY_INDEX_DB', default_db) or None,
+            threshold=float(os.getenv('SIMILARITY_THRESHOLD', DEFAULT_THRESHOLD)),
+            num_perm=int(os.getenv('SIMILARITY_NUM_PERM', DEFAULT_NUM_PERM)),
+            bands=int(os.getenv('SIMILARITY_BANDS', DEFAULT_BANDS)),
+            ttl_seconds=int(os.getenv('SIMILARITY_TTL_SECONDS', DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv('SIMILARITY_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)),
+            sync_interval=float(os.getenv('SIMILARITY_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)),
+        )
+
+    def _open_db(self, db_path: str) -> None:
+        try:
+            db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS similar_generations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    partition TEXT NOT NULL,
+                    fields TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            db.execute('CREATE INDEX IF NOT EXISTS similar_generations_created_at '
+                       'ON similar_generations (created_at)')
+            self._db = db
+            self._load()
+        except sqlite3.Error as e:
+            logger.error(f"Similarity index database unavailable, using memory only: {str(e)}")
+            self._db = None
+
+    def _after_fork(self) -> None:
+        """Give a forked worker its own connection; the in-memory index stays shared copy-on-write."""
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        if self._db is not None:
+            # The parent's connection must not be used or closed in the child
+            self._inherited_db = self._db
+            self._db = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+
+    def _load(self) -> None:
+        started = time.time()
+        rows = self._db.execute(
+            'SELECT id, partition, fields, signature, created_at FROM similar_generations '
+            'WHERE created_at >= ? ORDER BY id DESC LIMIT ?', (time.time() - self.ttl_seconds, self.max_entries)
+        ).fetchall()
+        rows.reverse()
+        self._insert_rows(rows)
+        logger.info(f"Loaded {len(self._entries)} generations into similarity index in {time.time() - started:.2f}s")
+
+    def _sync(self) -> None:
+        """Pick up generations other worker processes added to the shared database."""
+        if self._db is None or time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        try:
+            with self._db_lock:
+                if time.monotonic() - self._synced_at < self.sync_interval:
+                    return
+                self._synced_at = time.monotonic()
+                rows = self._db.execute(
+                    'SELECT id, partition, fields, signature, created_at FROM similar_generations '
+                    'WHERE id > ? ORDER BY id', (self._synced_id,)
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Similarity index sync failed: {str(e)}")
+            return
+        self._insert_rows(rows)
+
+    def _insert_rows(self, rows: List[Tuple[int, str, str, bytes, float]]) -> None:
+        now = time.time()
+        with self._lock:
+            for doc_id, partition, fields_json, blob, created_at in rows:
+                self._synced_id = max(self._synced_id, doc_id)
+                if doc_id in self._entries or now - created_at > self.ttl_seconds:
+                    continue
+                if '|variant=' not in partition:
+                    # Written before partitions carried the prompt variant; it can never match
+                    continue
+                shingle_set = shingles(free_text(json.loads(fields_json)))
+                signature = array('I')
+                signature.frombytes(blob)
+                if len(signature) != self.hasher.num_perm:
+                    signature = self.hasher.signature(shingle_set)
+                self._insert(doc_id, _digest(partition), signature, shingle_set, created_at)
+
+    def _band_keys(self, partition: bytes, signature: array) -> List[int]:
+        # A stable digest, so every process (and restart) buckets a signature the same way
+        return [int.from_bytes(hashlib.blake2b(
+                    partition + bytes((band,)) + signature[band * self.rows:(band + 1) * self.rows].tobytes(),
+                    digest_size=8).digest(), 'little')
+                for band in range(self.bands)]
+
+    def _insert(self, doc_id: int, partition: bytes, signature: array, shingle_set: Set[int],
+                created_at: float) -> None:
+        self._entries[doc_id] = (partition, array('I', sorted(shingle_set)), created_at)
+        for key in self._band_keys(partition, signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = doc_id
+            elif isinstance(bucket, int):
+                self._buckets[key] = array('q', (bucket, doc_id))
+            else:
+                bucket.append(doc_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, doc_id: int) -> None:
+        partition, stored, _ = self._entries.pop(doc_id)
+        self._memory_docs.pop(doc_id, None)
+        for key in self._band_keys(partition, self.hasher.signature(stored)):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            if isinstance(bucket, int):
+                if bucket == doc_id:
+                    del self._buckets[key]
+            elif doc_id in bucket:
+                bucket.remove(doc_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+
+    def _trim(self) -> None:
+        """Delete expired rows and rows beyond ``max_entries`` from the shared database."""
+        if time.monotonic() - self._trimmed_at < TRIM_INTERVAL:
+            return
+        self._trimmed_at = time.monotonic()
+        try:
+            with self._db_lock:
+                self._db.execute('DELETE FROM similar_generations WHERE created_at < ?',
+                                 (time.time() - self.ttl_seconds,))
+                self._db.execute(
+                    'DELETE FROM similar_generations WHERE id <= '
+                    '(SELECT id FROM similar_generations ORDER BY id DESC LIMIT 1 OFFSET ?)', (self.max_entries,))
+        except sqlite3.Error as e:
+            logger.error(f"Similarity index trim failed: {str(e)}")
+
+    def add(self, endpoint: str, fields: Dict[str, Any], result: Dict[str, Any], variant: str = '') -> None:
+        """Record a completed generation so later similar requests can reuse it.
+
+        ``variant`` identifies the prompt version and parameters the result was
+        generated with; only lookups with the same variant can match it.
+        """
+        partition = partition_key(endpoint, fields, variant)
+        shingle_set = shingles(free_text(fields))
+        signature = self.hasher.signature(shingle_set)
+        fields_json = json.dumps(fields, ensure_ascii=False)
+        result_json = json.dumps(result, ensure_ascii=False)
+        now = time.time()
+        doc_id = None
+        if self._db is not None:
+            try:
+                with self._db_lock:
+                    doc_id = self._db.execute(
+                        'INSERT INTO similar_generations (partition, fields, signature, result, created_at) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (partition, fields_json, signature.tobytes(), result_json, now)
+                    ).lastrowid
+            except sqlite3.Error as e:
+                logger.error(f"Similarity index write failed: {str(e)}")
+                return
+            self._trim()
+        with self._lock:
+            if doc_id is None:
+                doc_id = self._next_memory_id
+                self._next_memory_id -= 1
+                self._memory_docs[doc_id] = (fields_json, result_json, now)
+            self._insert(doc_id, _digest(partition), signature, shingle_set, now)
+
+    def lookup(self, endpoint: str, fields: Dict[str, Any], threshold: Optional[float] = None,
+               variant: str = '') -> Optional[Dict[str, Any]]:
+        """Return the most similar prior generation above ``threshold``, or None."""
+        threshold = self.threshold if threshold is None else threshold
+        partition = _digest(partition_key(endpoint, fields, variant))
+        query = shingles(free_text(fields))
+        signature = self.hasher.signature(query)
+        self._sync()
+        now = time.time()
+        best_id, best = None, (0.0, 0.0)
+        with self._lock:
+            self.lookups += 1
+            seen = set()
+            expired = []
+            for key in self._band_keys(partition, signature):
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    continue
+                for doc_id in ((bucket,) if isinstance(bucket, int) else bucket):
+                    if doc_id in seen:
+                        continue
+                    seen.add(doc_id)
+                    entry = self._entries.get(doc_id)
+                    if entry is None:
+                        continue
+                    stored_partition, stored, created_at = entry
+                    if now - created_at > self.ttl_seconds:
+                        expired.append(doc_id)
+                        continue
+                    if stored_partition != partition:
+                        continue
+                    common = len(query.intersection(stored))
+                    jaccard = common / (len(query) + len(stored) - common)
+                    if jaccard < threshold / 2:
+                        continue
+                    # Overlap first, then the closer request among equally covering ones
+                    score = (common / min(len(query), len(stored)), jaccard)
+                    if score > best:
+                        best_id, best = doc_id, score
+            for doc_id in expired:
+                self._remove(doc_id)
+            if best_id is None or best[0] < threshold:
+                return None
+            self.matches += 1
+            self._entries.move_to_end(best_id)
+            memory_doc = self._memory_docs.get(best_id)
+        match = self._fetch(best_id, best[0], memory_doc)
+        if match is None:
+            # Trimmed from the shared database by another worker
+            with self._lock:
+                if best_id in self._entries:
+                    self._remove(best_id)
+        return match
+
+    def _fetch(self, doc_id: int, score: float,
+               memory_doc: Optional[Tuple[str, str, float]]) -> Optional[Dict[str, Any]]:
+        if doc_id < 0:
+            if memory_doc is None:
+                return None
+            fields_json, result_json, created_at = memory_doc
+        else:
+            with self._db_lock:
+                row = self._db.execute(
+                    'SELECT fields, result, created_at FROM similar_generations WHERE id = ?', (doc_id,)
+                ).fetchone()
+            if row is None:
+                return None
+            fields_json, result_json, created_at = row
+        return {
+            "similarity": round(score, 3),
+            "fields": json.loads(fields_json),
+            "result": json.loads(result_json),
+            "created_at": created_at,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "documents": len(self._entries),
+                "buckets": len(self._buckets),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "lookups": self.lookups,
+                "matches": self.matches,
+                "evictions": self.evictions,
+                "persistent": self._db is not None,
+            }
@@ -0,0 +1,190 @@
+"""Single-flight coalescing of identical in-flight generation requests.
+
+The first caller for a key becomes the leader and performs the upstream call;
+callers that arrive while it is running become followers and attach to the
+leader's result (or, in streaming mode, to its live token stream) instead of
+issuing their own completion. Errors raised by the leader fan out to every
+follower, and followers give up after a configurable timeout.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, AsyncIterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT_SECONDS = 120.0
+
+
+class CoalescingTimeout(TimeoutError):
+    """Raised when a follower gives up waiting for its leader."""
+
+
+class Flight:
+    """One in-flight upstream call shared between threads."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+
+    def publish(self, chunk: str) -> None:
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, result: Dict[str, Any]) -> None:
+        with self._cond:
+            self.result = result
+            self.done = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException) -> None:
+        with self._cond:
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def wait(self, timeout: float) -> Dict[str, Any]:
+        """Block until the leader finishes and return its result."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.done, timeout):
+                raise CoalescingTimeout(f"Timed out after {timeout}s waiting for coalesced request")
+            if self.error is not None:
+                raise self.error
+            return self.result
+
+    def iter_chunks(self, timeout: float) -> Iterator[str]:
+        """Yield the leader's stream chunks from the start, following it live."""
+        deadline = time.monotonic() + timeout
+        index = 0
+        while True:
+            with self._cond:
+                ready = self._cond.wait_for(lambda: index < len(self.chunks) or self.done,
+                                            max(0.0, deadline - time.monotonic()))
+                if not ready:
+                    raise CoalescingTimeout(f"Timed out after {timeout}s waiting for coalesced stream")
+                pending = self.chunks[index:]
+                finished = self.done
+                error = self.error
+            index += len(pending)
+            yield from pending
+            if finished and index >= len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+class AsyncFlight:
+    """One in-flight upstream call shared between coroutines on one event loop."""
+
+    def __init__(self):
+        self._changed = asyncio.Event()
+        self.chunks = []
+        self.done = False
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, result: Dict[str, Any]) -> None:
+        self.result = result
+        self.done = True
+        self._notify()
+
+    def fail(self, error: BaseException) -> None:
+        self.error = error
+        self.done = True
+        self._notify()
+
+    async def wait(self, timeout: float) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        while not self.done:
+            await self._wait_changed(deadline, timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    async def iter_chunks(self, timeout: float) -> AsyncIterator[str]:
+        deadline = time.monotonic() + timeout
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                index += 1
+                yield self.chunks[index - 1]
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._wait_changed(deadline, timeout)
+
+    async def _wait_changed(self, deadline: float, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._changed.wait(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise CoalescingTimeout(f"Timed out after {timeout}s waiting for coalesced request") from None
+
+
+class SingleFlight:
+    """Registry of in-flight calls keyed on the normalized request."""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT_SECONDS, flight_factory: Callable[[], Any] = Flight):
+        self.timeout = timeout
+        self._flight_factory = flight_factory
+        self._flights: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @classmethod
+    def from_env(cls, flight_factory: Callable[[], Any] = Flight) -> 'SingleFlight':
+        timeout = float(os.getenv('COALESCE_TIMEOUT_SECONDS', DEFAULT_TIMEOUT_SECONDS))
+        return cls(timeout=timeout, flight_factory=flight_factory)
+
+    def _count(self, endpoint: str, name: str) -> None:
+        counters = self._stats.setdefault(endpoint, {'leaders': 0, 'followers': 0, 'timeouts': 0, 'errors': 0})
+        counters[name] += 1
+
+    def join(self, endpoint: str, key: str) -> Tuple[Any, bool]:
+        """Return ``(flight, is_leader)`` for ``key``, creating the flight if none is running."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._count(endpoint, 'followers')
+                return flight, False
+            flight = self._flight_factory()
+            self._flights[key] = flight
+            self._count(endpoint, 'leaders')
+            return flight, True
+
+    def leave(self, endpoint: str, key: str, flight: Any) -> None:
+        """Retire the leader's flight so later requests start a new one."""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if flight.error is not None:
+                self._count(endpoint, 'errors')
+
+    def record_timeout(self, endpoint: str) -> None:
+        with self._lock:
+            self._count(endpoint, 'timeouts')
+
+    def stats(self) -> Dict[str, Any]:
+        """Return per-endpoint counters; ``followers`` is the number of upstream calls saved."""
+        with self._lock:
+            endpoints = {name: dict(counters) for name, counters in self._stats.items()}
+            return {
+                'timeout_seconds': self.timeout,
+                'in_flight': len(self._flights),
+                'upstream_calls_saved': sum(c['followers'] for c in endpoints.values()),
+                'endpoints': endpoints,
+            }
@@ -0,0 +1,90 @@
+"""Server-sent-events helpers for the streaming generation endpoints."""
+import json
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # keep nginx/Vercel proxies from buffering the stream
+}
+
+
+def streaming_requested(args, headers) -> bool:
+    """Return True if the request opted into an SSE response via ``?stream=1`` or ``Accept``."""
+    if args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'text/event-stream' in headers.get('Accept', '')
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Encode one SSE frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def usage_to_dict(usage: Any) -> Optional[Dict[str, Any]]:
+    """Convert an upstream usage object into a plain dict."""
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage
+    if hasattr(usage, 'model_dump'):
+        return usage.model_dump()
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+        'completion_tokens': getattr(usage, 'completion_tokens', None),
+        'total_tokens': getattr(usage, 'total_tokens', None),
+    }
+
+
+def cached_tokens(usage: Optional[Dict[str, Any]]) -> int:
+    """Prompt tokens the upstream served from its prompt cache, per ``usage.prompt_tokens_details``."""
+    details = (usage or {}).get('prompt_tokens_details') or {}
+    return details.get('cached_tokens') or 0
+
+
+def chunk_events(chunk: Any) -> Iterator[Tuple[str, Any]]:
+    """Flatten one upstream chat-completion chunk into ``(kind, value)`` pairs.
+
+    ``kind`` is ``'delta'`` for content text, ``'finish_reason'`` when the
+    choice completes and ``'usage'`` for the trailing usage chunk.
+    """
+    for choice in chunk.choices or []:
+        content = getattr(choice.delta, 'content', None)
+        if content:
+            yield 'delta', content
+        if choice.finish_reason:
+            yield 'finish_reason', choice.finish_reason
+    if getattr(chunk, 'usage', None) is not None:
+        yield 'usage', usage_to_dict(chunk.usage)
+
+
+def iter_stream_events(chunks: Iterable[Any]) -> Iterator[Tuple[str, Any]]:
+    """Flatten a synchronous upstream stream into ``(kind, value)`` pairs."""
+    for chunk in chunks:
+        yield from chunk_events(chunk)
+
+
+class EventStream:
+    """The ``(kind, value)`` events of one open upstream stream.
+
+    ``close()`` always runs ``on_close``, which releases the upstream
+    response, even when iteration never started; closing an unstarted
+    generator would not run its cleanup.
+    """
+
+    __slots__ = ('_events', '_on_close')
+
+    def __init__(self, events: Iterator[Tuple[str, Any]], on_close: Callable[[], None]):
+        self._events = events
+        self._on_close = on_close
+
+    def __iter__(self) -> 'EventStream':
+        return self
+
+    def __next__(self) -> Tuple[str, Any]:
+        return next(self._events)
+
+    def close(self) -> None:
+        try:
+            self._events.close()
+        finally:
+            self._on_close()
@@ -0,0 +1,97 @@
+"""Pre-serialized, pre-compressed responses for the catalog endpoints.
+
+A ``PreparedResponse`` holds the JSON body serialized once together with its
+gzip and brotli variants and a strong ETag per encoding, so repeated polls
+cost a dictionary lookup plus content negotiation instead of a rebuild.
+Brotli is optional; without the ``brotli`` package only gzip is offered.
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+# Bodies smaller than this are served uncompressed; the framing overhead outweighs the gain
+MIN_COMPRESS_SIZE = 256
+
+
+class PreparedResponse:
+    """A JSON body with precomputed encodings and ETags."""
+
+    def __init__(self, body: bytes, cache_control: str = 'no-cache',
+                 headers: Optional[Dict[str, str]] = None, mimetype: str = 'application/json'):
+        self.cache_control = cache_control
+        self.headers = headers or {}
+        self.mimetype = mimetype
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': (body, digest)}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants['gzip'] = (compressed, f"{digest}-gz")
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    self.variants['br'] = (compressed, f"{digest}-br")
+
+    def _negotiate(self, accept_encoding) -> str:
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encoding[encoding]:
+                return encoding
+        return 'identity'
+
+    def to_response(self, request) -> Response:
+        """Build the Flask response for ``request``, honouring Accept-Encoding and If-None-Match."""
+        encoding = self._negotiate(request.accept_encodings)
+        body, etag = self.variants[encoding]
+        headers = dict(self.headers)
+        headers['Cache-Control'] = self.cache_control
+        headers['Vary'] = 'Accept-Encoding'
+        if any(request.if_none_match.contains(tag) for _, tag in self.variants.values()):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        response = Response(body, mimetype=self.mimetype, headers=headers)
+        response.set_etag(etag)
+        return response
+
+
+class PreparedResponseCache:
+    """Bounded LRU of prepared responses keyed by endpoint, data version and query."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key: Hashable, build: Callable[[], PreparedResponse]) -> PreparedResponse:
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is not None:
+                self._entries.move_to_end(key)
+                return prepared
+        prepared = build()
+        with self._lock:
+            self._entries[key] = prepared
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prepared
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def prepare_json(app, payload: Any, **kwargs) -> PreparedResponse:
+    """Serialize ``payload`` exactly as ``jsonify`` would and prepare its encodings."""
+    body = (app.json.dumps(payload) + "\n").encode('utf-8')
+    return PreparedResponse(body, **kwargs)
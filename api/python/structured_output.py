@@ -0,0 +1,315 @@
+"""Structured JSON output for the generate endpoints.
+
+With ``?structured=1`` (or ``X-Structured-Output: 1``) a generate request asks
+the upstream for JSON constrained by the artifact's schema instead of
+markdown, and the response carries the parsed object under the usual result
+key. A lesson plan comes back in the ``content`` shape of stored plans (one
+field per section), a rubric as criteria rows with their levels, a unit plan
+as weeks and activities as a list.
+
+Streamed, the raw JSON is not forwarded as ``delta`` frames. An incremental
+parser watches the token stream and emits each top-level field as it closes:
+``section`` frames for lesson sections, one ``row`` per rubric criterion,
+one ``week`` per unit plan week, one ``activity`` per activity, and ``field``
+frames for everything else. Clients render progressively and never re-parse
+the text.
+
+Strict JSON schemas need a model that supports them, so structured requests
+default to ``STRUCTURED_OUTPUT_MODEL``, and JSON output gets a larger
+``max_tokens`` (``STRUCTURED_TOKEN_FACTOR``) for its quoting and keys.
+"""
+import json
+import os
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from lesson_sections import OVERVIEW_KEY, SECTION_KEYS
+from prompts import GenerationRequest, RequestValidationError
+
+STRUCTURED_OUTPUT_MODEL = os.getenv('STRUCTURED_OUTPUT_MODEL', 'gpt-4o-mini')
+STRUCTURED_TOKEN_FACTOR = float(os.getenv('STRUCTURED_TOKEN_FACTOR', 1.2))
+
+STRUCTURED_INSTRUCTION = (
+    "Responde únicamente con un objeto JSON que siga el esquema indicado. "
+    "Dentro de cada campo de texto puedes usar markdown."
+)
+
+
+def structured_requested(args, headers) -> bool:
+    """Return True if the request asked for JSON output via ``?structured=1`` or ``X-Structured-Output``."""
+    if args.get('structured', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return headers.get('X-Structured-Output', '').lower() in ('1', 'true', 'yes')
+
+
+class StructuredOutputError(ValueError):
+    """Raised when a structured completion is not the JSON object its schema asks for."""
+
+
+def _object(properties: Dict[str, Any]) -> Dict[str, Any]:
+    # Strict schemas list every property as required and allow no others
+    return {"type": "object", "properties": properties, "required": list(properties),
+            "additionalProperties": False}
+
+
+def _text(description: str) -> Dict[str, Any]:
+    return {"type": "string", "description": description}
+
+
+def _list(items: Dict[str, Any], description: str = '') -> Dict[str, Any]:
+    schema = {"type": "array", "items": items}
+    if description:
+        schema["description"] = description
+    return schema
+
+
+@dataclass
+class StructuredArtifact:
+    """The JSON schema of one endpoint's output and the stream events its fields map to."""
+    name: str
+    schema: Dict[str, Any]
+    # Top-level arrays whose elements are emitted one by one, mapped to their event name
+    items: Dict[str, str] = field(default_factory=dict)
+    # Top-level fields emitted as ``section`` events; the rest are ``field`` events
+    sections: Tuple[str, ...] = ()
+
+    def response_format(self) -> Dict[str, Any]:
+        return {"type": "json_schema", "json_schema": {"name": self.name, "strict": True, "schema": self.schema}}
+
+
+ARTIFACTS: Dict[str, StructuredArtifact] = {
+    'generate-lesson': StructuredArtifact(
+        'lesson_plan',
+        _object(dict(
+            {"title": _text("Título de la clase")},
+            **{key: _text(f"Sección '{key}' del plan de clase") for key in SECTION_KEYS},
+        )),
+        sections=SECTION_KEYS,
+    ),
+    'generate-rubric': StructuredArtifact(
+        'rubric',
+        _object({
+            "title": _text("Título de la rúbrica"),
+            "criteria": _list(_object({
+                "criterion": _text("Criterio evaluado"),
+                "levels": _list(_object({
+                    "level": _text("Nivel de desempeño"),
+                    "score": {"type": "integer"},
+                    "description": _text("Descriptor del nivel"),
+                })),
+            }), "Una fila por criterio"),
+            "max_score": {"type": "integer"},
+        }),
+        items={"criteria": "row"},
+    ),
+    'generate-unit-plan': StructuredArtifact(
+        'unit_plan',
+        _object({
+            "title": _text("Título de la unidad"),
+            "objectives": _list({"type": "string"}),
+            "weeks": _list(_object({
+                "week": {"type": "integer"},
+                "focus": _text("Enfoque de la semana"),
+                "activities": _list({"type": "string"}),
+                "assessment": _text("Evaluación de la semana"),
+            }), "Desglose semanal"),
+            "assessment_plan": _text("Plan de evaluación de la unidad"),
+            "materials": _list({"type": "string"}),
+        }),
+        items={"weeks": "week"},
+    ),
+    'generate-activities': StructuredArtifact(
+        'activities',
+        _object({
+            "activities": _list(_object({
+                "title": _text("Nombre de la actividad"),
+                "description": _text("Descripción"),
+                "duration_minutes": {"type": "integer"},
+                "grouping": _text("Individual, parejas, grupos..."),
+                "materials": _list({"type": "string"}),
+                "steps": _list({"type": "string"}),
+            })),
+        }),
+        items={"activities": "activity"},
+    ),
+}
+
+
+def is_structured(gen: GenerationRequest) -> bool:
+    return 'response_format' in gen.params
+
+
+def structured_request(gen: GenerationRequest) -> GenerationRequest:
+    """Turn a built generation request into its schema-constrained JSON variant."""
+    artifact = ARTIFACTS.get(gen.endpoint)
+    if artifact is None:
+        raise RequestValidationError(f"{gen.endpoint} does not support structured output")
+    messages = [dict(message) for message in gen.messages]
+    # Appended last, so the system message and course context stay a shared prompt prefix
+    messages[-1]["content"] = f"{messages[-1]['content']}\n\n{STRUCTURED_INSTRUCTION}"
+    params = dict(gen.params, model=STRUCTURED_OUTPUT_MODEL, response_format=artifact.response_format())
+    if params.get('max_tokens'):
+        params['max_tokens'] = int(params['max_tokens'] * STRUCTURED_TOKEN_FACTOR)
+    return replace(gen, messages=messages, params=params)
+
+
+def parse_document(content: str) -> Dict[str, Any]:
+    """Parse a structured completion, raising StructuredOutputError if it is not a JSON object."""
+    try:
+        document = json.loads(content)
+    except (TypeError, ValueError) as e:
+        raise StructuredOutputError(f"La respuesta estructurada no es JSON válido: {str(e)}") from e
+    if not isinstance(document, dict):
+        raise StructuredOutputError("La respuesta estructurada no es un objeto JSON")
+    return document
+
+
+def document_sections(document: Dict[str, Any]) -> Dict[str, str]:
+    """A structured lesson plan in the section dict shape stored plans use."""
+    sections = {key: str(document[key]).strip() for key in SECTION_KEYS if document.get(key)}
+    if document.get('title'):
+        sections[OVERVIEW_KEY] = str(document['title']).strip()
+    return sections
+
+
+class _Frame:
+    __slots__ = ('kind', 'path', 'key', 'index', 'expect_key')
+
+    def __init__(self, kind: str, path: Tuple):
+        self.kind = kind
+        self.path = path
+        self.key = None
+        self.index = 0
+        self.expect_key = kind == '{'
+
+
+class IncrementalJSONParser:
+    """Streaming JSON scanner emitting ``(path, value)`` as each watched value closes.
+
+    ``watch(path)`` selects values by their path (a tuple of keys and array
+    indexes). Only the watched value currently open is buffered; watched values
+    must not nest.
+    """
+
+    def __init__(self, watch: Callable[[Tuple], bool]):
+        self.watch = watch
+        self._frames: List[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        self._key_chars: Optional[List[str]] = None
+        self._scalar = False
+        self._capture: Optional[List[str]] = None
+        self._capture_path: Optional[Tuple] = None
+        self._events: List[Tuple[Tuple, Any]] = []
+
+    def _path(self) -> Tuple:
+        if not self._frames:
+            return ()
+        top = self._frames[-1]
+        return top.path + ((top.key,) if top.kind == '{' else (top.index,))
+
+    def _start(self, path: Tuple) -> None:
+        if self._capture is None and self.watch(path):
+            self._capture = []
+            self._capture_path = path
+
+    def _end(self, path: Tuple) -> None:
+        if self._capture is not None and self._capture_path == path:
+            value = json.loads(''.join(self._capture))
+            self._capture = None
+            self._events.append((path, value))
+
+    def feed(self, text: str) -> List[Tuple[Tuple, Any]]:
+        """Consume the next chunk and return the watched values it completed."""
+        for char in text:
+            if self._in_string:
+                if self._capture is not None:
+                    self._capture.append(char)
+                if self._key_chars is not None:
+                    self._key_chars.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._frames[-1].key = json.loads('"' + ''.join(self._key_chars))
+                        self._key_chars = None
+                    else:
+                        self._end(self._path())
+                continue
+            if self._scalar:
+                if char not in ',}] \t\r\n':
+                    if self._capture is not None:
+                        self._capture.append(char)
+                    continue
+                self._scalar = False
+                self._end(self._path())
+            if char in ' \t\r\n':
+                if self._capture is not None:
+                    self._capture.append(char)
+                continue
+            top = self._frames[-1] if self._frames else None
+            if char == '"':
+                if top is not None and top.kind == '{' and top.expect_key:
+                    self._key_chars = []
+                else:
+                    self._start(self._path())
+                self._in_string = True
+            elif char in '{[':
+                path = self._path()
+                self._start(path)
+                self._frames.append(_Frame(char, path))
+            elif char in '}]':
+                if self._capture is not None:
+                    self._capture.append(char)
+                frame = self._frames.pop()
+                self._end(frame.path)
+                continue
+            elif char == ':':
+                top.expect_key = False
+            elif char == ',':
+                if top.kind == '{':
+                    top.expect_key = True
+                else:
+                    top.index += 1
+            else:
+                self._start(self._path())
+                self._scalar = True
+            if self._capture is not None:
+                self._capture.append(char)
+        events, self._events = self._events, []
+        return events
+
+
+def stream_framer(gen: GenerationRequest) -> Callable[[str], List[Tuple[str, Dict[str, Any]]]]:
+    """Map completion text chunks to SSE ``(event, data)`` frames for one response.
+
+    Plain generations become ``delta`` frames; structured ones the parsed fields.
+    """
+    if not is_structured(gen):
+        return lambda chunk: [("delta", {"content": chunk})]
+    return StructuredStream(gen.endpoint).feed
+
+
+class StructuredStream:
+    """Turns the text chunks of a structured completion into ``(event, data)`` frames."""
+
+    def __init__(self, endpoint: str):
+        artifact = ARTIFACTS[endpoint]
+        self.artifact = artifact
+        self.parser = IncrementalJSONParser(
+            lambda path: (len(path) == 1 and path[0] not in artifact.items)
+            or (len(path) == 2 and path[0] in artifact.items))
+
+    def feed(self, text: str) -> List[Tuple[str, Dict[str, Any]]]:
+        frames = []
+        for path, value in self.parser.feed(text):
+            if len(path) == 2:
+                frames.append((self.artifact.items[path[0]], {"key": path[0], "index": path[1], "value": value}))
+            elif path[0] in self.artifact.sections:
+                frames.append(("section", {"key": path[0], "value": value}))
+            else:
+                frames.append(("field", {"key": path[0], "value": value}))
+        return frames
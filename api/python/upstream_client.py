@@ -0,0 +1,113 @@
+"""Lazily created, shared OpenAI client with cached credential health.
+
+The client (and its keep-alive connection pool) is created on first use
+instead of at import time, and the API key is validated by a background
+thread that refreshes the result periodically. Key-check endpoints read
+the cached state instead of calling the upstream on every hit.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from openai import OpenAI, AuthenticationError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_SECONDS = 300
+
+
+def api_key_configured(api_key: Optional[str]) -> bool:
+    return bool(api_key) and api_key != 'your-api-key-here'
+
+
+class UpstreamClient:
+    """Owns the process-wide OpenAI client and the background key validator."""
+
+    def __init__(self, api_key: Optional[str], refresh_seconds: float = DEFAULT_REFRESH_SECONDS):
+        self.api_key = api_key
+        self.refresh_seconds = refresh_seconds
+        self._client: Optional[OpenAI] = None
+        self._lock = threading.Lock()
+        self._refresh = threading.Event()
+        self._pid: Optional[int] = None
+        self._health: Dict[str, Any] = {"valid": None, "pending": True, "checked_at": None}
+
+    @classmethod
+    def from_env(cls) -> 'UpstreamClient':
+        return cls(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            refresh_seconds=float(os.getenv('OPENAI_KEY_REFRESH_SECONDS', DEFAULT_REFRESH_SECONDS)),
+        )
+
+    @property
+    def client(self) -> OpenAI:
+        """Return the shared client, creating it on first use (and again after a fork)."""
+        self._ensure_process()
+        client = self._client
+        if client is None:
+            if not api_key_configured(self.api_key):
+                raise ValueError("OpenAI API key not configured")
+            with self._lock:
+                if self._client is None:
+                    # Retries are left to the caller so the deadline bounds the whole call
+                    self._client = OpenAI(api_key=self.api_key, max_retries=0)
+                client = self._client
+        return client
+
+    def _ensure_process(self) -> None:
+        """Start the validator once per process; forked children get a fresh pool and thread."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._client = None
+            self._refresh = threading.Event()
+            thread = threading.Thread(target=self._validate_loop, name='openai-key-health', daemon=True)
+            thread.start()
+
+    def _validate_loop(self) -> None:
+        refresh = self._refresh
+        while True:
+            self._health = self.check()
+            refresh.wait(self.refresh_seconds)
+            refresh.clear()
+
+    def check(self) -> Dict[str, Any]:
+        """Validate the API key against the upstream (blocking) and return the health record."""
+        checked_at = datetime.now().isoformat()
+        if not api_key_configured(self.api_key):
+            logger.error("OpenAI API key not configured")
+            return {"valid": False, "error": "OpenAI API key not configured", "checked_at": checked_at}
+        started = time.monotonic()
+        try:
+            models = self.client.models.list()
+            logger.info("OpenAI API key validated successfully")
+            return {
+                "valid": True,
+                "models_available": len(models.data),
+                "latency_ms": round((time.monotonic() - started) * 1000, 1),
+                "checked_at": checked_at,
+            }
+        except AuthenticationError:
+            logger.error("Invalid OpenAI API key")
+            return {"valid": False, "error": "Invalid OpenAI API key", "checked_at": checked_at}
+        except Exception as e:
+            logger.error(f"Error validating OpenAI API key: {str(e)}")
+            return {"valid": False, "error": f"Error validating OpenAI API key: {str(e)}", "checked_at": checked_at}
+
+    def health(self, refresh: bool = False) -> Dict[str, Any]:
+        """Return the cached key health without touching the network.
+
+        ``refresh`` wakes the validator thread early; the caller still gets the
+        current cached state immediately.
+        """
+        self._ensure_process()
+        if refresh:
+            self._refresh.set()
+        return dict(self._health)